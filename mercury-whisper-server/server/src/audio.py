@@ -1,27 +1,97 @@
 import asyncio
+import bisect
+import itertools
+import time
 import numpy as np
 from numpy.typing import NDArray
-from collections.abc import AsyncGenerator
-from config import SAMPLE_RATE
+from collections import deque
+from collections.abc import AsyncGenerator, Callable
+from config import SAMPLE_RATE, AUDIO_RETENTION, HOP_LENGTH, INBOUND_MAX_PENDING
+from ingest import AudioDecoder
 from fastapi import WebSocket, WebSocketDisconnect
 from fastapi.websockets import WebSocketState
 import logging
 
 logger = logging.getLogger(__name__)
 
+MIN_CAPACITY = SAMPLE_RATE * 4
+
+
+class SampleBuffer:
+    # Amortized append-only sample storage. Samples are only ever written to
+    # the unused tail, and growing allocates a fresh array (capacity doubling),
+    # so views handed out by `view` stay valid while the buffer keeps growing.
+    # Released samples are skipped over and dropped on the next reallocation.
+    def __init__(self, data: NDArray[np.float32] | None = None) -> None:
+        self.array = (
+            np.asarray(data, dtype=np.float32)
+            if data is not None
+            else np.empty(0, dtype=np.float32)
+        )
+        self.head = 0
+        self.size = len(self.array)
+        self.released = 0
+
+    @property
+    def view(self) -> NDArray[np.float32]:
+        return self.array[self.head : self.head + self.size]
+
+    @property
+    def total(self) -> int:
+        return self.released + self.size
+
+    @property
+    def capacity(self) -> int:
+        return len(self.array) - self.head
+
+    def append(self, data: NDArray[np.float32]) -> None:
+        n = len(data)
+        if self.head + self.size + n > len(self.array):
+            self._grow(self.size + n)
+        tail = self.head + self.size
+        self.array[tail : tail + n] = data
+        self.size += n
+
+    def drop(self, n: int) -> None:
+        n = min(max(n, 0), self.size)
+        self.head += n
+        self.size -= n
+        self.released += n
+
+    def clear(self) -> None:
+        self.drop(self.size)
+
+    def _grow(self, required: int) -> None:
+        array = np.empty(max(2 * required, MIN_CAPACITY), dtype=np.float32)
+        array[: self.size] = self.view
+        self.array = array
+        self.head = 0
+
 
 class Audio:
     def __init__(
         self,
-        data: NDArray[np.float32] = np.array([], dtype=np.float32),
+        data: NDArray[np.float32] | None = None,
         start: float = 0.0,
     ) -> None:
-        self.data = data
+        self.buffer = SampleBuffer(data)
         self.start = start
 
+    @property
+    def data(self) -> NDArray[np.float32]:
+        return self.buffer.view
+
+    @property
+    def start(self) -> float:
+        return self.origin + self.buffer.released / SAMPLE_RATE
+
+    @start.setter
+    def start(self, start: float) -> None:
+        self.origin = start - self.buffer.released / SAMPLE_RATE
+
     @property
     def duration(self) -> float:
-        return len(self.data) / SAMPLE_RATE
+        return self.buffer.size / SAMPLE_RATE
 
     @property
     def end(self) -> float:
@@ -29,7 +99,7 @@ class Audio:
 
     @property
     def size(self) -> int:
-        return len(self.data)
+        return self.buffer.size
 
     def after(self, ts: float) -> "Audio":
         adjust = ts - self.start if ts > self.duration else ts
@@ -37,46 +107,131 @@ class Audio:
         return Audio(data=self.data[int(adjust * SAMPLE_RATE) :], start=ts)
 
     def extend(self, data: NDArray[np.float32]) -> None:
-        self.data = np.append(self.data, data)
+        self.buffer.append(data)
+
+    def release(self, ts: float) -> None:
+        # drop samples before the absolute timestamp ts, snapped down to the
+        # feature hop so cached log-mel frames can be shifted instead of
+        # recomputed
+        target = int(ts * SAMPLE_RATE) // HOP_LENGTH * HOP_LENGTH
+        self.buffer.drop(target - int(round(self.start * SAMPLE_RATE)))
+
+    def compact(self, regions: list[tuple[float, float]]) -> tuple["Audio", "SpeechMap"]:
+        # speech only copy of the audio, regions are sorted stream times
+        origin = int(round(self.start * SAMPLE_RATE))
+        samples = [
+            (
+                max(int(round(start * SAMPLE_RATE)), origin),
+                min(int(round(end * SAMPLE_RATE)), origin + self.size),
+            )
+            for start, end in regions
+        ]
+        samples = [(start, end) for start, end in samples if end > start]
+        data = self.data
+        compacted = np.concatenate(
+            [data[start - origin : end - origin] for start, end in samples]
+        )
+        return Audio(data=compacted), SpeechMap(samples)
 
     def set(self, ts: float) -> None:
         assert ts <= self.duration
-        self.data = np.array([self.data[int(ts * SAMPLE_RATE) :]], dtype=np.float32)
+        self.buffer.drop(int(ts * SAMPLE_RATE))
         self.start = 0.0
 
     def reset(self) -> None:
-        self.data = np.array([], dtype=np.float32)
+        self.buffer.clear()
         self.start = 0.0
 
 
+class SpeechMap:
+    # Maps times in a compacted, speech only buffer back to stream time.
+    # Like faster_whisper.vad.SpeechTimestampsMap, but sample accurate and
+    # without rounding the result.
+    def __init__(self, regions: list[tuple[int, int]]) -> None:
+        # stream sample of every region's start, and its offset in the
+        # compacted buffer
+        self.origins = [start for start, _ in regions]
+        self.offsets = list(
+            itertools.accumulate((end - start for start, end in regions), initial=0)
+        )[:-1]
+
+    def original(self, seconds: float, end: bool = False) -> float:
+        # a time on the boundary of two regions is the start of the later
+        # one, or with end the end of the earlier one
+        sample = seconds * SAMPLE_RATE
+        if end:
+            i = bisect.bisect_left(self.offsets, round(sample)) - 1
+        else:
+            i = bisect.bisect_right(self.offsets, round(sample)) - 1
+        i = max(i, 0)
+        return (self.origins[i] + sample - self.offsets[i]) / SAMPLE_RATE
+
+
 class AudioStream(Audio):
     def __init__(
         self,
-        data: NDArray[np.float32] = np.array([], dtype=np.float32),
+        data: NDArray[np.float32] | None = None,
         start: float = 0.0,
+        retention: float = AUDIO_RETENTION,
     ) -> None:
         super().__init__(data=data, start=start)
 
+        self.retention = retention
         self.closed = False
         self.event = asyncio.Event()
+        # set whenever audio is handed out, see drain
+        self.consumed = asyncio.Event()
+        # end of the audio handed out by chunks
+        self.cursor = self.start
+        # (stream end, wall clock) of every frame not yet handed out
+        self.arrivals: deque[tuple[float, float]] = deque()
+        # wall clock arrival of the newest audio handed out
+        self.consumed_arrival = time.monotonic()
+        # number of frames received, a resumed client re-sends the rest
+        self.frames = 0
+
+    @property
+    def pending(self) -> float:
+        return self.end - self.cursor
+
+    @property
+    def lag(self) -> float:
+        # how long the oldest audio not yet handed out has been waiting
+        if len(self.arrivals) == 0:
+            return 0.0
+        return time.monotonic() - self.arrivals[0][1]
+
+    @property
+    def latency(self) -> float:
+        # age of the newest audio handed out, i.e. of a result computed from it
+        return time.monotonic() - self.consumed_arrival
 
     def extend(self, data: NDArray[np.float32]) -> None:
         assert not self.closed
         super().extend(data=data)
+        self.frames += 1
+        self.arrivals.append((self.end, time.monotonic()))
         self.event.set()
 
     def close(self) -> None:
         assert not self.closed
         self.closed = True
         self.event.set()
+        self.consumed.set()
+
+    async def drain(self, pending: float) -> None:
+        # waits until at most `pending` seconds are left to hand out
+        while self.pending > pending and not self.closed:
+            self.consumed.clear()
+            await self.consumed.wait()
 
     def slice(self, ts: float) -> NDArray[np.float32]:
-        return self.data[int(ts * SAMPLE_RATE) :]
+        return self.data[max(int(round((ts - self.start) * SAMPLE_RATE)), 0) :]
 
     async def chunks(
         self, min_duration: float
     ) -> AsyncGenerator[NDArray[np.float32], None]:
-        ts = 0.0
+        ts = self.start
         while True:
             await self.event.wait()
             self.event.clear()
@@ -84,33 +239,73 @@ class AudioStream(Audio):
             # if the stream is closed, end generator
             # if there are remainding data, yeild rest of data
             if self.closed:
-                if self.duration > ts:
+                if self.end > ts:
+                    self._advance(self.end)
                     yield self.slice(ts=ts)
                 return
 
-            # yield chunks of data by min_duration
-            if self.duration - ts >= min_duration:
+            # yield chunks of data by min_duration, everything that arrived
+            # while the consumer was busy is handed out as one chunk
+            if self.end - ts >= min_duration:
                 ts_ = ts
-                ts = self.duration
+                ts = self.end
+                self._advance(ts)
                 yield self.slice(ts=ts_)
+                # consumed audio is only kept for the retention window
+                self.release(ts - self.retention)
+
+    def _advance(self, ts: float) -> None:
+        self.cursor = ts
+        self.consumed.set()
+        while len(self.arrivals) > 0 and self.arrivals[0][0] <= ts:
+            self.consumed_arrival = self.arrivals.popleft()[1]
 
 
-async def stream_audio(websocket: WebSocket, audio_stream: AudioStream) -> None:
+async def stream_audio(
+    websocket: WebSocket,
+    audio_stream: AudioStream,
+    decoder: AudioDecoder | None = None,
+    on_text: Callable[[str], None] | None = None,
+    max_pending: float = INBOUND_MAX_PENDING,
+) -> int | None:
+    # binary frames are audio, text frames are control messages handed to
+    # on_text (and ignored without it). Reading pauses while more than
+    # max_pending seconds of audio wait for the transcriber, until it is
+    # down to half of that, so a client can not outrun its decodes. Returns
+    # the close code when the client disconnected.
     try:
         while True:
+            if audio_stream.pending > max_pending:
+                logger.debug("Pausing reads, transcriber is behind.")
+                await audio_stream.drain(max_pending / 2)
+            if audio_stream.closed:
+                # the session ended
+                break
             try:
-                data = await websocket.receive_bytes()
+                message = await websocket.receive()
             except RuntimeError as e:
                 if 'WebSocket is not connected. Need to call "accept" first.' in str(e):
                     logger.error("WebSocket was disconnected! Exiting stream audio...")
                     break
                 else:
                     raise
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message["code"], message.get("reason"))
+            if message.get("bytes") is None:
+                if on_text is not None and message.get("text") is not None:
+                    on_text(message["text"])
+                continue
+            data = message["bytes"]
 
-            float_array = np.frombuffer(data, dtype=np.float32)
+            if decoder is None:
+                float_array = np.frombuffer(data, dtype=np.float32)
+            else:
+                float_array = decoder.decode(data)
             audio_stream.extend(float_array)
 
     except TimeoutError:
         logger.info("Timeout! No data was detected!")
     except WebSocketDisconnect as e:
         logger.info(f"Client disconnected: {e}")
+        return e.code
+    return None
@@ -0,0 +1,139 @@
+from decode_policy import DecodePolicy
+from config import (
+    CHUNK_DURATION,
+    MAX_SESSIONS,
+    CAPACITY_TARGET_LOAD,
+    CAPACITY_WINDOW,
+    CAPACITY_LEVEL_INTERVAL,
+    ADMISSION_TIMEOUT,
+)
+from collections import deque
+from typing import Any
+import asyncio
+import logging
+import math
+import time
+
+logger = logging.getLogger(__name__)
+
+# Degradation levels, applied in order while the model is overloaded:
+#   (name, chunk interval, decode a partial every n chunks, 0 for never)
+LEVELS = (
+    ("normal", CHUNK_DURATION, 1),
+    ("longer-chunks", 2 * CHUNK_DURATION, 1),
+    ("fewer-partials", 2 * CHUNK_DURATION, 2),
+    ("finals-only", 2 * CHUNK_DURATION, 0),
+)
+
+
+class CapacityManager:
+    # Estimates model load from the decode time recorded by the decode
+    # tiers: the decode seconds spent over the last `window` seconds divided
+    # by the wall time and the number of decodes that can run in parallel.
+    # New sessions are only admitted while there is headroom for one more
+    # session at the measured per-session cost. When the load goes over
+    # `target` all sessions are degraded one level at a time, and restored
+    # once it falls well below it.
+    def __init__(
+        self,
+        policy: DecodePolicy,
+        parallelism: int = 1,
+        max_sessions: int = MAX_SESSIONS,
+        target: float = CAPACITY_TARGET_LOAD,
+        window: float = CAPACITY_WINDOW,
+        level_interval: float = CAPACITY_LEVEL_INTERVAL,
+    ) -> None:
+        self.policy = policy
+        self.parallelism = parallelism
+        self.max_sessions = max_sessions
+        self.target = target
+        self.window = window
+        self.level_interval = level_interval
+
+        self.sessions = 0
+        self.level = 0
+        self.level_changed = 0.0
+        # (wall clock, total decode seconds, total audio seconds)
+        self.samples: deque[tuple[float, float, float]] = deque()
+        self.load = 0.0
+        self.real_time_factor = 0.0
+
+    @property
+    def chunk_duration(self) -> float:
+        return LEVELS[self.level][1]
+
+    @property
+    def partial_stride(self) -> int:
+        return LEVELS[self.level][2]
+
+    def update(self) -> None:
+        now = time.monotonic()
+        tiers = {id(tier): tier for tier in (self.policy.partial, self.policy.final)}
+        decode = sum(tier.stats.decode_seconds for tier in tiers.values())
+        audio = sum(tier.stats.audio_seconds for tier in tiers.values())
+        self.samples.append((now, decode, audio))
+        while len(self.samples) > 2 and self.samples[1][0] <= now - self.window:
+            self.samples.popleft()
+
+        then, decode_then, audio_then = self.samples[0]
+        if now - then > 0:
+            self.load = (decode - decode_then) / ((now - then) * self.parallelism)
+        if audio - audio_then > 0:
+            self.real_time_factor = (decode - decode_then) / (audio - audio_then)
+
+        if now - self.level_changed < self.level_interval:
+            return
+        if self.load > self.target and self.level < len(LEVELS) - 1:
+            self._set_level(self.level + 1, now)
+        elif self.load < 0.6 * self.target and self.level > 0:
+            self._set_level(self.level - 1, now)
+
+    def _set_level(self, level: int, now: float) -> None:
+        logger.info(
+            f"Load {self.load:.2f}, switching from {LEVELS[self.level][0]} to {LEVELS[level][0]}."
+        )
+        self.level = level
+        self.level_changed = now
+
+    @property
+    def remaining(self) -> int:
+        remaining = self.max_sessions - self.sessions
+        if self.level > 0:
+            return 0
+        if self.sessions > 0 and self.load > 0:
+            per_session = self.load / self.sessions
+            remaining = min(
+                remaining, math.floor((self.target - self.load) / per_session)
+            )
+        return max(remaining, 0)
+
+    async def admit(self, timeout: float = ADMISSION_TIMEOUT) -> bool:
+        # waits up to timeout seconds for a free slot, an admitted session
+        # is counted until release() is called for it
+        deadline = time.monotonic() + timeout
+        while True:
+            self.update()
+            if self.remaining > 0:
+                self.sessions += 1
+                return True
+            if time.monotonic() >= deadline:
+                return False
+            await asyncio.sleep(min(0.5, max(deadline - time.monotonic(), 0.0)))
+
+    def release(self) -> None:
+        self.sessions -= 1
+
+    async def run(self, interval: float = 1.0) -> None:
+        while True:
+            self.update()
+            await asyncio.sleep(interval)
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "sessions": self.sessions,
+            "max_sessions": self.max_sessions,
+            "remaining": self.remaining,
+            "load": self.load,
+            "real_time_factor": self.real_time_factor,
+            "level": LEVELS[self.level][0],
+        }
@@ -1,6 +1,101 @@
+import os
+
 SAMPLE_RATE = 16000
 CHUNK_DURATION = 1.0
 MAX_SENTENCES = 3
 MAX_SILENCE = 10
 min_silence_duration_ms = 1500
 word_timestamp_error_margin = 0.2
+SCHEDULER_POLICY = "finals-first"
+SCHEDULER_MAX_BATCH_SIZE = 4
+SCHEDULER_MAX_WAIT = 0.02
+SCHEDULER_DEFAULT_DEADLINE = CHUNK_DURATION
+AUDIO_RETENTION = 30.0
+STREAMING_VAD = True
+VAD_STEP = 0.1
+vad_threshold = 0.5
+min_speech_duration_ms = 250
+eou_silence_duration_ms = 700
+INCREMENTAL_DECODE = True
+MAX_DECODE_WINDOW = 15.0
+INCREMENTAL_PROMPT_WORDS = 40
+FEATURE_CACHE = True
+HOP_LENGTH = 160
+# decode settings for partial hypotheses, finals always use the full settings
+# below. Without word timestamps partial word timings are interpolated from
+# segment timings, which makes incremental commits less precise.
+PARTIAL_BEAM_SIZE = 1
+PARTIAL_WORD_TIMESTAMPS = True
+PARTIAL_MODEL_SIZE = None
+FINAL_BEAM_SIZE = 5
+FINAL_WORD_TIMESTAMPS = True
+OPUS_SAMPLE_RATE = 48000
+RESAMPLER_ZERO_CROSSINGS = 16
+OFFLINE_CHUNK_DURATION = 30.0
+OFFLINE_MIN_SILENCE_DURATION_MS = 500
+SECRET_TTL = 3600.0
+TRANSLATION_CACHE_SIZE = 1024
+TRANSLATION_CACHE_TTL = 600.0
+TRANSLATION_MODEL = "gpt-4o"
+TRANSLATION_BATCH_WINDOW = 0.3
+METRICS_ENABLED = True
+TRACING_ENABLED = False
+# fraction of hot path log lines (one per decode) that are emitted
+LOG_SAMPLE_RATE = 0.1
+# model worker processes, 0 runs the model in the server process
+WORKER_PROCESSES = 0
+WORKER_CPU_THREADS = 4
+WORKER_SLOTS = 4
+WORKER_SLOT_SECONDS = 30.0
+WORKER_OVERLOAD = 2
+WORKER_SESSION_CACHE = 64
+# dead workers are looked for this often, and a decode waits at most
+# WORKER_REQUEST_TIMEOUT seconds for its worker
+WORKER_CHECK_INTERVAL = 1.0
+WORKER_REQUEST_TIMEOUT = 120.0
+# a worker failing to start this many times in a row fails the pool
+WORKER_MAX_START_FAILURES = 3
+MAX_SESSIONS = 64
+# fraction of the model's decode capacity sessions may use before new ones
+# are turned away and existing ones are degraded
+CAPACITY_TARGET_LOAD = 0.8
+CAPACITY_WINDOW = 30.0
+CAPACITY_LEVEL_INTERVAL = 5.0
+ADMISSION_TIMEOUT = 5.0
+# model construction, overridable from the environment. MODEL_PATH is a local
+# CTranslate2 model directory and takes precedence over MODEL_SIZE.
+MODEL_SIZE = os.environ.get("MERCURY_MODEL_SIZE", "large-v3")
+MODEL_PATH = os.environ.get("MERCURY_MODEL_PATH")
+MODEL_DEVICE = os.environ.get("MERCURY_MODEL_DEVICE", "cuda")
+MODEL_COMPUTE_TYPE = os.environ.get("MERCURY_MODEL_COMPUTE_TYPE", "float16")
+MODEL_CPU_THREADS = int(os.environ.get("MERCURY_MODEL_CPU_THREADS", "0"))
+MODEL_NUM_WORKERS = int(os.environ.get("MERCURY_MODEL_NUM_WORKERS", "1"))
+WARMUP_SECONDS = 5.0
+# a session detects its language until a decode is at least this confident,
+# then decodes with it. It is detected again when the mean segment log
+# probability of a decode falls below LANGUAGE_REDETECT_LOGPROB.
+LANGUAGE_DETECTION_THRESHOLD = 0.8
+LANGUAGE_REDETECT_LOGPROB = -1.0
+# resumable live sessions are kept this long after their connection drops
+RESUME_GRACE = 30.0
+# parked sessions keep their capacity slot, at most a quarter of the slots
+# can be held by them
+RESUME_MAX_SESSIONS = MAX_SESSIONS // 4
+RESUME_REPLAY_MESSAGES = 512
+# decode only the speech in a decode window, according to the session's
+# streaming VAD. Silences longer than SPEECH_WINDOW_MIN_SILENCE are cut
+# (keeping SPEECH_WINDOW_PAD on either side) when that removes at least
+# SPEECH_WINDOW_MIN_CUT seconds, otherwise the window is decoded as is.
+SPEECH_ONLY_DECODE = True
+SPEECH_WINDOW_PAD = 0.2
+SPEECH_WINDOW_MIN_SILENCE = 0.6
+SPEECH_WINDOW_MIN_CUT = 0.5
+# per session outbox: partials are coalesced, a client with more than
+# OUTBOX_MAX_MESSAGES queued or one waiting over OUTBOX_MAX_DELAY seconds is
+# disconnected. Reads pause while more than INBOUND_MAX_PENDING seconds of
+# received audio wait to be decoded.
+OUTBOX_MAX_MESSAGES = 32
+OUTBOX_MAX_DELAY = 10.0
+INBOUND_MAX_PENDING = 10.0
+# prompt chunks (words) whose token ids a session keeps
+PROMPT_CACHE_SIZE = 512
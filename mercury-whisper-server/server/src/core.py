@@ -1,11 +1,20 @@
-from pydantic import BaseModel
 from collections.abc import Iterable
+from dataclasses import dataclass
 from config import word_timestamp_error_margin
 import faster_whisper.transcribe
+import bisect
+import math
 import re
+import logging
 
+logger = logging.getLogger(__name__)
 
-class Word(BaseModel):
+
+# Words and segments are plain slotted dataclasses, they are created for
+# every word of every decode. Pydantic models are only built when a
+# transcription is serialized (see mercury_json).
+@dataclass(slots=True)
+class Word:
     start: float
     end: float
     word: str
@@ -17,7 +26,11 @@ class Word(BaseModel):
         for segment in segments:
             assert segment is not None
 
-            words.extend(segment.words)
+            words.extend(
+                segment.words
+                if segment.words is not None
+                else segment.interpolate_words()
+            )
 
         return words
 
@@ -26,7 +39,8 @@ class Word(BaseModel):
         self.end += seconds
 
 
-class Segment(BaseModel):
+@dataclass(slots=True)
+class Segment:
     id: int
     seek: int
     start: float
@@ -39,6 +53,25 @@ class Segment(BaseModel):
     no_speech_prob: float
     words: list[Word] | None
 
+    def interpolate_words(self) -> list[Word]:
+        # Estimate word timings when the segment was decoded without word
+        # alignment, spreading the segment duration by character count
+        tokens = re.findall(r"\s*\S+", self.text)
+        if len(tokens) == 0:
+            return []
+
+        total = sum(len(token.strip()) for token in tokens)
+        probability = math.exp(self.avg_logprob)
+        words: list[Word] = []
+        start = self.start
+        for token in tokens:
+            end = start + (self.end - self.start) * len(token.strip()) / total
+            words.append(
+                Word(start=start, end=end, word=token, probability=probability)
+            )
+            start = end
+        return words
+
     @classmethod
     def translate(
         cls, segments: Iterable[faster_whisper.transcribe.Segment]
@@ -74,7 +107,14 @@ class Segment(BaseModel):
 class Transcription:
     def __init__(self, words: list[Word] = []) -> None:
         self.words: list[Word] = []
+        # canonical form of every word, for agreement checks
+        self.canonical: list[str] = []
+        # index one past every sentence ending word
+        self.boundaries: list[int] = []
+        self.last_sentence: str | None = None
         self.type: str = "none"
+        # number of leading words that will not be revised anymore
+        self.stable = 0
         self.extend(words)
 
     @property
@@ -93,33 +133,114 @@ class Transcription:
     def duration(self) -> float:
         return self.end - self.start
 
-    def after(self, seconds: float) -> "Transcription":
-        return Transcription(
-            words=[word for word in self.words if word.start > seconds]
+    @property
+    def number_of_sentences(self) -> int:
+        return len(self.boundaries)
+
+    @property
+    def last_sentence_end(self) -> float:
+        return self.words[self.boundaries[-1] - 1].end if self.boundaries else 0.0
+
+    @property
+    def previous_sentence_end(self) -> float:
+        return (
+            self.words[self.boundaries[-2] - 1].end
+            if len(self.boundaries) > 1
+            else 0.0
         )
 
+    # words are kept sorted by start time, after bisects instead of scanning
+    def after(self, seconds: float) -> "Transcription":
+        i = bisect.bisect_right(self.words, seconds, key=lambda word: word.start)
+        return self._slice(i, len(self.words))
+
     def before(self, seconds: float) -> "Transcription":
+        # word ends may be out of order within the overlap margin, they are
+        # not bisected
         return Transcription(words=[word for word in self.words if word.end <= seconds])
 
+    def tail(self, i: int) -> "Transcription":
+        return self._slice(i, len(self.words))
+
+    def _slice(self, lo: int, hi: int) -> "Transcription":
+        # words taken from an already validated transcription keep their index
+        transcription = Transcription()
+        transcription.words = self.words[lo:hi]
+        transcription.canonical = self.canonical[lo:hi]
+        transcription.boundaries = [
+            boundary - lo
+            for boundary in self.boundaries[
+                bisect.bisect_right(self.boundaries, lo) : bisect.bisect_right(
+                    self.boundaries, hi
+                )
+            ]
+        ]
+        transcription._update_last_sentence()
+        return transcription
+
+    def snapshot(self) -> "Transcription":
+        # copy for messages that are built after the transcriber moved on
+        transcription = self._slice(0, len(self.words))
+        transcription.type = self.type
+        transcription.stable = self.stable
+        return transcription
+
     def replace(self, words: list[Word]) -> None:
         self.words = words
+        self.canonical = []
+        self.boundaries = []
+        self._index(words, 0)
+        self._update_last_sentence()
 
     def extend(self, words: list[Word]) -> None:
         self._ensure_no_word_overlap(words)
         self.words.extend(words)
+        if self._index(words, len(self.words) - len(words)):
+            self._update_last_sentence()
 
     def merge(self, words: list[Word]) -> None:
         if len(words):
-            if words[0].start == self.words[0].start:
+            if len(self.words) == 0 or words[0].start == self.words[0].start:
                 self.replace(words=words)
             else:
                 overlap_start = words[0].start
-                print(f"Merge Start: {overlap_start}")
-                print(f"Self: {self.words}")
-                print(f"Incoming: {words}")
-                self.replace(words=self.before(overlap_start).words)
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug(
+                        f"Merge start: {overlap_start}. Self: {self.words}. Incoming: {words}"
+                    )
+                # word ends are not sorted, see before. The words kept are the
+                # ones up to the first ending after the incoming words start.
+                self._truncate(
+                    next(
+                        (
+                            i
+                            for i, word in enumerate(self.words)
+                            if word.end > overlap_start
+                        ),
+                        len(self.words),
+                    )
+                )
                 self.extend(words=words)
 
+    def _truncate(self, i: int) -> None:
+        del self.words[i:]
+        del self.canonical[i:]
+        del self.boundaries[bisect.bisect_right(self.boundaries, i) :]
+        self._update_last_sentence()
+
+    def _index(self, words: list[Word], offset: int) -> bool:
+        self.canonical.extend(canonicalize_word(word.word) for word in words)
+        boundaries = [offset + i + 1 for i, word in enumerate(words) if is_eos(word.word)]
+        self.boundaries.extend(boundaries)
+        return len(boundaries) > 0
+
+    def _update_last_sentence(self) -> None:
+        if len(self.boundaries) == 0:
+            self.last_sentence = None
+            return
+        start = self.boundaries[-2] if len(self.boundaries) > 1 else 0
+        self.last_sentence = word_to_text(self.words[start : self.boundaries[-1]])
+
     def _ensure_no_word_overlap(self, words: list[Word]) -> None:
         if len(self.words) > 0 and len(words) > 0:
             if words[0].start + word_timestamp_error_margin <= self.words[-1].end:
@@ -165,19 +286,26 @@ def word_to_text(words: list[Word]) -> str:
     return "".join(word.word for word in words)
 
 
+NON_ALPHA = re.compile(r"[^a-z]")
+
+
 def canonicalize_word(text: str) -> str:
     text = text.lower()
-    return re.sub(r"[^a-z]", "", text)
+    return NON_ALPHA.sub("", text)
 
 
-def common_prefix(a: list[Word], b: list[Word]) -> list[Word]:
+def common_prefix_length(a: list[str], b: list[str]) -> int:
     i = 0
-    while (
-        i < len(a)
-        and i < len(b)
-        and canonicalize_word(a[i].word) == canonicalize_word(b[i].word)
-    ):
+    while i < len(a) and i < len(b) and a[i] == b[i]:
         i += 1
+    return i
+
+
+def common_prefix(a: list[Word], b: list[Word]) -> list[Word]:
+    i = common_prefix_length(
+        [canonicalize_word(word.word) for word in a],
+        [canonicalize_word(word.word) for word in b],
+    )
     return a[:i]
 
 
@@ -0,0 +1,67 @@
+from faster_whisper import WhisperModel
+from dataclasses import dataclass, field
+from typing import Any
+import threading
+
+
+@dataclass
+class TierStats:
+    decodes: int = 0
+    audio_seconds: float = 0.0
+    decode_seconds: float = 0.0
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def record(self, audio_seconds: float, decode_seconds: float) -> None:
+        with self.lock:
+            self.decodes += 1
+            self.audio_seconds += audio_seconds
+            self.decode_seconds += decode_seconds
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "decodes": self.decodes,
+            "audio_seconds": self.audio_seconds,
+            "decode_seconds": self.decode_seconds,
+            # seconds of audio decoded per second of compute
+            "throughput": (
+                self.audio_seconds / self.decode_seconds if self.decode_seconds else 0.0
+            ),
+        }
+
+
+@dataclass
+class DecodeTier:
+    name: str
+    beam_size: int = 5
+    word_timestamps: bool = True
+    # optional draft model used instead of the session's model
+    whisper: WhisperModel | None = None
+    stats: TierStats = field(default_factory=TierStats)
+
+    def options(self) -> dict[str, Any]:
+        return {"beam_size": self.beam_size, "word_timestamps": self.word_timestamps}
+
+
+class DecodePolicy:
+    # Partial hypotheses are overwritten a second later, so they are decoded
+    # with cheaper settings. Finals are decoded with the full-accuracy tier.
+    def __init__(self, partial: DecodeTier, final: DecodeTier) -> None:
+        self.partial = partial
+        self.final = final
+
+    @classmethod
+    def uniform(cls) -> "DecodePolicy":
+        return cls(partial=DecodeTier(name="partial"), final=DecodeTier(name="final"))
+
+    @property
+    def tiered(self) -> bool:
+        return (
+            self.partial.options() != self.final.options()
+            or self.partial.whisper is not self.final.whisper
+        )
+
+    def tier(self, final: bool) -> DecodeTier:
+        return self.final if final else self.partial
+
+    def stats(self) -> dict[str, Any]:
+        return {tier.name: tier.stats.to_dict() for tier in (self.partial, self.final)}
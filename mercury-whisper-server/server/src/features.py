@@ -0,0 +1,136 @@
+from faster_whisper.feature_extractor import FeatureExtractor
+from numpy.lib.stride_tricks import sliding_window_view
+from numpy.typing import NDArray
+import numpy as np
+import logging
+
+logger = logging.getLogger(__name__)
+
+# log10 of the clipped mel energy of an all zero frame
+SILENT_FRAME = -10.0
+
+
+class FeatureCache:
+    # Per-session stand-in for WhisperModel.feature_extractor. Raw log-mel
+    # frames that only depend on audio the session already had are kept
+    # between calls, so only frames touching newly appended samples go
+    # through the STFT. Frames before a trimmed buffer start are dropped by
+    # shifting the cache, which requires the trim to land on the hop grid.
+    def __init__(self, extractor: FeatureExtractor) -> None:
+        self.extractor = extractor
+        self.half_window = (extractor.n_fft - 1) // 2 + 1
+        self.window = np.hanning(extractor.n_fft + 1)[:-1]
+        self.reset()
+
+        self.origin = 0
+        self.next_origin = 0
+        self.computed = 0
+        self.reused = 0
+
+    def __getattr__(self, name: str):
+        return getattr(self.extractor, name)
+
+    def reset(self) -> None:
+        self.frames = np.empty((self.extractor.mel_filters.shape[0], 0), np.float32)
+        self.fingerprint: NDArray[np.float32] | None = None
+        self.fingerprint_at = 0
+
+    def set_origin(self, origin: int) -> None:
+        # absolute sample index of the first sample of the next waveform
+        self.next_origin = origin
+
+    def __call__(
+        self,
+        waveform: NDArray[np.float32],
+        padding: bool = True,
+        chunk_length: int | None = None,
+    ) -> NDArray[np.float32]:
+        if not padding or chunk_length is not None:
+            return self.extractor(waveform, padding=padding, chunk_length=chunk_length)
+
+        hop = self.extractor.hop_length
+        cached = self._shift(waveform)
+
+        length = len(waveform)
+        total = (length + self.extractor.n_samples) // hop
+        # frames whose window lies entirely inside the real audio
+        stable = min(max((length - self.half_window) // hop + 1, 0), total)
+        # frames from here on only see the zero padding
+        silent = min(-(-(length + self.half_window) // hop), total)
+        # the first frames are reflect padded at the buffer start and are
+        # always recomputed
+        edge = min(self.half_window // hop + 1, silent)
+        reuse = max(min(cached, silent), edge)
+
+        raw = np.empty((self.frames.shape[0], total), dtype=np.float32)
+        raw[:, :edge] = self._log_mel(waveform, 0, edge)
+        raw[:, edge:reuse] = self.frames[:, edge:reuse]
+        raw[:, reuse:silent] = self._log_mel(waveform, reuse, silent)
+        raw[:, silent:] = SILENT_FRAME
+
+        self.computed += silent - (reuse - edge)
+        self.reused += reuse - edge
+        self.frames = raw[:, :stable]
+        if stable > 0:
+            end = min(stable * hop, length)
+            self.fingerprint_at = self.origin + end - hop
+            self.fingerprint = waveform[end - hop : end].copy()
+
+        log_spec = np.maximum(raw, raw.max() - 8.0)
+        return (log_spec + 4.0) / 4.0
+
+    def _shift(self, waveform: NDArray[np.float32]) -> int:
+        shift = self.next_origin - self.origin
+        hop = self.extractor.hop_length
+        self.origin = self.next_origin
+
+        if shift < 0 or shift % hop != 0 or self.fingerprint is None:
+            self.reset()
+            return 0
+
+        # make sure the cached frames were computed from this audio
+        at = self.fingerprint_at - self.origin
+        if at < 0 or at + hop > len(waveform):
+            self.reset()
+            return 0
+        if not np.array_equal(waveform[at : at + hop], self.fingerprint):
+            self.reset()
+            return 0
+
+        self.frames = self.frames[:, shift // hop :]
+        return self.frames.shape[1]
+
+    def _log_mel(
+        self, waveform: NDArray[np.float32], start: int, end: int
+    ) -> NDArray[np.float32]:
+        hop = self.extractor.hop_length
+        n_fft = self.extractor.n_fft
+        if end <= start:
+            return np.empty((self.frames.shape[0], 0), dtype=np.float32)
+
+        frames = np.empty((end - start, n_fft), dtype=np.float64)
+        first = start
+        # frames near the buffer start use the extractor's reflect padding
+        while first < end and first * hop <= self.half_window:
+            frames[first - start] = self._edge_frame(waveform, first * hop)
+            first += 1
+
+        if first < end:
+            lo = first * hop - self.half_window
+            hi = (end - 1) * hop + self.half_window
+            segment = waveform[lo:hi]
+            if len(segment) < hi - lo:
+                segment = np.pad(segment, (0, hi - lo - len(segment)))
+            frames[first - start :] = sliding_window_view(segment, n_fft)[::hop]
+
+        stft = np.fft.rfft(frames * self.window, axis=1).astype(np.complex64)
+        magnitudes = np.abs(stft.T) ** 2
+        mel_spec = self.extractor.mel_filters @ magnitudes
+        return np.log10(np.clip(mel_spec, a_min=1e-10, a_max=None))
+
+    def _edge_frame(self, waveform: NDArray[np.float32], i: int) -> NDArray:
+        end = i + self.half_window
+        frame = waveform[:end]
+        if len(frame) < end:
+            frame = np.pad(frame, (0, end - len(frame)))
+        return np.pad(frame, pad_width=(self.half_window - i, 0), mode="reflect")
@@ -0,0 +1,110 @@
+from config import SAMPLE_RATE, OPUS_SAMPLE_RATE, RESAMPLER_ZERO_CROSSINGS
+from math import gcd
+from numpy.typing import NDArray
+import av
+import numpy as np
+import logging
+
+logger = logging.getLogger(__name__)
+
+FORMATS = ("f32", "s16", "opus")
+
+
+class StreamingResampler:
+    # Polyphase windowed-sinc resampler for a stream of frames. The filter
+    # history is carried across calls, so splitting the input into frames
+    # gives the same output as resampling it in one go.
+    def __init__(
+        self,
+        in_rate: int,
+        out_rate: int = SAMPLE_RATE,
+        zero_crossings: int = RESAMPLER_ZERO_CROSSINGS,
+    ) -> None:
+        divisor = gcd(in_rate, out_rate)
+        self.up = out_rate // divisor
+        self.down = in_rate // divisor
+
+        # low pass at the lower of the two nyquist frequencies
+        cutoff = min(1.0, self.up / self.down)
+        self.half = int(np.ceil(zero_crossings / cutoff))
+        taps = np.arange(-self.half + 1, self.half + 1)
+        phases = np.arange(self.up)[:, None] / self.up
+        x = phases - taps[None, :]
+        window = np.cos(np.pi * x / (2 * self.half)) ** 2
+        self.weights = (cutoff * np.sinc(cutoff * x) * window).astype(np.float32)
+        self.taps = taps
+
+        # input history, starting with silence so the first outputs have a
+        # full filter window
+        self.history = np.zeros(self.half, dtype=np.float32)
+        self.offset = -self.half
+        self.next_output = 0
+
+    @property
+    def passthrough(self) -> bool:
+        return self.up == self.down
+
+    def process(self, data: NDArray[np.float32]) -> NDArray[np.float32]:
+        if self.passthrough:
+            return data
+
+        self.history = np.concatenate([self.history, data])
+        last = self.offset + len(self.history) - 1
+
+        # outputs whose filter window is fully available
+        end = ((last - self.half) * self.up) // self.down + 1
+        if end <= self.next_output:
+            return np.empty(0, dtype=np.float32)
+
+        outputs = np.arange(self.next_output, end)
+        bases = (outputs * self.down) // self.up
+        phases = (outputs * self.down) % self.up
+        windows = self.history[bases[:, None] + self.taps[None, :] - self.offset]
+        resampled = np.einsum("ij,ij->i", windows, self.weights[phases])
+
+        self.next_output = end
+        keep = (end * self.down) // self.up - self.half + 1
+        self.history = self.history[keep - self.offset :]
+        self.offset = keep
+
+        return resampled.astype(np.float32)
+
+    def flush(self) -> NDArray[np.float32]:
+        return self.process(np.zeros(self.half, dtype=np.float32))
+
+
+class AudioDecoder:
+    # Converts incoming websocket frames of the negotiated format into 16 kHz
+    # float32 samples.
+    def __init__(self, format: str = "f32", sample_rate: int = SAMPLE_RATE) -> None:
+        if format not in FORMATS:
+            raise ValueError(f"Unsupported audio format: {format}. Available: {FORMATS}")
+        if sample_rate <= 0:
+            raise ValueError(f"Invalid sample rate: {sample_rate}")
+
+        self.format = format
+        self.codec: av.CodecContext | None = None
+        if format == "opus":
+            # opus always decodes at its own rate, whatever the client recorded
+            sample_rate = OPUS_SAMPLE_RATE
+            self.codec = av.CodecContext.create("opus", "r")
+            self.codec.sample_rate = sample_rate
+            self.codec.layout = "mono"
+
+        self.resampler = StreamingResampler(in_rate=sample_rate)
+
+    def decode(self, data: bytes) -> NDArray[np.float32]:
+        if self.format == "f32":
+            samples = np.frombuffer(data, dtype=np.float32)
+        elif self.format == "s16":
+            samples = np.frombuffer(data, dtype=np.int16).astype(np.float32) / 32768.0
+        else:
+            frames = [
+                frame.to_ndarray()[0]
+                for frame in self.codec.decode(av.packet.Packet(data))
+            ]
+            if len(frames) == 0:
+                return np.empty(0, dtype=np.float32)
+            samples = np.concatenate(frames)
+
+        return self.resampler.process(samples)
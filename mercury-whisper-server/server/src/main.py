@@ -1,22 +1,68 @@
 from fastapi import (
     FastAPI,
+    HTTPException,
+    UploadFile,
     WebSocket,
+    status,
 )
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.websockets import WebSocketState
-from faster_whisper import WhisperModel
-from mercury_asr import MercuryASR
+from mercury_asr import MercuryASR, is_supported_language
+from scheduler import InferenceScheduler, make_policy
+from workerpool import WorkerPool
+from models import ModelManager, ModelSpec
+from capacity import CapacityManager
+from decode_policy import DecodePolicy, DecodeTier
 from audio import AudioStream, stream_audio
+from vad import StreamingVAD
 from transcriber import mercury_transcribe, mercury_transcribe_v2
-from translator import mercury_translator
+from translator import mercury_translator, TranslationPipeline
+from sessions import LiveSession, SessionStore
+from core import Transcription
 from logger_setup import set_up_logger
+from protocol import DeltaEncoder, ENCODINGS, serialize
+from ingest import AudioDecoder
+from metrics import (
+    EXPOSITION_CONTENT_TYPE,
+    REGISTRY,
+    Gauge,
+    SERIALIZATION_SECONDS,
+    active_traces,
+)
+from offline import decode_file, split_on_silence, transcribe_chunks, stitch
+from config import (
+    SAMPLE_RATE,
+    SCHEDULER_POLICY,
+    SCHEDULER_MAX_BATCH_SIZE,
+    SCHEDULER_MAX_WAIT,
+    SCHEDULER_DEFAULT_DEADLINE,
+    STREAMING_VAD,
+    PARTIAL_BEAM_SIZE,
+    PARTIAL_WORD_TIMESTAMPS,
+    PARTIAL_MODEL_SIZE,
+    MODEL_SIZE,
+    MODEL_PATH,
+    FINAL_BEAM_SIZE,
+    FINAL_WORD_TIMESTAMPS,
+    TRANSLATION_MODEL,
+    WORKER_PROCESSES,
+    WORKER_CPU_THREADS,
+    WORKER_OVERLOAD,
+)
 from mercury_json import (
+    MercuryFileChunkJSON,
     MercuryTranscriptionJSON,
     MercuryTranslationJSON,
     MercuryTranslationRequestJSON,
 )
+import av
+from collections.abc import Callable
+from functools import partial
+import dataclasses
+import json
 import logging
 import asyncio
+import time
 from hypercorn.asyncio import serve
 from hypercorn.config import Config
 
@@ -35,16 +81,118 @@ app.add_middleware(
     allow_headers=["*"],  # Allow all headers
 )
 
-model_size = "large-v3"
+decode_policy = DecodePolicy(
+    partial=DecodeTier(
+        name="partial",
+        beam_size=PARTIAL_BEAM_SIZE,
+        word_timestamps=PARTIAL_WORD_TIMESTAMPS,
+    ),
+    final=DecodeTier(
+        name="final",
+        beam_size=FINAL_BEAM_SIZE,
+        word_timestamps=FINAL_WORD_TIMESTAMPS,
+    ),
+)
 
-# Run on GPU with FP16
-model = WhisperModel(model_size, device="cuda", compute_type="float16")
+# Device, compute type and model come from MERCURY_MODEL_* environment
+# variables (see config), e.g. MERCURY_MODEL_DEVICE=cpu and
+# MERCURY_MODEL_COMPUTE_TYPE=int8 to run on CPU. Nothing is loaded here, the
+# models are loaded and warmed up in the background once the server is up.
+model_spec = ModelSpec(model=MODEL_PATH or MODEL_SIZE)
+draft_spec = (
+    dataclasses.replace(model_spec, model=PARTIAL_MODEL_SIZE)
+    if PARTIAL_MODEL_SIZE
+    else None
+)
 
-# or run on GPU with INT8
-# model = WhisperModel(model_size, device="cuda", compute_type="int8_float16")
+if WORKER_PROCESSES > 0:
+    # Models are loaded by the worker processes, which are started with the
+    # server. This module is imported again by every spawned worker, so
+    # nothing here may load a model or start a process in that case.
+    pool = WorkerPool(
+        models={
+            "default": dataclasses.replace(
+                model_spec, cpu_threads=WORKER_CPU_THREADS, num_workers=1
+            ),
+            **(
+                {
+                    "partial": dataclasses.replace(
+                        draft_spec, cpu_threads=WORKER_CPU_THREADS, num_workers=1
+                    )
+                }
+                if draft_spec is not None
+                else {}
+            ),
+        },
+        workers=WORKER_PROCESSES,
+        warmup_options={
+            tier.name: tier.options()
+            for tier in (decode_policy.partial, decode_policy.final)
+        },
+    )
+else:
+    pool = None
 
-# or run on CPU with INT8
-# model = WhisperModel(model_size, device="cpu", compute_type="int8")
+model_manager = ModelManager(
+    model_spec, policy=decode_policy, draft=draft_spec, pool=pool
+)
+
+# audio streams of the live sessions whose transcriber is running, used to
+# report per-session lag. Added when a session starts and discarded when it
+# ends.
+live_streams: set[AudioStream] = set()
+
+# Shared by every session so decodes are queued and batched instead of
+# contending for the model in the default executor
+scheduler = InferenceScheduler(
+    policy=make_policy(SCHEDULER_POLICY),
+    # with worker processes every worker should be able to get a request
+    max_batch_size=max(SCHEDULER_MAX_BATCH_SIZE, WORKER_PROCESSES * WORKER_OVERLOAD),
+    max_wait=SCHEDULER_MAX_WAIT,
+    default_deadline=SCHEDULER_DEFAULT_DEADLINE,
+)
+
+# parked resumable sessions, see sessions.LiveSession
+session_store = SessionStore()
+
+# admission control for live sessions, see capacity.CapacityManager
+capacity = CapacityManager(
+    policy=decode_policy, parallelism=WORKER_PROCESSES if pool is not None else 1
+)
+
+REGISTRY.register(
+    Gauge(
+        "mercury_active_sessions",
+        "Open live transcription sessions.",
+        function=lambda: len(live_streams),
+    )
+)
+REGISTRY.register(
+    Gauge(
+        "mercury_buffered_audio_bytes",
+        "Audio held in live session streams.",
+        function=lambda: sum(stream.data.nbytes for stream in list(live_streams)),
+    )
+)
+REGISTRY.register(
+    Gauge(
+        "mercury_executor_queue_depth",
+        "Decodes waiting in the inference scheduler.",
+        function=lambda: scheduler.queue_depth,
+    )
+)
+
+
+@app.on_event("startup")
+async def start_workers():
+    app.state.model_task = asyncio.create_task(model_manager.load())
+    app.state.capacity_task = asyncio.create_task(capacity.run())
+
+
+@app.on_event("shutdown")
+def stop_workers():
+    if pool is not None:
+        pool.close()
 
 
 @app.get("/")
@@ -52,63 +200,549 @@ def read_root():
     return {"message": "Welcome to mercury-ai.io api."}
 
 
+@app.get("/scheduler")
+def scheduler_stats():
+    return scheduler.stats()
+
+
+@app.get("/health")
+def health():
+    # 503 while the node is loading, degraded or full, so load balancers
+    # route away
+    stats = {**capacity.stats(), "model": model_manager.stats()}
+    return JSONResponse(
+        stats,
+        status_code=(
+            status.HTTP_200_OK
+            if model_manager.ready and stats["remaining"] > 0
+            else status.HTTP_503_SERVICE_UNAVAILABLE
+        ),
+    )
+
+
+@app.get("/ready")
+def ready():
+    # readiness probe, flips to 200 once the model is loaded and warmed up
+    return JSONResponse(
+        model_manager.stats(),
+        status_code=(
+            status.HTTP_200_OK
+            if model_manager.ready
+            else status.HTTP_503_SERVICE_UNAVAILABLE
+        ),
+    )
+
+
+@app.get("/workers")
+def workers():
+    return pool.stats() if pool is not None else []
+
+
+@app.get("/decode-policy")
+def decode_policy_stats():
+    return decode_policy.stats()
+
+
+@app.get("/sessions")
+def sessions():
+    return [
+        {"lag": audio_stream.lag, "pending": audio_stream.pending}
+        for audio_stream in live_streams
+    ]
+
+
+@app.get("/metrics")
+def metrics():
+    return PlainTextResponse(REGISTRY.render(), media_type=EXPOSITION_CONTENT_TYPE)
+
+
+@app.get("/traces")
+def traces():
+    # only populated with TRACING_ENABLED
+    return [trace.to_dict() for trace in list(active_traces)]
+
+
 @app.post("/translation")
-def translate(request: MercuryTranslationRequestJSON):
-    translation_resp = mercury_translator(request=request)
+async def translate(request: MercuryTranslationRequestJSON):
+    translation_resp = await mercury_translator(request=request)
     return MercuryTranslationJSON(**translation_resp)
 
 
-@app.websocket("/v1/live-transcription")
-async def transcribe(websocket: WebSocket):
-    await websocket.accept()
-    logger.info("Websocket connection accepted.")
-    mercury_asr = MercuryASR(model)
-    audio_stream = AudioStream()
+# Offline transcription of an uploaded file. The file is split at silences,
+# the chunks are decoded concurrently through the shared scheduler (behind live
+# sessions) and each chunk is streamed back as newline delimited JSON as soon
+# as it is done. The last line is the whole stitched transcription.
+@app.post("/v1/file-transcription")
+async def transcribe_file(file: UploadFile, language: str | None = None):
+    if not model_manager.ready:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Model is loading",
+        )
+    if language is not None and not is_supported_language(language):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Unsupported language: {language}",
+        )
+    data = await file.read()
+    loop = asyncio.get_running_loop()
+    try:
+        audio = await loop.run_in_executor(None, decode_file, data)
+    except av.error.FFmpegError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Could not decode audio file: {e}",
+        )
+    chunks = await loop.run_in_executor(None, split_on_silence, audio)
+    logger.info(
+        f"Transcribing {file.filename}: {len(audio) / SAMPLE_RATE:.1f} seconds in {len(chunks)} chunks."
+    )
 
-    async with asyncio.TaskGroup() as tg:
-        tg.create_task(stream_audio(websocket=websocket, audio_stream=audio_stream))
-        async for transcript in mercury_transcribe(
-            audio_stream=audio_stream, mercury_asr=mercury_asr
-        ):
-            logger.debug(f"Sending transcription: {transcript.text}")
-            if websocket.client_state == WebSocketState.DISCONNECTED:
-                break
+    mercury_asr = MercuryASR(
+        model_manager.whisper,
+        scheduler=scheduler,
+        policy=decode_policy,
+        feature_cache=False,
+        pool=pool,
+        language=language,
+    )
 
-            await websocket.send_json(
-                MercuryTranscriptionJSON.from_transcription(transcript).model_dump()
-            )
+    async def results():
+        transcriptions = [None] * len(chunks)
+        try:
+            async for index, transcription in transcribe_chunks(
+                audio=audio, chunks=chunks, mercury_asr=mercury_asr
+            ):
+                transcriptions[index] = transcription
+                start, end = chunks[index]
+                yield MercuryFileChunkJSON(
+                    index=index,
+                    chunks=len(chunks),
+                    start=start / SAMPLE_RATE,
+                    end=end / SAMPLE_RATE,
+                    transcription=MercuryTranscriptionJSON.from_transcription(
+                        transcription
+                    ),
+                ).model_dump_json() + "\n"
+        finally:
+            mercury_asr.close()
 
-    if websocket.client_state != WebSocketState.DISCONNECTED:
-        logger.info("Closing the connection.")
-        websocket.close()
+        yield MercuryTranscriptionJSON.from_transcription(
+            stitch(transcriptions)
+        ).model_dump_json() + "\n"
 
+    return StreamingResponse(results(), media_type="application/x-ndjson")
 
-@app.websocket("/v2/live-transcription")
-async def transcribe_v2(websocket: WebSocket):
+
+async def reject(websocket: WebSocket, code: int, reason: str) -> None:
+    # the handshake is completed first, a close before accept() turns into an
+    # HTTP 403 and the client never sees the code or reason
+    logger.info(f"Rejecting connection: {reason}.")
     await websocket.accept()
-    logger.info("Websocket connection accepted.")
-    mercury_asr = MercuryASR(model)
-    audio_stream = AudioStream()
+    await websocket.close(code=code, reason=reason)
+
+
+async def negotiate_decoder(
+    websocket: WebSocket, format: str, sample_rate: int
+) -> AudioDecoder | None:
+    # clients pick the ingest format with the `format` (f32, s16, opus) and
+    # `sample_rate` query parameters, the defaults match the original protocol
+    try:
+        return AudioDecoder(format=format, sample_rate=sample_rate)
+    except ValueError as e:
+        await reject(websocket, status.WS_1003_UNSUPPORTED_DATA, str(e))
+        return None
+
+
+async def negotiate_language(websocket: WebSocket, language: str | None) -> bool:
+    # the optional `language` query parameter pins the session language,
+    # otherwise it is detected (see MercuryASR.detect_language)
+    if language is None or is_supported_language(language):
+        return True
+    await reject(
+        websocket, status.WS_1003_UNSUPPORTED_DATA, f"Unsupported language: {language}"
+    )
+    return False
+
+
+def make_control_handler(
+    mercury_asr: MercuryASR, session: LiveSession | None = None
+) -> Callable[[str], None]:
+    # Text frames carry JSON control messages. {"type": "language",
+    # "language": "de"} pins the language, "language": null detects it again.
+    # {"type": "ack", "seq": n} acknowledges messages of resumable sessions.
+    # {"type": "end"} ends the audio, the connection is closed once the last
+    # transcripts are sent.
+    def on_text(text: str) -> None:
+        try:
+            message = json.loads(text)
+        except ValueError:
+            logger.info("Ignoring malformed control message.")
+            return
+        if not isinstance(message, dict):
+            return
+        if message.get("type") == "language":
+            language = message.get("language")
+            if language is None or is_supported_language(language):
+                mercury_asr.detect_language(language)
+        elif message.get("type") == "ack" and session is not None:
+            if isinstance(message.get("seq"), int):
+                session.acknowledge(message["seq"])
+        elif message.get("type") == "end" and session is not None:
+            session.end_of_audio()
+
+    return on_text
 
+
+async def admit(websocket: WebSocket) -> bool:
+    # sessions are turned away with 1013 (try again later) until the model is
+    # warmed up, and wait up to ADMISSION_TIMEOUT for capacity after that
+    if not model_manager.ready:
+        reason = "Model is loading"
+    elif await capacity.admit():
+        return True
+    else:
+        reason = "Server at capacity"
+    await reject(websocket, status.WS_1013_TRY_AGAIN_LATER, reason)
+    return False
+
+
+def make_encoder(protocol: str, encoding: str = "json"):
+    # A message can be passed as a callable building it, so that is counted
+    # as serialization time. seq numbers messages of resumable sessions.
+    serialization_seconds = SERIALIZATION_SECONDS.labels(protocol=protocol)
+
+    def encode(message: dict | Callable[[], dict], seq: int | None = None):
+        start = time.perf_counter()
+        if callable(message):
+            message = message()
+        if seq is not None:
+            message["seq"] = seq
+        data = serialize(message, encoding=encoding)
+        serialization_seconds.observe(time.perf_counter() - start)
+        return data
+
+    return encode
+
+
+def make_translation_pipeline(
+    languages: str | None, model: str, stream: bool, send
+) -> TranslationPipeline | None:
+    # sessions opt in to server side translation of their finals with the
+    # `languages` query parameter (comma separated language codes)
+    if not languages:
+        return None
+    return TranslationPipeline(
+        model=model,
+        languages=[language for language in languages.split(",") if language],
+        send=send,
+        stream=stream,
+    )
+
+
+@app.websocket("/v1/live-transcription")
+async def transcribe(
+    websocket: WebSocket,
+    format: str = "f32",
+    sample_rate: int = SAMPLE_RATE,
+    language: str | None = None,
+):
+    decoder = await negotiate_decoder(websocket, format, sample_rate)
+    if decoder is None:
+        return
+
+    if not await negotiate_language(websocket, language):
+        return
+
+    if not await admit(websocket):
+        return
+
+    await start_live_session(
+        websocket,
+        protocol="v1",
+        decoder=decoder,
+        language=language,
+        resumable=False,
+        languages=None,
+        translation_model=TRANSLATION_MODEL,
+        stream_translation=False,
+    )
+
+
+async def run_live_session(
+    session: LiveSession,
+    translation: TranslationPipeline | None,
+    message: Callable[[Transcription], dict],
+) -> None:
     async with asyncio.TaskGroup() as tg:
-        tg.create_task(stream_audio(websocket=websocket, audio_stream=audio_stream))
-        async for transcript in mercury_transcribe_v2(
-            audio_stream=audio_stream, mercury_asr=mercury_asr
-        ):
+        if translation is not None:
+            translation.start(tg)
+        if session.protocol == "v1":
+            transcripts = mercury_transcribe(
+                audio_stream=session.audio_stream,
+                mercury_asr=session.mercury_asr,
+                vad=session.vad,
+            )
+        else:
+            transcripts = mercury_transcribe_v2(
+                audio_stream=session.audio_stream,
+                mercury_asr=session.mercury_asr,
+                vad=session.vad,
+                capacity=capacity,
+            )
+        async for transcript in transcripts:
             if not transcript:
                 break
 
-            if websocket.client_state == WebSocketState.DISCONNECTED:
-                break
+            # the message is built when the client is ready for it, by
+            # then the transcriber has moved on
+            snapshot = transcript.snapshot()
+            await session.send(partial(message, snapshot), kind=snapshot.type)
+            if translation is not None and transcript.type == "final":
+                translation.submit(transcript)
+
+        if translation is not None:
+            await translation.close()
+
+
+async def serve_live_session(websocket: WebSocket, session: LiveSession) -> None:
+    # feeds the connection's audio into the session until either ends
+    code = None
+    try:
+        code = await stream_audio(
+            websocket=websocket,
+            audio_stream=session.audio_stream,
+            decoder=session.decoder,
+            on_text=make_control_handler(session.mercury_asr, session),
+        )
+        if session.audio_stream.closed and session.writer is not None:
+            # the audio ended, the writer closes the connection after the
+            # last transcripts
+            await asyncio.wait({session.writer})
+    finally:
+        if session.detach(websocket):
+            if session.finished:
+                session_store.discard(session)
+            elif session.resumable and code != status.WS_1000_NORMAL_CLOSURE:
+                # the connection dropped, the client may come back
+                session_store.park(session)
+            else:
+                # nobody is left to receive the rest
+                session_store.discard(session)
+                session.close()
+
+
+async def resume_live_session(
+    websocket: WebSocket, token: str, ack: int, protocol: str
+) -> None:
+    await websocket.accept()
+    session = session_store.get(token, protocol)
+    if session is None:
+        logger.info("Rejecting connection: unknown session.")
+        await websocket.close(
+            code=status.WS_1008_POLICY_VIOLATION, reason="Unknown session"
+        )
+        return
+
+    if not await session.attach(websocket, ack=ack):
+        # messages after ack are gone, the client has to start over
+        logger.info("Rejecting resume: messages after ack were dropped.")
+        session_store.discard(session)
+        session.close()
+        await websocket.close(
+            code=status.WS_1008_POLICY_VIOLATION, reason="Session cannot be resumed"
+        )
+        return
+    logger.info("Session resumed.")
+    await serve_live_session(websocket, session)
 
-            logger.debug(f"Sending transcription: {transcript.text}")
-            await websocket.send_json(
-                MercuryTranscriptionJSON.from_transcription(transcript).model_dump()
+
+async def open_live_session(
+    websocket: WebSocket,
+    protocol: str,
+    decoder: AudioDecoder,
+    language: str | None,
+    resumable: bool,
+    languages: str | None,
+    translation_model: str,
+    stream_translation: bool,
+    encoding: str = "json",
+) -> LiveSession:
+    # the protocols only differ in the transcriber (v1) and how transcripts
+    # are encoded (v3)
+    await websocket.accept()
+    logger.info(f"Websocket connection accepted. Protocol: {protocol}, encoding: {encoding}")
+    mercury_asr = MercuryASR(
+        model_manager.whisper,
+        scheduler=scheduler,
+        policy=decode_policy,
+        pool=pool,
+        language=language,
+    )
+    session = LiveSession(
+        protocol=protocol,
+        mercury_asr=mercury_asr,
+        decoder=decoder,
+        encode=make_encoder(protocol, encoding),
+        vad=StreamingVAD() if STREAMING_VAD else None,
+        resumable=resumable,
+    )
+    translation = make_translation_pipeline(
+        languages, translation_model, stream_translation, session.send
+    )
+
+    if protocol == "v3":
+        encoder = DeltaEncoder()
+
+        def message(transcript: Transcription) -> dict:
+            return encoder.encode(
+                transcript,
+                language=mercury_asr.language,
+                language_probability=mercury_asr.language_probability,
             )
 
-        if websocket.client_state != WebSocketState.DISCONNECTED:
-            logger.info("Closing the connection.")
-            await websocket.close()
+    else:
+
+        # v1 and v2 messages are unchanged, only v3 reports the language
+        def message(transcript: Transcription) -> dict:
+            return MercuryTranscriptionJSON.from_transcription(transcript).model_dump()
+
+    if resumable:
+        session_store.add(session)
+    await session.attach(websocket)
+    live_streams.add(session.audio_stream)
+    session.start(run_live_session(session, translation, message))
+    return session
+
+
+async def start_live_session(
+    websocket: WebSocket,
+    protocol: str,
+    decoder: AudioDecoder,
+    language: str | None,
+    resumable: bool,
+    languages: str | None,
+    translation_model: str,
+    stream_translation: bool,
+    encoding: str = "json",
+) -> None:
+    # Call once admit() has taken a capacity slot. The slot is held until the
+    # session task ends, a parked session keeps it. It is given back right
+    # away when the session could not be opened.
+    try:
+        session = await open_live_session(
+            websocket,
+            protocol=protocol,
+            decoder=decoder,
+            language=language,
+            resumable=resumable,
+            languages=languages,
+            translation_model=translation_model,
+            stream_translation=stream_translation,
+            encoding=encoding,
+        )
+    except BaseException:
+        capacity.release()
+        raise
+
+    def end(_: asyncio.Task) -> None:
+        # also when the session is cancelled before its transcriber ran
+        live_streams.discard(session.audio_stream)
+        session.mercury_asr.close()
+        capacity.release()
+
+    session.task.add_done_callback(end)
+    await serve_live_session(websocket, session)
+
+
+# Sessions opt in to resuming with `resumable=true` and reconnect with the
+# `session` token and the last acked message `ack`, see sessions.LiveSession.
+@app.websocket("/v2/live-transcription")
+async def transcribe_v2(
+    websocket: WebSocket,
+    format: str = "f32",
+    sample_rate: int = SAMPLE_RATE,
+    language: str | None = None,
+    languages: str | None = None,
+    translation_model: str = TRANSLATION_MODEL,
+    stream_translation: bool = False,
+    resumable: bool = False,
+    session: str | None = None,
+    ack: int = 0,
+):
+    if session is not None:
+        await resume_live_session(websocket, session, ack, protocol="v2")
+        return
+
+    decoder = await negotiate_decoder(websocket, format, sample_rate)
+    if decoder is None:
+        return
+
+    if not await negotiate_language(websocket, language):
+        return
+
+    if not await admit(websocket):
+        return
+
+    await start_live_session(
+        websocket,
+        protocol="v2",
+        decoder=decoder,
+        language=language,
+        resumable=resumable,
+        languages=languages,
+        translation_model=translation_model,
+        stream_translation=stream_translation,
+    )
+
+
+# Opt-in delta protocol, see protocol.DeltaEncoder. The encoding is picked with
+# the `encoding` query parameter (json or msgpack).
+@app.websocket("/v3/live-transcription")
+async def transcribe_v3(
+    websocket: WebSocket,
+    encoding: str = "json",
+    format: str = "f32",
+    sample_rate: int = SAMPLE_RATE,
+    language: str | None = None,
+    languages: str | None = None,
+    translation_model: str = TRANSLATION_MODEL,
+    stream_translation: bool = False,
+    resumable: bool = False,
+    session: str | None = None,
+    ack: int = 0,
+):
+    if session is not None:
+        await resume_live_session(websocket, session, ack, protocol="v3")
+        return
+
+    if encoding not in ENCODINGS:
+        await reject(
+            websocket, status.WS_1003_UNSUPPORTED_DATA, f"Unsupported encoding: {encoding}"
+        )
+        return
+
+    decoder = await negotiate_decoder(websocket, format, sample_rate)
+    if decoder is None:
+        return
+
+    if not await negotiate_language(websocket, language):
+        return
+
+    if not await admit(websocket):
+        return
+
+    await start_live_session(
+        websocket,
+        protocol="v3",
+        decoder=decoder,
+        language=language,
+        resumable=resumable,
+        languages=languages,
+        translation_model=translation_model,
+        stream_translation=stream_translation,
+        encoding=encoding,
+    )
 
 
 if __name__ == "__main__":
@@ -1,44 +1,262 @@
 import asyncio
 from faster_whisper import transcribe
+from faster_whisper.tokenizer import _LANGUAGE_CODES
 from core import Transcription, Segment, Word
 from audio import Audio
+from scheduler import InferenceScheduler
+from workerpool import WorkerPool
+from features import FeatureCache
+from prompts import PromptCache
+from decode_policy import DecodePolicy, DecodeTier
+from metrics import (
+    DECODE_SECONDS,
+    DECODE_AUDIO_SECONDS,
+    TRIMMED_AUDIO_SECONDS,
+    PROMPT_TOKENS,
+    DECODED_TOKENS,
+    LogSampler,
+    SessionTrace,
+)
+from config import (
+    FEATURE_CACHE,
+    SAMPLE_RATE,
+    LANGUAGE_DETECTION_THRESHOLD,
+    LANGUAGE_REDETECT_LOGPROB,
+)
+from functools import partial
+import copy
+import itertools
 import logging
 import time
+import weakref
 
 logger = logging.getLogger(__name__)
 
+_session_ids = itertools.count()
+
+
+def is_supported_language(language: str) -> bool:
+    return language in _LANGUAGE_CODES
+
 
 class MercuryASR:
-    def __init__(self, whisper: transcribe.WhisperModel) -> None:
+    def __init__(
+        self,
+        whisper: transcribe.WhisperModel | None,
+        scheduler: InferenceScheduler | None = None,
+        policy: DecodePolicy | None = None,
+        feature_cache: bool = FEATURE_CACHE,
+        pool: WorkerPool | None = None,
+        language: str | None = None,
+    ) -> None:
         self.whisper = whisper
+        self.scheduler = scheduler
+        self.policy = policy if policy is not None else DecodePolicy.uniform()
+        # the cache assumes one decode at a time over a growing buffer, it is
+        # turned off for callers decoding unrelated audio concurrently
+        self.feature_cache = feature_cache
+        self.feature_caches: dict[int, FeatureCache] = {}
+        self.session_models: dict[int, transcribe.WhisperModel] = {}
+        # prompt token ids by tokenizer, see PromptCache
+        self.prompt_caches: dict[int, PromptCache] = {}
+        self.reused_tokens = 0
+        self.decoded_tokens = 0
+        self.trace = SessionTrace()
+        # with a worker pool the model runs in another process, whisper is
+        # not used and the feature cache lives in the worker
+        self.pool = pool
+        self.session_id = next(_session_ids)
+        # sessions are released with close(), the finalizer only covers
+        # sessions that were never closed
+        self.finalizer = (
+            weakref.finalize(self, pool.release_later, self.session_id)
+            if pool is not None
+            else None
+        )
+        self.log_sampler = LogSampler()
+        # Without a pinned language faster-whisper runs language detection,
+        # an extra encoder pass, on every decode. The language is detected
+        # until a decode is confident about it and then passed to every
+        # following decode, see _update_language.
+        self.detect_language(language)
+
+    def close(self) -> None:
+        # frees the session's state in its model worker
+        if self.finalizer is not None and self.finalizer.detach() is not None:
+            self.pool.release(self.session_id)
+
+    def _session_model(
+        self, whisper: transcribe.WhisperModel
+    ) -> tuple[transcribe.WhisperModel, FeatureCache | None]:
+        if not self.feature_cache:
+            return whisper, None
+
+        key = id(whisper)
+        if key not in self.session_models:
+            # shallow copy so the session gets its own feature extractor while
+            # sharing the underlying model
+            session_model = copy.copy(whisper)
+            self.feature_caches[key] = FeatureCache(whisper.feature_extractor)
+            session_model.feature_extractor = self.feature_caches[key]
+            self.session_models[key] = session_model
+        return self.session_models[key], self.feature_caches[key]
+
+    def _prompt_tokens(
+        self, whisper: transcribe.WhisperModel, prompt: str | None
+    ) -> tuple[str | list[int] | None, tuple[int, int]]:
+        tokenizer = getattr(whisper, "hf_tokenizer", None)
+        if prompt is None or tokenizer is None:
+            return prompt, (0, 0)
+        key = id(tokenizer)
+        if key not in self.prompt_caches:
+            self.prompt_caches[key] = PromptCache(tokenizer)
+        cache = self.prompt_caches[key]
+        return cache.encode(prompt), cache.take_counts()
 
     def _transcribe(
-        self, audio: Audio, prompt: str | None = None
+        self,
+        audio: Audio,
+        prompt: str | None = None,
+        tier: DecodeTier | None = None,
+        speech: list[tuple[float, float]] | None = None,
     ) -> tuple[Transcription, transcribe.TranscriptionInfo]:
+        tier = tier if tier is not None else self.policy.final
+        # with speech regions only those are decoded, and word times are
+        # mapped back to the stream through the speech map. The compacted
+        # audio is not a continuation of the previous decode's, so it skips
+        # the feature cache.
+        speech_map = None
+        feature_cache = self.feature_cache
+        if speech is not None:
+            trimmed = audio.duration
+            audio, speech_map = audio.compact(speech)
+            trimmed -= audio.duration
+            TRIMMED_AUDIO_SECONDS.labels(tier=tier.name).inc(trimmed)
+            feature_cache = False
+
+        options = tier.options()
+        language = self.language if self.language_detected else None
+        if language is not None:
+            options["language"] = language
+
         start = time.perf_counter()
-        segments, transcription_info = self.whisper.transcribe(
-            audio.data,
-            initial_prompt=prompt,
-            word_timestamps=True,
-        )
-        segments = Segment.translate(segments=segments)
+        if self.pool is not None:
+            segments, transcription_info, prompt_counts = self.pool.transcribe(
+                self.session_id,
+                audio.data,
+                origin=int(round(audio.start * SAMPLE_RATE)),
+                prompt=prompt,
+                tier=tier.name,
+                options=options,
+                feature_cache=feature_cache,
+            )
+        else:
+            whisper = tier.whisper if tier.whisper is not None else self.whisper
+            if feature_cache:
+                whisper, cache = self._session_model(whisper)
+                if cache is not None:
+                    cache.set_origin(int(round(audio.start * SAMPLE_RATE)))
+            initial_prompt, prompt_counts = self._prompt_tokens(whisper, prompt)
+            segments, transcription_info = whisper.transcribe(
+                audio.data,
+                initial_prompt=initial_prompt,
+                **options,
+            )
+        segments = list(Segment.translate(segments=segments))
+        self._count_tokens(tier, prompt_counts, segments)
+        self._update_language(language, transcription_info, segments)
         words = Word.flatten_segments(segments=segments)
 
-        for word in words:
-            word.offset(audio.start)
+        if speech_map is None:
+            for word in words:
+                word.offset(audio.start)
+        else:
+            for word in words:
+                word.start = speech_map.original(word.start)
+                word.end = speech_map.original(word.end, end=True)
 
         transcription = Transcription(words=words)
 
         end = time.perf_counter()
-        logger.info(
-            f"Transcribed {audio} in {end - start:.2f} seconds. Prompt: {prompt}. Transcription: {transcription.text}"
-        )
+        tier.stats.record(audio_seconds=audio.duration, decode_seconds=end - start)
+        DECODE_SECONDS.labels(tier=tier.name).observe(end - start)
+        DECODE_AUDIO_SECONDS.labels(tier=tier.name).observe(audio.duration)
+        self.trace.record(f"decode.{tier.name}", start, end - start)
+        if self.log_sampler() and logger.isEnabledFor(logging.INFO):
+            logger.info(
+                f"Transcribed {audio.duration:.2f} seconds ({tier.name}) in {end - start:.2f} seconds. Transcription: {transcription.text}"
+            )
 
         return (transcription, transcription_info)
 
+    def _count_tokens(
+        self, tier: DecodeTier, prompt_counts: tuple[int, int], segments: list[Segment]
+    ) -> None:
+        reused, tokenized = prompt_counts
+        decoded = sum(len(segment.tokens) for segment in segments)
+        self.reused_tokens += reused
+        self.decoded_tokens += decoded
+        PROMPT_TOKENS.labels(source="cache").inc(reused)
+        PROMPT_TOKENS.labels(source="tokenized").inc(tokenized)
+        DECODED_TOKENS.labels(tier=tier.name).inc(decoded)
+
+    def _update_language(
+        self,
+        language: str | None,
+        transcription_info: transcribe.TranscriptionInfo,
+        segments: list[Segment],
+    ) -> None:
+        if language is None:
+            # detected by this decode
+            self.language = transcription_info.language
+            self.language_probability = transcription_info.language_probability
+            # decodes of silence are not trusted with the language
+            if (
+                len(segments) > 0
+                and self.language_probability >= LANGUAGE_DETECTION_THRESHOLD
+            ):
+                self.language_detected = True
+                logger.info(
+                    f"Detected language {self.language} ({self.language_probability:.2f})."
+                )
+            return
+
+        # A decode with a given language reports no probability for it. A low
+        # mean log probability is taken as a sign that the speaker switched
+        # languages, and the next decode detects it again.
+        if self.language_pinned or len(segments) == 0:
+            return
+        logprob = sum(segment.avg_logprob for segment in segments) / len(segments)
+        if logprob < LANGUAGE_REDETECT_LOGPROB:
+            logger.info(
+                f"Mean log probability {logprob:.2f} in {language}, detecting the language again."
+            )
+            self.language_detected = False
+
+    def detect_language(self, language: str | None = None) -> None:
+        # pins the session to language, or detects it again on the next decode
+        self.language = language
+        self.language_probability = 1.0 if language is not None else None
+        self.language_pinned = language is not None
+        self.language_detected = language is not None
+
     async def transcribe(
-        self, audio: Audio, prompt: str | None = None
+        self,
+        audio: Audio,
+        prompt: str | None = None,
+        final: bool = False,
+        background: bool = False,
+        speech: list[tuple[float, float]] | None = None,
     ) -> tuple[Transcription, transcribe.TranscriptionInfo]:
-        return await asyncio.get_running_loop().run_in_executor(
-            None, self._transcribe, audio, prompt
-        )
+        tier = self.policy.tier(final=final)
+        with self.trace.span(f"transcribe.{tier.name}"):
+            if self.scheduler is not None:
+                # background work (file uploads) is scheduled behind live sessions
+                return await self.scheduler.submit(
+                    partial(self._transcribe, audio, prompt, tier, speech),
+                    final=final,
+                    background=background,
+                )
+            return await asyncio.get_running_loop().run_in_executor(
+                None, self._transcribe, audio, prompt, tier, speech
+            )
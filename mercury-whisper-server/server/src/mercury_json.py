@@ -1,10 +1,17 @@
 from pydantic import BaseModel
-from core import Transcription, Word
+from core import Transcription
+
+
+class WordJSON(BaseModel):
+    start: float
+    end: float
+    word: str
+    probability: float
 
 
 class MercuryTranscriptionJSON(BaseModel):
     text: str
-    words: list[Word]
+    words: list[WordJSON]
     duration: float
     type: str
 
@@ -14,10 +21,30 @@ class MercuryTranscriptionJSON(BaseModel):
     ) -> "MercuryTranscriptionJSON":
         return cls(
             text=transcription.text,
-            words=transcription.words,
+            words=[
+                WordJSON.model_construct(
+                    start=word.start,
+                    end=word.end,
+                    word=word.word,
+                    probability=word.probability,
+                )
+                for word in transcription.words
+            ],
             duration=transcription.duration,
             type=transcription.type,
         )
+
+
+class MercuryFileChunkJSON(BaseModel):
+    # one line of the /v1/file-transcription response, chunks arrive in
+    # completion order and `index` gives their position in the file
+    index: int
+    chunks: int
+    start: float
+    end: float
+    transcription: MercuryTranscriptionJSON
+
+
 class MercuryTranslationRequestJSON(BaseModel):
     model: str
     transcription: str
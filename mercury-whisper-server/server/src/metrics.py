@@ -0,0 +1,281 @@
+from config import METRICS_ENABLED, TRACING_ENABLED, LOG_SAMPLE_RATE
+from abc import ABC, abstractmethod
+from collections import deque
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from typing import Any
+import bisect
+import itertools
+import threading
+import time
+import weakref
+
+# Minimal OpenMetrics text format metrics. Observations are a bisect and two
+# additions under a lock, and a no-op when METRICS_ENABLED is off. HELP and
+# TYPE name the metric family, its samples add the suffixes (a counter
+# `x` is exposed as `x_total`).
+
+EXPOSITION_CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+AUDIO_BUCKETS = (0.5, 1.0, 2.0, 5.0, 10.0, 15.0, 20.0, 30.0)
+
+
+def escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(labels: dict[str, str]) -> str:
+    if len(labels) == 0:
+        return ""
+    pairs = ",".join(f'{key}="{escape(str(value))}"' for key, value in labels.items())
+    return "{" + pairs + "}"
+
+
+class Metric(ABC):
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.children: dict[tuple[str, ...], "Metric"] = {}
+        self.lock = threading.Lock()
+
+    def labels(self, **labels: str) -> "Metric":
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        child = self.children.get(key)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(key, self._child())
+        return child
+
+    @abstractmethod
+    def _child(self) -> "Metric": ...
+
+    @abstractmethod
+    def samples(self) -> Iterator[tuple[str, dict[str, str], float]]: ...
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        children = list(self.children.items()) if self.labelnames else [((), self)]
+        for key, child in children:
+            base = dict(zip(self.labelnames, key))
+            for suffix, labels, value in child.samples():
+                lines.append(
+                    f"{self.name}{suffix}{format_labels({**base, **labels})} {value}"
+                )
+        return lines
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = ()) -> None:
+        super().__init__(name, help, labelnames)
+        self.value = 0.0
+
+    def _child(self) -> "Counter":
+        return Counter(self.name, self.help)
+
+    def inc(self, amount: float = 1.0) -> None:
+        if not METRICS_ENABLED:
+            return
+        with self.lock:
+            self.value += amount
+
+    def samples(self) -> Iterator[tuple[str, dict[str, str], float]]:
+        yield "_total", {}, self.value
+
+
+class Gauge(Metric):
+    # either set explicitly or read from `function` at scrape time
+    type = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: tuple[str, ...] = (),
+        function: Callable[[], float] | None = None,
+    ) -> None:
+        super().__init__(name, help, labelnames)
+        self.value = 0.0
+        self.function = function
+
+    def _child(self) -> "Gauge":
+        return Gauge(self.name, self.help)
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def samples(self) -> Iterator[tuple[str, dict[str, str], float]]:
+        yield "", {}, self.function() if self.function is not None else self.value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ) -> None:
+        super().__init__(name, help, labelnames)
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def _child(self) -> "Histogram":
+        return Histogram(self.name, self.help, buckets=self.buckets)
+
+    def observe(self, value: float) -> None:
+        if not METRICS_ENABLED:
+            return
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    @contextmanager
+    def time(self) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def samples(self) -> Iterator[tuple[str, dict[str, str], float]]:
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield "_bucket", {"le": str(bound)}, cumulative
+        cumulative += self.counts[-1]
+        yield "_bucket", {"le": "+Inf"}, cumulative
+        yield "_sum", {}, self.sum
+        yield "_count", {}, cumulative
+
+
+class Registry:
+    def __init__(self) -> None:
+        self.metrics: list[Metric] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = [line for metric in self.metrics for line in metric.render()]
+        return "\n".join([*lines, "# EOF"]) + "\n"
+
+
+REGISTRY = Registry()
+
+DECODE_SECONDS = REGISTRY.register(
+    Histogram("mercury_decode_seconds", "Whisper decode time.", ("tier",))
+)
+DECODE_AUDIO_SECONDS = REGISTRY.register(
+    Histogram(
+        "mercury_decode_audio_seconds",
+        "Seconds of audio per decode.",
+        ("tier",),
+        buckets=AUDIO_BUCKETS,
+    )
+)
+TRIMMED_AUDIO_SECONDS = REGISTRY.register(
+    Counter(
+        "mercury_trimmed_audio_seconds",
+        "Silence cut from decode windows.",
+        ("tier",),
+    )
+)
+PROMPT_TOKENS = REGISTRY.register(
+    Counter(
+        "mercury_prompt_tokens",
+        "Prompt tokens, by whether they were reused from the prompt cache or tokenized.",
+        ("source",),
+    )
+)
+DECODED_TOKENS = REGISTRY.register(
+    Counter("mercury_decoded_tokens", "Tokens generated by the decoder.", ("tier",))
+)
+QUEUE_WAIT_SECONDS = REGISTRY.register(
+    Histogram("mercury_queue_wait_seconds", "Time decodes wait in the scheduler.")
+)
+VAD_SECONDS = REGISTRY.register(
+    Histogram(
+        "mercury_vad_seconds",
+        "Streaming VAD time per step.",
+        buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1),
+    )
+)
+SERIALIZATION_SECONDS = REGISTRY.register(
+    Histogram(
+        "mercury_serialization_seconds",
+        "Time to serialize an outgoing message.",
+        ("protocol",),
+        buckets=(0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01),
+    )
+)
+PARTIAL_LATENCY_SECONDS = REGISTRY.register(
+    Histogram(
+        "mercury_partial_latency_seconds",
+        "Time from the arrival of the newest audio in a partial to sending it.",
+    )
+)
+
+
+class SessionTrace:
+    # Optional per-session spans, kept in a small ring buffer and served by
+    # /traces. span() costs a single attribute check when tracing is off.
+    def __init__(self, history: int = 256) -> None:
+        self.id = next(_trace_ids)
+        self.enabled = TRACING_ENABLED
+        self.started = time.time()
+        self.spans: deque[tuple[str, float, float]] = deque(maxlen=history)
+        if self.enabled:
+            active_traces.add(self)
+
+    @contextmanager
+    def span(self, name: str) -> Iterator[None]:
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, start, time.perf_counter() - start)
+
+    def record(self, name: str, start: float, duration: float) -> None:
+        if self.enabled:
+            self.spans.append((name, start, duration))
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "id": self.id,
+            "started": self.started,
+            "spans": [
+                {"name": name, "start": start, "duration": duration}
+                for name, start, duration in self.spans
+            ],
+        }
+
+
+_trace_ids = itertools.count()
+active_traces: weakref.WeakSet[SessionTrace] = weakref.WeakSet()
+
+
+class LogSampler:
+    # lets one in every 1 / rate calls through, for logs on the hot path
+    def __init__(self, rate: float = LOG_SAMPLE_RATE) -> None:
+        self.every = max(int(round(1 / rate)), 1) if rate > 0 else 0
+        self.calls = 0
+
+    def __call__(self) -> bool:
+        if self.every == 0:
+            return False
+        self.calls += 1
+        return self.calls % self.every == 1 or self.every == 1
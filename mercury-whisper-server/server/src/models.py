@@ -0,0 +1,132 @@
+from faster_whisper import WhisperModel
+from decode_policy import DecodePolicy
+from config import (
+    SAMPLE_RATE,
+    MODEL_DEVICE,
+    MODEL_COMPUTE_TYPE,
+    MODEL_CPU_THREADS,
+    MODEL_NUM_WORKERS,
+    WARMUP_SECONDS,
+)
+from dataclasses import dataclass
+from numpy.typing import NDArray
+from typing import Any
+import asyncio
+import logging
+import time
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class ModelSpec:
+    # model size or path to a local CTranslate2 model directory
+    model: str
+    device: str = MODEL_DEVICE
+    compute_type: str = MODEL_COMPUTE_TYPE
+    cpu_threads: int = MODEL_CPU_THREADS
+    num_workers: int = MODEL_NUM_WORKERS
+
+    def build(self) -> WhisperModel:
+        return WhisperModel(
+            self.model,
+            device=self.device,
+            compute_type=self.compute_type,
+            cpu_threads=self.cpu_threads,
+            num_workers=self.num_workers,
+        )
+
+
+def synthetic_speech(seconds: float) -> NDArray[np.float32]:
+    # a gliding harmonic tone with a syllable rate envelope, close enough to
+    # voice that the decoder and word alignment both run
+    t = np.arange(int(seconds * SAMPLE_RATE)) / SAMPLE_RATE
+    f0 = 120 + 20 * np.sin(2 * np.pi * 0.5 * t)
+    phase = 2 * np.pi * np.cumsum(f0) / SAMPLE_RATE
+    voiced = sum(np.sin(k * phase) / k for k in range(1, 11))
+    envelope = 0.5 * (1 + np.sin(2 * np.pi * 3 * t))
+    return (0.1 * voiced * envelope).astype(np.float32)
+
+
+def warmup(whisper: WhisperModel, options: list[dict[str, Any]]) -> None:
+    # the first decodes pay for kernel selection and allocations
+    audio = synthetic_speech(WARMUP_SECONDS)
+    for option in options:
+        segments, _ = whisper.transcribe(audio, **option)
+        list(segments)
+
+
+class ModelManager:
+    # Loads the models in the background once the server is up and warms
+    # them up with a synthetic decode per tier. Sessions are only admitted
+    # once `ready`. With a worker pool the workers load and warm up their own
+    # models, and readiness follows the pool.
+    def __init__(
+        self,
+        spec: ModelSpec,
+        policy: DecodePolicy,
+        draft: ModelSpec | None = None,
+        pool=None,
+    ) -> None:
+        self.spec = spec
+        self.draft = draft
+        self.policy = policy
+        self.pool = pool
+        self.whisper: WhisperModel | None = None
+        self.state = "pending"
+        self.error: str | None = None
+        self.load_seconds = 0.0
+        self.warmup_seconds = 0.0
+
+    @property
+    def ready(self) -> bool:
+        return self.state == "ready" and (self.pool is None or self.pool.ready)
+
+    async def load(self) -> None:
+        start = time.perf_counter()
+        try:
+            self.state = "loading"
+            if self.pool is not None:
+                self.pool.start()
+                while not self.pool.ready:
+                    if self.pool.error is not None:
+                        raise RuntimeError(self.pool.error)
+                    await asyncio.sleep(0.5)
+                self.load_seconds = time.perf_counter() - start
+            else:
+                self.whisper = await asyncio.to_thread(self.spec.build)
+                if self.draft is not None:
+                    self.policy.partial.whisper = await asyncio.to_thread(
+                        self.draft.build
+                    )
+                self.load_seconds = time.perf_counter() - start
+                logger.info(f"Loaded {self.spec.model} in {self.load_seconds:.1f} seconds.")
+
+                self.state = "warming-up"
+                start = time.perf_counter()
+                await asyncio.to_thread(self._warmup)
+                self.warmup_seconds = time.perf_counter() - start
+                logger.info(f"Warmed up in {self.warmup_seconds:.1f} seconds.")
+            self.state = "ready"
+        except Exception as e:
+            logger.exception("Loading the model failed.")
+            self.state = "failed"
+            self.error = str(e)
+
+    def _warmup(self) -> None:
+        for tier in (self.policy.partial, self.policy.final):
+            whisper = tier.whisper if tier.whisper is not None else self.whisper
+            warmup(whisper, [tier.options()])
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "state": self.state,
+            "ready": self.ready,
+            "model": self.spec.model,
+            "device": self.spec.device,
+            "compute_type": self.spec.compute_type,
+            "load_seconds": self.load_seconds,
+            "warmup_seconds": self.warmup_seconds,
+            "error": self.error,
+        }
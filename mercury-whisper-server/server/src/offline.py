@@ -0,0 +1,74 @@
+from faster_whisper.audio import decode_audio
+from faster_whisper.vad import VadOptions, get_speech_timestamps
+from config import SAMPLE_RATE, OFFLINE_CHUNK_DURATION, OFFLINE_MIN_SILENCE_DURATION_MS
+from audio import Audio
+from core import Transcription
+from mercury_asr import MercuryASR
+from collections.abc import AsyncGenerator
+from numpy.typing import NDArray
+import numpy as np
+import asyncio
+import io
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def decode_file(data: bytes) -> NDArray[np.float32]:
+    return decode_audio(io.BytesIO(data), sampling_rate=SAMPLE_RATE)
+
+
+def split_on_silence(audio: NDArray[np.float32]) -> list[tuple[int, int]]:
+    # Group VAD speech regions into chunks of at most OFFLINE_CHUNK_DURATION,
+    # only cutting inside silences. Each chunk fits a single Whisper window.
+    vad_options = VadOptions(
+        min_silence_duration_ms=OFFLINE_MIN_SILENCE_DURATION_MS,
+        max_speech_duration_s=OFFLINE_CHUNK_DURATION,
+        speech_pad_ms=200,
+    )
+    max_samples = int(OFFLINE_CHUNK_DURATION * SAMPLE_RATE)
+
+    chunks: list[tuple[int, int]] = []
+    for speech in get_speech_timestamps(audio, vad_options):
+        if len(chunks) > 0 and speech["end"] - chunks[-1][0] <= max_samples:
+            chunks[-1] = (chunks[-1][0], speech["end"])
+        else:
+            chunks.append((speech["start"], speech["end"]))
+    return chunks
+
+
+async def transcribe_chunks(
+    audio: NDArray[np.float32],
+    chunks: list[tuple[int, int]],
+    mercury_asr: MercuryASR,
+) -> AsyncGenerator[tuple[int, Transcription], None]:
+    # every chunk is submitted at once, the scheduler batches them, and the
+    # results are yielded in completion order
+    async def run(index: int, start: int, end: int) -> tuple[int, Transcription]:
+        transcription, _ = await mercury_asr.transcribe(
+            audio=Audio(data=audio[start:end], start=start / SAMPLE_RATE),
+            final=True,
+            background=True,
+        )
+        transcription.set_final()
+        return index, transcription
+
+    tasks = [
+        asyncio.ensure_future(run(index, start, end))
+        for index, (start, end) in enumerate(chunks)
+    ]
+    try:
+        for task in asyncio.as_completed(tasks):
+            yield await task
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+def stitch(transcriptions: list[Transcription]) -> Transcription:
+    stitched = Transcription()
+    for transcription in transcriptions:
+        # words spilling over a chunk boundary are only kept once
+        stitched.extend(transcription.after(stitched.end - 0.1).words)
+    stitched.set_final()
+    return stitched
@@ -0,0 +1,46 @@
+from config import PROMPT_CACHE_SIZE
+from collections import OrderedDict
+import re
+
+# whitespace delimited chunks with their leading whitespace
+CHUNK = re.compile(r"\s*\S+")
+
+
+class PromptCache:
+    # Token ids of prompts, cached per whitespace delimited chunk. Whisper's
+    # tokenizer splits text at whitespace before applying BPE, so the tokens
+    # of a prompt are the concatenation of its chunks' tokens. Consecutive
+    # prompts share most of their words, so only the new ones are tokenized.
+    # faster-whisper takes the token ids as initial_prompt as is.
+    def __init__(self, tokenizer, size: int = PROMPT_CACHE_SIZE) -> None:
+        # the model's tokenizers.Tokenizer (WhisperModel.hf_tokenizer)
+        self.tokenizer = tokenizer
+        self.size = size
+        self.chunks: OrderedDict[str, list[int]] = OrderedDict()
+        # prompt tokens taken from the cache and tokenized since the last
+        # call to take_counts
+        self.reused = 0
+        self.tokenized = 0
+
+    def encode(self, prompt: str) -> list[int]:
+        # same text as faster-whisper builds from a string prompt
+        tokens: list[int] = []
+        for chunk in CHUNK.findall(" " + prompt.strip()):
+            ids = self.chunks.get(chunk)
+            if ids is None:
+                ids = self.tokenizer.encode(chunk, add_special_tokens=False).ids
+                self.chunks[chunk] = ids
+                self.tokenized += len(ids)
+                if len(self.chunks) > self.size:
+                    self.chunks.popitem(last=False)
+            else:
+                self.chunks.move_to_end(chunk)
+                self.reused += len(ids)
+            tokens.extend(ids)
+        return tokens
+
+    def take_counts(self) -> tuple[int, int]:
+        counts = (self.reused, self.tokenized)
+        self.reused = 0
+        self.tokenized = 0
+        return counts
@@ -0,0 +1,107 @@
+from core import Transcription, Word
+from typing import Any
+import json
+import msgpack
+
+ENCODINGS = ("json", "msgpack")
+
+
+def compact_word(word: Word) -> list:
+    # times in centiseconds and probability in thousandths, small integers
+    # pack much tighter than floats in both encodings
+    return [
+        round(word.start * 100),
+        round(word.end * 100),
+        word.word,
+        round(word.probability * 1000),
+    ]
+
+
+def common_length(a: list[Word], b: list[Word]) -> int:
+    i = 0
+    while (
+        i < len(a)
+        and i < len(b)
+        and a[i].word == b[i].word
+        and a[i].start == b[i].start
+    ):
+        i += 1
+    return i
+
+
+class DeltaEncoder:
+    # v3 protocol. Every message only carries what changed since the previous
+    # one. The client keeps a committed word list and an unstable tail:
+    #   committed = committed[:base] + commit
+    #   tail = tail[:tail_base] + tail
+    # A final additionally moves committed[:words] out as the finished
+    # utterance and clears the tail. Words are [start, end, word, probability]
+    # (see compact_word). The session language is sent as
+    # "language": [code, probability in thousandths] whenever it changes.
+    def __init__(self) -> None:
+        self.rev = 0
+        self.committed: list[Word] = []
+        self.tail: list[Word] = []
+        self.language: list | None = None
+
+    def encode(
+        self,
+        transcription: Transcription,
+        language: str | None = None,
+        language_probability: float | None = None,
+    ) -> dict[str, Any]:
+        self.rev += 1
+        message = (
+            self._final(transcription.words)
+            if transcription.type == "final"
+            else self._partial(transcription)
+        )
+        if language is not None:
+            compact = [language, round((language_probability or 0.0) * 1000)]
+            if compact != self.language:
+                self.language = compact
+                message["language"] = compact
+        return message
+
+    def _partial(self, transcription: Transcription) -> dict[str, Any]:
+        committed = transcription.words[: transcription.stable]
+        tail = transcription.words[transcription.stable :]
+        base = common_length(self.committed, committed)
+        tail_base = common_length(self.tail, tail)
+        self.committed = committed
+        self.tail = tail
+
+        return {
+            "type": transcription.type,
+            "rev": self.rev,
+            "base": base,
+            "commit": [compact_word(word) for word in committed[base:]],
+            "tail_base": tail_base,
+            "tail": [compact_word(word) for word in tail[tail_base:]],
+        }
+
+    def _final(self, words: list[Word]) -> dict[str, Any]:
+        base = common_length(self.committed, words)
+        if base == len(words):
+            # the final is a prefix of the committed words, nothing is dropped
+            base = len(self.committed)
+            commit = []
+        else:
+            commit = words[base:]
+        self.committed = self.committed[:base] + commit
+        self.committed = self.committed[len(words) :]
+        self.tail = []
+
+        return {
+            "type": "final",
+            "rev": self.rev,
+            "base": base,
+            "commit": [compact_word(word) for word in commit],
+            "words": len(words),
+        }
+
+
+def serialize(message: dict[str, Any], encoding: str) -> bytes | str:
+    if encoding == "msgpack":
+        return msgpack.packb(message, use_bin_type=True)
+    return json.dumps(message, separators=(",", ":"), ensure_ascii=False)
@@ -0,0 +1,227 @@
+import asyncio
+import heapq
+import itertools
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any
+from metrics import QUEUE_WAIT_SECONDS
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class InferenceRequest:
+    fn: Callable[[], Any]
+    final: bool
+    background: bool
+    deadline: float
+    submitted: float
+    seq: int
+    future: asyncio.Future = field(repr=False)
+    started: float = 0.0
+
+    @property
+    def waited(self) -> float:
+        return self.started - self.submitted
+
+
+class SchedulingPolicy(ABC):
+    name = "base"
+
+    @abstractmethod
+    def key(self, request: InferenceRequest) -> tuple: ...
+
+
+class FIFOPolicy(SchedulingPolicy):
+    name = "fifo"
+
+    def key(self, request: InferenceRequest) -> tuple:
+        return (request.seq,)
+
+
+class EarliestDeadlinePolicy(SchedulingPolicy):
+    name = "edf"
+
+    def key(self, request: InferenceRequest) -> tuple:
+        return (request.deadline, request.seq)
+
+
+class FinalsFirstPolicy(SchedulingPolicy):
+    name = "finals-first"
+
+    def key(self, request: InferenceRequest) -> tuple:
+        return (not request.final, request.deadline, request.seq)
+
+
+POLICIES: dict[str, type[SchedulingPolicy]] = {
+    policy.name: policy
+    for policy in (FIFOPolicy, EarliestDeadlinePolicy, FinalsFirstPolicy)
+}
+
+
+def make_policy(name: str) -> SchedulingPolicy:
+    try:
+        return POLICIES[name]()
+    except KeyError:
+        raise ValueError(
+            f"Unknown scheduling policy: {name}. Available: {list(POLICIES)}"
+        )
+
+
+# Process-wide queue in front of the shared WhisperModel. Requests from all
+# sessions run on at most max_batch_size executor threads, and a request is
+# dispatched as soon as a thread is free, so a slow request only holds up its
+# own thread. While fewer requests are queued than threads are free, they
+# gather for at most max_wait seconds so the policy picks among them.
+# Background requests (file uploads) are only dispatched when no live
+# request is queued, the policy orders requests within each class.
+class InferenceScheduler:
+    def __init__(
+        self,
+        policy: SchedulingPolicy,
+        max_batch_size: int,
+        max_wait: float,
+        default_deadline: float,
+        history: int = 1000,
+    ) -> None:
+        self.policy = policy
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.default_deadline = default_deadline
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_batch_size, thread_name_prefix="mercury-inference"
+        )
+
+        self.queue: list[tuple[tuple, InferenceRequest]] = []
+        self.event = asyncio.Event()
+        self.counter = itertools.count()
+        self.wait_times: deque[float] = deque(maxlen=history)
+        # requests running when one is dispatched
+        self.in_flight: deque[int] = deque(maxlen=history)
+        self.running = 0
+        self.executions: set[asyncio.Task] = set()
+        self.task: asyncio.Task | None = None
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self.queue)
+
+    def stats(self) -> dict[str, Any]:
+        waits = sorted(self.wait_times)
+        return {
+            "policy": self.policy.name,
+            "queue_depth": self.queue_depth,
+            "max_batch_size": self.max_batch_size,
+            "max_wait": self.max_wait,
+            "mean_wait": sum(waits) / len(waits) if waits else 0.0,
+            "p95_wait": waits[int(0.95 * (len(waits) - 1))] if waits else 0.0,
+            "mean_in_flight": (
+                sum(self.in_flight) / len(self.in_flight) if self.in_flight else 0.0
+            ),
+        }
+
+    async def submit(
+        self,
+        fn: Callable[[], Any],
+        final: bool = False,
+        deadline: float | None = None,
+        background: bool = False,
+    ) -> Any:
+        self._ensure_running()
+
+        now = time.perf_counter()
+        request = InferenceRequest(
+            fn=fn,
+            final=final,
+            background=background,
+            deadline=now + (self.default_deadline if deadline is None else deadline),
+            submitted=now,
+            seq=next(self.counter),
+            future=asyncio.get_running_loop().create_future(),
+        )
+        key = (request.background, *self.policy.key(request))
+        heapq.heappush(self.queue, (key, request))
+        self.event.set()
+
+        return await request.future
+
+    async def close(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        for execution in list(self.executions):
+            execution.cancel()
+        for _, request in self.queue:
+            request.future.cancel()
+        self.queue.clear()
+        self.executor.shutdown(wait=False)
+
+    def _ensure_running(self) -> None:
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            await self.event.wait()
+            self.event.clear()
+
+            while self.queue and self.running < self.max_batch_size:
+                # let requests gather until they fill the free threads or the
+                # oldest has waited max_wait
+                oldest = min(request.submitted for _, request in self.queue)
+                remaining = oldest + self.max_wait - time.perf_counter()
+                free = self.max_batch_size - self.running
+                if len(self.queue) < free and remaining > 0:
+                    try:
+                        await asyncio.wait_for(self.event.wait(), timeout=remaining)
+                    except TimeoutError:
+                        pass
+                    self.event.clear()
+                    continue
+
+                _, request = heapq.heappop(self.queue)
+                # the session went away while the request was queued
+                if request.future.done():
+                    continue
+                self._dispatch(request)
+
+    def _dispatch(self, request: InferenceRequest) -> None:
+        self.running += 1
+        self.in_flight.append(self.running)
+        execution = asyncio.get_running_loop().create_task(self._execute(request))
+        self.executions.add(execution)
+        execution.add_done_callback(self._finished)
+
+    def _finished(self, execution: asyncio.Task) -> None:
+        # a thread is free for the next request
+        self.executions.discard(execution)
+        self.running -= 1
+        self.event.set()
+
+    async def _execute(self, request: InferenceRequest) -> None:
+        request.started = time.perf_counter()
+        self.wait_times.append(request.waited)
+        QUEUE_WAIT_SECONDS.observe(request.waited)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                f"Dispatching request {request.seq} (final={request.final}) after waiting {request.waited:.3f} seconds. Queue depth: {self.queue_depth}"
+            )
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(
+                self.executor, request.fn
+            )
+        except Exception as e:
+            if not request.future.done():
+                request.future.set_exception(e)
+        else:
+            if not request.future.done():
+                request.future.set_result(result)
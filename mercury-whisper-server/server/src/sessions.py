@@ -0,0 +1,297 @@
+from audio import AudioStream
+from ingest import AudioDecoder
+from mercury_asr import MercuryASR
+from vad import StreamingVAD
+from metrics import PARTIAL_LATENCY_SECONDS
+from config import (
+    RESUME_GRACE,
+    RESUME_MAX_SESSIONS,
+    RESUME_REPLAY_MESSAGES,
+    OUTBOX_MAX_MESSAGES,
+    OUTBOX_MAX_DELAY,
+)
+from collections import OrderedDict, deque
+from collections.abc import Callable, Coroutine
+from fastapi import WebSocket, WebSocketDisconnect, status
+from fastapi.websockets import WebSocketState
+from typing import Any
+import asyncio
+import logging
+import secrets
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class LiveSession:
+    # A live transcription session. The transcriber runs in its own task and
+    # outlives the websocket feeding it: a connection attaches to the session,
+    # sends audio into its stream and receives its messages. When a resumable
+    # session's connection drops, the session is parked in a SessionStore and
+    # keeps decoding the audio it already has, so nothing is lost or decoded
+    # twice when the client comes back.
+    #
+    # Messages go through a bounded outbox drained by a writer task, so a
+    # slow client never stalls the transcriber. Messages are only encoded
+    # when the writer gets to them, and a queued partial is dropped when a
+    # newer one arrives. Finals and translations are never dropped, a client
+    # that lets more than `outbox` of them queue up, or one wait longer than
+    # `max_delay`, is disconnected.
+    #
+    # Resume protocol: a resumable session starts with a
+    #   {"type": "session", "token", "frames", "seq"}
+    # message, and numbers every following message with "seq". Clients ack
+    # messages with {"type": "ack", "seq"} text frames and reconnect with the
+    # `session` token and the last `ack`ed seq. The server answers with a new
+    # session message, where `frames` is the number of audio frames it has
+    # received, so only the frames after it are sent again, and replays the
+    # messages after the ack.
+    def __init__(
+        self,
+        protocol: str,
+        mercury_asr: MercuryASR,
+        decoder: AudioDecoder | None,
+        encode: Callable[[dict | Callable[[], dict], int | None], bytes | str],
+        vad: StreamingVAD | None = None,
+        resumable: bool = False,
+        replay: int = RESUME_REPLAY_MESSAGES,
+        outbox: int = OUTBOX_MAX_MESSAGES,
+        max_delay: float = OUTBOX_MAX_DELAY,
+    ) -> None:
+        self.protocol = protocol
+        self.mercury_asr = mercury_asr
+        self.decoder = decoder
+        self.encode = encode
+        self.vad = vad
+        self.resumable = resumable
+        self.token = secrets.token_urlsafe(16)
+        self.audio_stream = AudioStream()
+
+        self.seq = 0
+        # sent messages not acked yet, only kept for resumable sessions
+        self.replay: deque[tuple[int, bytes | str]] = deque(maxlen=replay)
+        # (kind, message, enqueued) waiting for the writer
+        self.outbox: deque[tuple[str, Any, float]] = deque()
+        self.max_outbox = outbox
+        self.max_delay = max_delay
+        self.wakeup = asyncio.Event()
+        self.websocket: WebSocket | None = None
+        self.writer: asyncio.Task | None = None
+        self.task: asyncio.Task | None = None
+        self.finished = False
+        self.coalesced = 0
+
+    def start(self, run: Coroutine[Any, Any, None]) -> None:
+        self.task = asyncio.create_task(self._run(run))
+        # a session cancelled before it ran never awaited run
+        self.task.add_done_callback(lambda _: run.close())
+
+    async def _run(self, run: Coroutine[Any, Any, None]) -> None:
+        try:
+            await run
+        except Exception:
+            logger.exception("Live session failed.")
+        finally:
+            self.finished = True
+            self.end_of_audio()
+            # the connection is closed once the writer has sent everything
+            if self.writer is not None:
+                self.outbox.append(("end", None, time.monotonic()))
+                self.wakeup.set()
+
+    async def send(self, message: dict | Callable[[], dict], kind: str = "message") -> None:
+        # never waits for the client. kind is the transcript type for
+        # transcripts, only partials are coalesced.
+        if self.writer is None:
+            if self.resumable:
+                self._encode(message)
+            return
+
+        if kind == "partial":
+            queued = len(self.outbox)
+            self.outbox = deque(item for item in self.outbox if item[0] != "partial")
+            self.coalesced += queued - len(self.outbox)
+        now = time.monotonic()
+        self.outbox.append((kind, message, now))
+        self.wakeup.set()
+        if len(self.outbox) > self.max_outbox or now - self.outbox[0][2] > self.max_delay:
+            logger.info(
+                f"Disconnecting slow client, {len(self.outbox)} messages queued for {now - self.outbox[0][2]:.1f} seconds."
+            )
+            websocket = self.websocket
+            self._stop_writer()
+            asyncio.create_task(
+                self._close(websocket, status.WS_1008_POLICY_VIOLATION, "Client too slow")
+            )
+
+    def _encode(self, message: dict | Callable[[], dict]) -> bytes | str:
+        seq = None
+        if self.resumable:
+            self.seq += 1
+            seq = self.seq
+        data = self.encode(message, seq)
+        if seq is not None:
+            self.replay.append((seq, data))
+        return data
+
+    async def _write(self, websocket: WebSocket, initial: list[bytes | str]) -> None:
+        for data in initial:
+            await self._deliver(websocket, data)
+        while True:
+            while len(self.outbox) == 0:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+            kind, message, _ = self.outbox.popleft()
+            if kind == "end":
+                await self._close(websocket)
+                return
+            await self._deliver(websocket, self._encode(message))
+            if kind == "partial":
+                PARTIAL_LATENCY_SECONDS.observe(self.audio_stream.latency)
+
+    async def _deliver(self, websocket: WebSocket, data: bytes | str) -> None:
+        # a dropped connection is noticed by its receive loop, messages sent
+        # in the meantime stay in the replay buffer
+        try:
+            if isinstance(data, bytes):
+                await websocket.send_bytes(data)
+            else:
+                await websocket.send_text(data)
+        except (WebSocketDisconnect, RuntimeError):
+            pass
+
+    async def _close(
+        self,
+        websocket: WebSocket | None,
+        code: int = status.WS_1000_NORMAL_CLOSURE,
+        reason: str | None = None,
+    ) -> None:
+        if websocket is None or websocket.client_state == WebSocketState.DISCONNECTED:
+            return
+        logger.info("Closing the connection.")
+        try:
+            await websocket.close(code=code, reason=reason)
+        except (WebSocketDisconnect, RuntimeError):
+            pass
+
+    def _stop_writer(self) -> None:
+        # queued messages go to the replay buffer of resumable sessions and
+        # are dropped otherwise
+        if self.writer is not None:
+            self.writer.cancel()
+            self.writer = None
+        while len(self.outbox) > 0:
+            kind, message, _ = self.outbox.popleft()
+            if kind != "end" and self.resumable:
+                self._encode(message)
+
+    def acknowledge(self, seq: int) -> None:
+        while len(self.replay) > 0 and self.replay[0][0] <= seq:
+            self.replay.popleft()
+
+    async def attach(self, websocket: WebSocket, ack: int | None = None) -> bool:
+        # ack is None for a new session, False when the messages after ack
+        # have already been dropped from the replay buffer
+        previous = self.websocket
+        self._stop_writer()
+        if ack is not None:
+            self.acknowledge(ack)
+            first = self.replay[0][0] if len(self.replay) > 0 else self.seq + 1
+            if first > ack + 1 or ack > self.seq:
+                return False
+
+        initial = []
+        if self.resumable:
+            initial.append(
+                self.encode(
+                    {
+                        "type": "session",
+                        "token": self.token,
+                        "frames": self.audio_stream.frames,
+                        "seq": self.seq,
+                    },
+                    None,
+                )
+            )
+            initial.extend(data for _, data in self.replay)
+        self.websocket = websocket
+        self.writer = asyncio.create_task(self._write(websocket, initial))
+
+        if previous is not None and previous is not websocket:
+            # the client reconnected before the old connection was noticed
+            # to be gone
+            await self._close(previous)
+        return True
+
+    def detach(self, websocket: WebSocket) -> bool:
+        # False when another connection has taken the session over
+        if self.websocket is not websocket:
+            return False
+        self._stop_writer()
+        self.websocket = None
+        return True
+
+    def end_of_audio(self) -> None:
+        # the transcriber finishes the buffered audio and ends the session
+        if not self.audio_stream.closed:
+            self.audio_stream.close()
+
+    def close(self) -> None:
+        self._stop_writer()
+        if self.task is not None:
+            self.task.cancel()
+
+
+class SessionStore:
+    # Resumable sessions by token. Sessions without a connection are parked
+    # for `grace` seconds, and at most `max_parked` of them are kept, the
+    # oldest are closed first.
+    def __init__(
+        self, grace: float = RESUME_GRACE, max_parked: int = RESUME_MAX_SESSIONS
+    ) -> None:
+        self.grace = grace
+        self.max_parked = max_parked
+        self.sessions: dict[str, LiveSession] = {}
+        self.parked: OrderedDict[str, asyncio.TimerHandle] = OrderedDict()
+
+    def add(self, session: LiveSession) -> None:
+        self.sessions[session.token] = session
+
+    def get(self, token: str, protocol: str) -> LiveSession | None:
+        # the session is only taken off the parked ones when it can be
+        # resumed, a rejected resume leaves it to expire
+        session = self.sessions.get(token)
+        if session is None or session.finished or session.protocol != protocol:
+            return None
+        expiry = self.parked.pop(token, None)
+        if expiry is not None:
+            expiry.cancel()
+        return session
+
+    def park(self, session: LiveSession) -> None:
+        if session.token not in self.sessions:
+            return
+        logger.info(f"Parking session for {self.grace:.0f} seconds.")
+        self.parked[session.token] = asyncio.get_running_loop().call_later(
+            self.grace, self.expire, session.token
+        )
+        while len(self.parked) > self.max_parked:
+            token, expiry = self.parked.popitem(last=False)
+            expiry.cancel()
+            self.expire(token)
+
+    def expire(self, token: str) -> None:
+        self.parked.pop(token, None)
+        session = self.sessions.pop(token, None)
+        if session is not None:
+            logger.info("Closing parked session.")
+            session.close()
+
+    def discard(self, session: LiveSession) -> None:
+        expiry = self.parked.pop(session.token, None)
+        if expiry is not None:
+            expiry.cancel()
+        self.sessions.pop(session.token, None)
+
+    def stats(self) -> dict[str, Any]:
+        return {"sessions": len(self.sessions), "parked": len(self.parked)}
@@ -1,8 +1,19 @@
 from audio import Audio, AudioStream
 from mercury_asr import MercuryASR
-from core import Transcription, Word, common_prefix, to_full_sentences, word_to_text
-from config import CHUNK_DURATION, MAX_SENTENCES, SAMPLE_RATE, MAX_SILENCE
-from vad import is_speaking
+from core import Transcription, Word, common_prefix_length, word_to_text
+from config import (
+    CHUNK_DURATION,
+    MAX_SENTENCES,
+    SAMPLE_RATE,
+    MAX_SILENCE,
+    INCREMENTAL_DECODE,
+    MAX_DECODE_WINDOW,
+    INCREMENTAL_PROMPT_WORDS,
+    SPEECH_ONLY_DECODE,
+    SPEECH_WINDOW_MIN_CUT,
+)
+from vad import StreamingVAD, speech_chunks
+from capacity import CapacityManager
 from collections.abc import AsyncGenerator
 import logging
 
@@ -15,57 +26,124 @@ class LocalAgreement:
 
     def merge(self, confirmed: Transcription, incoming: Transcription) -> list[Word]:
         incoming = incoming.after(confirmed.end - 0.1)
-        prefix = common_prefix(incoming.words, self.unconfirmed.words)
-        logger.debug(f"Confirmed: {confirmed.text}")
-        logger.debug(f"Unconfirmed: {self.unconfirmed.text}")
-        logger.debug(f"Incoming: {incoming.text}")
+        # only the tail after the confirmed words is compared, using the
+        # canonical forms cached on both transcriptions
+        i = common_prefix_length(incoming.canonical, self.unconfirmed.canonical)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Confirmed: {confirmed.text}")
+            logger.debug(f"Unconfirmed: {self.unconfirmed.text}")
+            logger.debug(f"Incoming: {incoming.text}")
 
-        if len(incoming.words) > len(prefix):
-            self.unconfirmed = Transcription(incoming.words[len(prefix) :])
-        else:
-            self.unconfirmed = Transcription()
+        self.unconfirmed = incoming.tail(i)
 
-        return prefix
+        return incoming.words[:i]
 
 
 def last_fs(confirmed: Transcription) -> float:
-    full_sentences = to_full_sentences(confirmed.words)
-    return full_sentences[-1][-1].end if len(full_sentences) > 0 else 0.0
+    return confirmed.last_sentence_end
 
 
 def last_confirmed_fs(confirmed: Transcription) -> float:
-    full_sentences = to_full_sentences(confirmed.words)
-    return full_sentences[-2][-1].end if len(full_sentences) > 1 else 0.0
+    return confirmed.previous_sentence_end
 
 
 def number_of_fs(confirmed: Transcription) -> int:
-    full_sentences = full_sentences = to_full_sentences(confirmed.words)
-    return len(full_sentences)
+    return confirmed.number_of_sentences
 
 
 def prompt(confirmed: Transcription) -> str | None:
-    sentences = to_full_sentences(confirmed.words)
-    return word_to_text(sentences[-1]) if len(sentences) > 0 else None
+    return confirmed.last_sentence
+
+
+def is_stale(audio_stream: AudioStream) -> bool:
+    # another full chunk arrived while decoding, a newer partial is due
+    # right away so this one is not worth sending
+    if audio_stream.pending >= CHUNK_DURATION:
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                f"Skipping stale partial. Pending: {audio_stream.pending:.2f} seconds, lag: {audio_stream.lag:.2f} seconds"
+            )
+        return True
+    return False
+
+
+def chunk_duration(capacity: CapacityManager | None):
+    if capacity is None:
+        return CHUNK_DURATION
+    return lambda: capacity.chunk_duration
+
+
+def skip_partial(capacity: CapacityManager | None, steps: int) -> bool:
+    # under load only every partial_stride-th chunk is decoded, or none
+    if capacity is None:
+        return False
+    stride = capacity.partial_stride
+    return stride == 0 or steps % stride != 0
+
+
+def stream_origin(vad: StreamingVAD | None, buffer: Audio) -> float:
+    # Stream time of time 0 of the transcriber's buffer, which restarts at 0
+    # with every utterance and skips the silence between them. Call right
+    # after adding a chunk, the VAD has then seen exactly up to its end.
+    return vad.end - buffer.end if vad is not None else 0.0
+
+
+def speech_window(
+    vad: StreamingVAD | None, audio: Audio, origin: float = 0.0
+) -> list[tuple[float, float]] | None:
+    # speech regions of a decode window, None to decode all of it. The VAD
+    # works in stream time, the window is shifted by origin, see
+    # stream_origin.
+    if vad is None or not SPEECH_ONLY_DECODE:
+        return None
+    regions = vad.speech_regions(audio.start + origin, audio.end + origin)
+    speech = sum(end - start for start, end in regions)
+    if len(regions) == 0 or audio.duration - speech < SPEECH_WINDOW_MIN_CUT:
+        return None
+    return [(start - origin, end - origin) for start, end in regions]
+
+
+def committed_prompt(committed: Transcription) -> str | None:
+    words = committed.words[-INCREMENTAL_PROMPT_WORDS:]
+    return word_to_text(words) if len(words) > 0 else None
 
 
 async def mercury_transcribe(
-    audio_stream: AudioStream, mercury_asr: MercuryASR
+    audio_stream: AudioStream,
+    mercury_asr: MercuryASR,
+    vad: StreamingVAD | None = None,
 ) -> AsyncGenerator[Transcription, None]:
     buffer = Audio()
     confirmed = Transcription()
     local_agreement = LocalAgreement()
     spoken = False
 
-    async for chunk in audio_stream.chunks(min_duration=CHUNK_DURATION):
-        speaking = is_speaking(chunk)
+    async for chunk, speaking in speech_chunks(
+        audio_stream=audio_stream, min_duration=CHUNK_DURATION, vad=vad
+    ):
         if not speaking:
             logger.debug("No speech detected.")
             if spoken:
                 spoken = False
+                # the chunk ending the utterance can hold its last words
+                buffer.extend(chunk)
+                origin = stream_origin(vad, buffer)
+                if mercury_asr.policy.tiered or len(chunk) > 0:
+                    # the unconfirmed tail came from a cheap partial decode,
+                    # or never was decoded, rerun it before emitting
+                    transcription, _ = await mercury_asr.transcribe(
+                        audio=buffer,
+                        prompt=prompt(confirmed=confirmed),
+                        final=True,
+                        speech=speech_window(vad, buffer, origin),
+                    )
+                    confirmed.extend(transcription.after(confirmed.end - 0.1).words)
+                else:
+                    confirmed.extend(local_agreement.unconfirmed.words)
                 buffer.reset()
-                confirmed.extend(local_agreement.unconfirmed.words)
                 confirmed.set_final()
-                logger.debug(f"Finalized transcription: {confirmed.text}")
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug(f"Finalized transcription: {confirmed.text}")
                 logger.debug("Reseting buffer...")
                 yield confirmed
                 confirmed.reset()
@@ -73,38 +151,56 @@ async def mercury_transcribe(
         spoken = True
 
         buffer.extend(chunk)
-
-        audio = buffer.after(last_fs(confirmed=confirmed))
+        origin = stream_origin(vad, buffer)
+        buffer.release(last_fs(confirmed=confirmed))
 
         transcription, _ = await mercury_asr.transcribe(
-            audio=audio, prompt=prompt(confirmed=confirmed)
+            audio=buffer,
+            prompt=prompt(confirmed=confirmed),
+            speech=speech_window(vad, buffer, origin),
         )
 
-        print(transcription.words)
-
         new_words = local_agreement.merge(confirmed=confirmed, incoming=transcription)
 
         if len(new_words) > 0:
             confirmed.extend(new_words)
+            confirmed.stable = len(confirmed.words)
             confirmed.set_partial()
-            yield confirmed
+            if not is_stale(audio_stream):
+                yield confirmed
 
     confirmed.extend(local_agreement.unconfirmed.words)
     yield confirmed
 
 
 async def mercury_transcribe_v2(
-    audio_stream: AudioStream, mercury_asr: MercuryASR
+    audio_stream: AudioStream,
+    mercury_asr: MercuryASR,
+    vad: StreamingVAD | None = None,
+    incremental: bool = INCREMENTAL_DECODE,
+    capacity: CapacityManager | None = None,
 ) -> AsyncGenerator[Transcription, None]:
+    if incremental:
+        async for transcript in mercury_transcribe_v2_incremental(
+            audio_stream=audio_stream,
+            mercury_asr=mercury_asr,
+            vad=vad,
+            capacity=capacity,
+        ):
+            yield transcript
+        return
+
     buffer = Audio()
     confirmed = Transcription()
     spoken = False
     silence_dur = 0
+    steps = 0
 
-    async for chunk in audio_stream.chunks(min_duration=CHUNK_DURATION):
-        speaking = is_speaking(chunk)
+    async for chunk, speaking in speech_chunks(
+        audio_stream=audio_stream, min_duration=chunk_duration(capacity), vad=vad
+    ):
         if not speaking:
-            logger.info("No speech detected.")
+            logger.debug("No speech detected.")
             silence_dur += len(chunk) / SAMPLE_RATE
             if silence_dur >= MAX_SILENCE:
                 logger.info(
@@ -113,12 +209,18 @@ async def mercury_transcribe_v2(
                 yield None
             if spoken:
                 buffer.extend(chunk)
-                transcription, _ = await mercury_asr.transcribe(audio=buffer)
+                origin = stream_origin(vad, buffer)
+                transcription, _ = await mercury_asr.transcribe(
+                    audio=buffer,
+                    final=True,
+                    speech=speech_window(vad, buffer, origin),
+                )
                 spoken = False
 
-                logger.debug(
-                    f"Merging transcription: {confirmed.text} <-> {transcription.text}"
-                )
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug(
+                        f"Merging transcription: {confirmed.text} <-> {transcription.text}"
+                    )
                 confirmed.merge(transcription.words)
 
                 confirmed.set_final()
@@ -132,33 +234,187 @@ async def mercury_transcribe_v2(
         silence_dur = 0
 
         buffer.extend(chunk)
+        origin = stream_origin(vad, buffer)
+        steps += 1
+        if skip_partial(capacity, steps):
+            continue
 
-        transcription, _ = await mercury_asr.transcribe(audio=buffer)
+        transcription, _ = await mercury_asr.transcribe(
+            audio=buffer, speech=speech_window(vad, buffer, origin)
+        )
 
         full_sentences = number_of_fs(confirmed=transcription)
         seconds = last_confirmed_fs(confirmed=transcription)
 
         if len(confirmed.words):
-            logger.debug(
-                f"Merging transcription: {confirmed.text} <-> {transcription.text}"
-            )
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(
+                    f"Merging transcription: {confirmed.text} <-> {transcription.text}"
+                )
             confirmed.merge(transcription.words)
         else:
-            logger.debug(
-                f"Replacing transcription: {confirmed.text} -> {transcription.text}"
-            )
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(
+                    f"Replacing transcription: {confirmed.text} -> {transcription.text}"
+                )
             confirmed.replace(transcription.words)
 
         if full_sentences > MAX_SENTENCES:
             logger.info("Reached max sentences.")
             confirmed_max_sentence = confirmed.before(seconds=seconds)
+            if mercury_asr.policy.tiered:
+                window = Audio(
+                    data=buffer.data[: int((seconds - buffer.start) * SAMPLE_RATE)],
+                    start=buffer.start,
+                )
+                finalized, _ = await mercury_asr.transcribe(
+                    audio=window,
+                    final=True,
+                    speech=speech_window(vad, window, origin),
+                )
+                if len(finalized.words) > 0:
+                    confirmed_max_sentence = finalized
             confirmed_max_sentence.set_final()
             logger.info(f"Finalized transcription: {confirmed_max_sentence.text}")
             yield confirmed_max_sentence
-            buffer = buffer.after(ts=seconds)
+            buffer.release(ts=seconds)
             confirmed = confirmed.after(seconds=seconds)
             continue
 
         confirmed.set_partial()
-        logger.debug(f"Partial transcription: {confirmed.text}")
+        if is_stale(audio_stream):
+            continue
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Partial transcription: {confirmed.text}")
         yield confirmed
+
+
+async def mercury_transcribe_v2_incremental(
+    audio_stream: AudioStream,
+    mercury_asr: MercuryASR,
+    vad: StreamingVAD | None = None,
+    capacity: CapacityManager | None = None,
+) -> AsyncGenerator[Transcription, None]:
+    # Words are committed once two consecutive decodes agree on them. Whisper
+    # only sees the audio after the last committed word, with the committed
+    # text as its prompt, so each step costs about the same however long the
+    # utterance runs.
+    buffer = Audio()
+    # with a tiered policy the audio of the unfinalized sentences is kept so
+    # they can be decoded again by the final tier, buffer only holds the
+    # audio after the last committed word
+    sentences = Audio() if mercury_asr.policy.tiered else None
+    committed = Transcription()
+    local_agreement = LocalAgreement()
+    spoken = False
+    silence_dur = 0
+    steps = 0
+
+    async for chunk, speaking in speech_chunks(
+        audio_stream=audio_stream, min_duration=chunk_duration(capacity), vad=vad
+    ):
+        if not speaking:
+            logger.debug("No speech detected.")
+            silence_dur += len(chunk) / SAMPLE_RATE
+            if silence_dur >= MAX_SILENCE:
+                logger.info(
+                    "Reached max silence duration. Ending websocket connection..."
+                )
+                yield None
+            if spoken:
+                buffer.extend(chunk)
+                origin = stream_origin(vad, buffer)
+                spoken = False
+                if sentences is not None:
+                    # the committed words came from partial decodes, the
+                    # whole unfinalized audio is decoded by the final tier
+                    sentences.extend(chunk)
+                    transcription, _ = await mercury_asr.transcribe(
+                        audio=sentences,
+                        final=True,
+                        speech=speech_window(vad, sentences, origin),
+                    )
+                    if len(transcription.words) > 0:
+                        committed.replace(transcription.words)
+                else:
+                    transcription, _ = await mercury_asr.transcribe(
+                        audio=buffer,
+                        prompt=committed_prompt(committed),
+                        final=True,
+                        speech=speech_window(vad, buffer, origin),
+                    )
+                    committed.extend(transcription.after(committed.end - 0.1).words)
+                committed.set_final()
+                logger.info(f"Finalized transcription: {committed.text}")
+                yield committed
+                logger.debug("Reseting buffer...")
+                buffer.reset()
+                committed.reset()
+                if sentences is not None:
+                    sentences.reset()
+                local_agreement = LocalAgreement()
+            continue
+        spoken = True
+        silence_dur = 0
+
+        buffer.extend(chunk)
+        origin = stream_origin(vad, buffer)
+        buffer.release(ts=committed.end)
+        if sentences is not None:
+            sentences.extend(chunk)
+        steps += 1
+        # the decode window cap below still applies when partials are skipped
+        if skip_partial(capacity, steps) and buffer.duration <= MAX_DECODE_WINDOW:
+            continue
+
+        # hard cap on the decode window, words about to fall out of it are
+        # committed even if they were never confirmed
+        if buffer.duration > MAX_DECODE_WINDOW:
+            cutoff = buffer.end - MAX_DECODE_WINDOW
+            unconfirmed = local_agreement.unconfirmed
+            forced = unconfirmed.before(seconds=cutoff).words
+            if len(forced) > 0:
+                logger.info(f"Force committing {len(forced)} words.")
+                committed.extend(forced)
+                local_agreement.unconfirmed = unconfirmed.tail(len(forced))
+            buffer.release(ts=cutoff)
+
+        transcription, _ = await mercury_asr.transcribe(
+            audio=buffer,
+            prompt=committed_prompt(committed),
+            speech=speech_window(vad, buffer, origin),
+        )
+        committed.extend(local_agreement.merge(committed, transcription))
+
+        if number_of_fs(confirmed=committed) > MAX_SENTENCES:
+            logger.info("Reached max sentences.")
+            seconds = last_confirmed_fs(confirmed=committed)
+            committed_max_sentence = committed.before(seconds=seconds)
+            if sentences is not None:
+                window = Audio(
+                    data=sentences.data[
+                        : int((seconds - sentences.start) * SAMPLE_RATE)
+                    ],
+                    start=sentences.start,
+                )
+                finalized, _ = await mercury_asr.transcribe(
+                    audio=window,
+                    final=True,
+                    speech=speech_window(vad, window, origin),
+                )
+                if len(finalized.words) > 0:
+                    committed_max_sentence = finalized
+                sentences.release(ts=seconds)
+            committed_max_sentence.set_final()
+            logger.info(f"Finalized transcription: {committed_max_sentence.text}")
+            yield committed_max_sentence
+            committed = committed.after(seconds=seconds)
+
+        if is_stale(audio_stream) or skip_partial(capacity, steps):
+            continue
+        hypothesis = Transcription(committed.words + local_agreement.unconfirmed.words)
+        hypothesis.stable = len(committed.words)
+        hypothesis.set_partial()
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Partial transcription: {hypothesis.text}")
+        yield hypothesis
@@ -1,16 +1,34 @@
 from mercury_json import MercuryTranslationRequestJSON
+from config import (
+    SECRET_TTL,
+    TRANSLATION_CACHE_SIZE,
+    TRANSLATION_CACHE_TTL,
+    TRANSLATION_BATCH_WINDOW,
+)
+from core import Transcription
 import boto3
 from botocore.exceptions import ClientError
-from openai import OpenAI
+from openai import AsyncOpenAI
+from collections import OrderedDict
+from collections.abc import AsyncGenerator, Awaitable, Callable
+from typing import Any
+import asyncio
 import logging
 import json
+import time
 
 logger = logging.getLogger(__name__)
 
+_aws_clients: dict[str, Any] = {}
+
 
 # AWS Secrets Manager client
 def get_secret(secret_name: str, region_name: str = "us-west-1"):
-    aws_client = boto3.client("secretsmanager", region_name=region_name)
+    # boto3 clients are thread safe, one per region is kept for the process
+    aws_client = _aws_clients.get(region_name)
+    if aws_client is None:
+        aws_client = boto3.client("secretsmanager", region_name=region_name)
+        _aws_clients[region_name] = aws_client
     try:
         response = aws_client.get_secret_value(
             SecretId=secret_name, VersionStage="AWSCURRENT"
@@ -21,55 +39,292 @@ def get_secret(secret_name: str, region_name: str = "us-west-1"):
         logger.error(f"Access secret failed: {e}")
 
 
-def mercury_translator(request: MercuryTranslationRequestJSON):
-    # Retrieve OpenAI API key from Secrets Manager
-    secret_name = "openai_api_token"
-    secret = get_secret(secret_name)
-    api_key = eval(secret).get("openai_api_token")
+class TTLCache:
+    # LRU cache whose entries also expire after ttl seconds
+    def __init__(self, max_size: int, ttl: float) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries: OrderedDict[Any, tuple[float, Any]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Any) -> Any | None:
+        entry = self.entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key: Any, value: Any) -> None:
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def stats(self) -> dict[str, Any]:
+        return {"size": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+
+class SecretCache:
+    # Secrets are fetched once and refreshed after ttl seconds. A failed
+    # refresh keeps serving the previous value.
+    def __init__(self, ttl: float = SECRET_TTL) -> None:
+        self.cache = TTLCache(max_size=16, ttl=ttl)
+        self.stale: dict[str, str] = {}
+        self.lock = asyncio.Lock()
+
+    async def get(self, secret_name: str) -> str | None:
+        secret = self.cache.get(secret_name)
+        if secret is not None:
+            return secret
+
+        async with self.lock:
+            secret = self.cache.get(secret_name)
+            if secret is not None:
+                return secret
+            secret = await asyncio.to_thread(get_secret, secret_name)
+            if secret is None:
+                return self.stale.get(secret_name)
+            self.cache.put(secret_name, secret)
+            self.stale[secret_name] = secret
+            return secret
+
+
+secret_cache = SecretCache()
+translation_cache = TTLCache(
+    max_size=TRANSLATION_CACHE_SIZE, ttl=TRANSLATION_CACHE_TTL
+)
+# translations currently waiting on OpenAI, identical requests share them
+_in_flight: dict[tuple, asyncio.Future] = {}
+_openai_client: AsyncOpenAI | None = None
+_openai_api_key: str | None = None
+
+
+async def get_openai_client() -> AsyncOpenAI:
+    # One client, and so one pooled HTTP connection, for the whole process.
+    # It is only rebuilt when the key is rotated.
+    global _openai_client, _openai_api_key
+
+    secret = await secret_cache.get("openai_api_token")
+    api_key = json.loads(secret).get("openai_api_token")
+    if _openai_client is None or api_key != _openai_api_key:
+        _openai_client = AsyncOpenAI(api_key=api_key)
+        _openai_api_key = api_key
+    return _openai_client
+
+
+def translation_key(
+    model: str, transcription: str, languages: list[str]
+) -> tuple[str, str, tuple[str, ...]]:
+    # whitespace differences between otherwise identical finals do not
+    # change the translation
+    return (model, " ".join(transcription.split()), tuple(sorted(set(languages))))
+
+
+def translation_messages(
+    transcription: str, languages: list[str]
+) -> list[dict[str, str]]:
+    return [
+        {
+            "role": "system",
+            "content": (
+                "You are a translator that will translate incoming transcriptions to the requested languages. "
+                "You will ONLY respond with JSON. "
+                "Make any corrections necessary to improve the translation. "
+                'JSON format: {"translations":{"en":"Hello world!","ko":"안녕 세상!"}}'
+            ),
+        },
+        {
+            "role": "user",
+            "content": ('{"transcription":"Hello World!","languages":["ko","es"]}'),
+        },
+        {
+            "role": "assistant",
+            "content": ('{"translations":{"ko":"안녕 세상!","es":"¡Hola Mundo!"}}'),
+        },
+        {
+            "role": "user",
+            "content": ('{"transcription":"Hello 세상!","languages":["en","ko"]}'),
+        },
+        {
+            "role": "assistant",
+            "content": ('{"translations":{"en":"Hello World!","ko":"안녕 세상!"}}'),
+        },
+        {
+            "role": "user",
+            "content": json.dumps(
+                {
+                    "transcription": transcription,
+                    "languages": languages,
+                }
+            ),
+        },
+    ]
+
+
+async def translate(model: str, transcription: str, languages: list[str]) -> str:
+    key = translation_key(model, transcription, languages)
+    completion = translation_cache.get(key)
+    if completion is not None:
+        return completion
 
-    openai_client = OpenAI(
-        api_key=api_key,
+    in_flight = _in_flight.get(key)
+    if in_flight is not None:
+        return await asyncio.shield(in_flight)
+
+    future = asyncio.get_running_loop().create_future()
+    _in_flight[key] = future
+    try:
+        openai_client = await get_openai_client()
+
+        # Generate translation with OpenAI
+        response = await openai_client.chat.completions.create(
+            model=model,
+            messages=translation_messages(transcription, languages),
+        )
+        completion = response.choices[0].message.content
+    except Exception as e:
+        future.set_exception(e)
+        # only surfaced to requests that joined this one
+        future.exception()
+        raise
+    else:
+        translation_cache.put(key, completion)
+        future.set_result(completion)
+    finally:
+        del _in_flight[key]
+        if not future.done():
+            future.cancel()
+
+    return completion
+
+
+async def translate_stream(
+    model: str, transcription: str, languages: list[str]
+) -> AsyncGenerator[str, None]:
+    # yields the completion as it is generated, cached results come out in
+    # one piece
+    key = translation_key(model, transcription, languages)
+    completion = translation_cache.get(key)
+    if completion is not None:
+        yield completion
+        return
+
+    openai_client = await get_openai_client()
+    stream = await openai_client.chat.completions.create(
+        model=model,
+        messages=translation_messages(transcription, languages),
+        stream=True,
     )
+    parts: list[str] = []
+    async for chunk in stream:
+        if len(chunk.choices) == 0 or not chunk.choices[0].delta.content:
+            continue
+        parts.append(chunk.choices[0].delta.content)
+        yield parts[-1]
+
+    translation_cache.put(key, "".join(parts))
+
 
-    # Generate translation with OpenAI
-    completion = openai_client.chat.completions.create(
+async def mercury_translator(request: MercuryTranslationRequestJSON):
+    completion = await translate(
         model=request.model,
-        messages=[
-            {
-                "role": "system",
-                "content": (
-                    "You are a translator that will translate incoming transcriptions to the requested languages. "
-                    "You will ONLY respond with JSON. "
-                    "Make any corrections necessary to improve the translation. "
-                    'JSON format: {"translations":{"en":"Hello world!","ko":"안녕 세상!"}}'
-                ),
-            },
-            {
-                "role": "user",
-                "content": ('{"transcription":"Hello World!","languages":["ko","es"]}'),
-            },
-            {
-                "role": "assistant",
-                "content": ('{"translations":{"ko":"안녕 세상!","es":"¡Hola Mundo!"}}'),
-            },
-            {
-                "role": "user",
-                "content": ('{"transcription":"Hello 세상!","languages":["en","ko"]}'),
-            },
-            {
-                "role": "assistant",
-                "content": ('{"translations":{"en":"Hello World!","ko":"안녕 세상!"}}'),
-            },
-            {
-                "role": "user",
-                "content": json.dumps(
-                    {
-                        "transcription": request.transcription,
-                        "languages": request.languages,
-                    }
-                ),
-            },
-        ],
+        transcription=request.transcription,
+        languages=request.languages,
     )
+    return {"status": 200, "completion": completion}
+
+
+class TranslationPipeline:
+    # Translates the finals of a live session in the background and pushes
+    # the results through `send`. Finals arriving within batch_window of each
+    # other, or while the previous translation is still running, go out as a
+    # single request. Translations are sent in order; `id` is the index of
+    # the first final of the batch and `finals` the number of finals in it.
+    def __init__(
+        self,
+        model: str,
+        languages: list[str],
+        send: Callable[[dict[str, Any]], Awaitable[None]],
+        stream: bool = False,
+        batch_window: float = TRANSLATION_BATCH_WINDOW,
+    ) -> None:
+        self.model = model
+        self.languages = languages
+        self.send = send
+        self.stream = stream
+        self.batch_window = batch_window
+        self.queue: asyncio.Queue[tuple[int, str] | None] = asyncio.Queue()
+        self.count = 0
+        self.task: asyncio.Task | None = None
+
+    def start(self, tg: asyncio.TaskGroup) -> None:
+        self.task = tg.create_task(self._run())
+
+    def submit(self, transcription: Transcription) -> None:
+        # never blocks the transcription loop
+        if len(transcription.words) > 0:
+            self.queue.put_nowait((self.count, transcription.text))
+        self.count += 1
+
+    async def close(self) -> None:
+        # waits for the finals already submitted to be translated
+        self.queue.put_nowait(None)
+        if self.task is not None:
+            await self.task
+
+    async def _run(self) -> None:
+        closed = False
+        while not closed:
+            item = await self.queue.get()
+            if item is None:
+                return
+            batch = [item]
+            await asyncio.sleep(self.batch_window)
+            while not self.queue.empty():
+                item = self.queue.get_nowait()
+                if item is None:
+                    closed = True
+                    break
+                batch.append(item)
+
+            try:
+                await self._translate(batch)
+            except Exception as e:
+                # the socket is gone, there is nobody to translate for
+                logger.info(f"Stopping translation pipeline: {e}")
+                return
+
+    async def _translate(self, batch: list[tuple[int, str]]) -> None:
+        first = batch[0][0]
+        transcription = " ".join(text for _, text in batch)
+        message = {
+            "type": "translation",
+            "id": first,
+            "finals": batch[-1][0] - first + 1,
+            "transcription": transcription,
+        }
+
+        try:
+            if self.stream:
+                parts: list[str] = []
+                async for delta in translate_stream(
+                    self.model, transcription, self.languages
+                ):
+                    parts.append(delta)
+                    await self.send(
+                        {"type": "translation-delta", "id": first, "delta": delta}
+                    )
+                completion = "".join(parts)
+            else:
+                completion = await translate(self.model, transcription, self.languages)
+        except Exception as e:
+            logger.error(f"Translation failed: {e}")
+            await self.send({**message, "status": 500, "completion": ""})
+            return
 
-    return {"status": 200, "completion": completion.choices[0].message.content}
+        await self.send({**message, "status": 200, "completion": completion})
@@ -1,5 +1,23 @@
-from faster_whisper.vad import VadOptions, get_speech_timestamps
-from config import min_silence_duration_ms
+from faster_whisper.vad import VadOptions, get_speech_timestamps, get_vad_model
+from config import (
+    min_silence_duration_ms,
+    eou_silence_duration_ms,
+    min_speech_duration_ms,
+    vad_threshold,
+    VAD_STEP,
+    SAMPLE_RATE,
+    SPEECH_WINDOW_PAD,
+    SPEECH_WINDOW_MIN_SILENCE,
+)
+from audio import AudioStream
+from metrics import VAD_SECONDS
+from collections import deque
+from collections.abc import AsyncGenerator, Callable
+from dataclasses import dataclass
+from numpy.typing import NDArray
+import numpy as np
+
+WINDOW_SIZE = 512
 
 
 def is_speaking(data):
@@ -8,3 +26,190 @@ def is_speaking(data):
     )
     timestamps = get_speech_timestamps(data, vad_options)
     return len(timestamps) > 0
+
+
+@dataclass
+class VadEvent:
+    type: str
+    ts: float
+
+
+class StreamingVAD:
+    # Per-session Silero VAD. Keeps the LSTM state and context between calls
+    # and only runs the model over newly arrived 512 sample windows.
+    def __init__(
+        self,
+        threshold: float = vad_threshold,
+        min_silence_duration_ms: int = eou_silence_duration_ms,
+        min_speech_duration_ms: int = min_speech_duration_ms,
+        history: int = 1024,
+    ) -> None:
+        self.model = get_vad_model()
+        self.threshold = threshold
+        self.neg_threshold = threshold - 0.15
+        self.min_silence_samples = SAMPLE_RATE * min_silence_duration_ms // 1000
+        self.min_speech_samples = SAMPLE_RATE * min_speech_duration_ms // 1000
+        self.probabilities: deque[tuple[float, float]] = deque(maxlen=history)
+        self.reset()
+
+    @property
+    def ts(self) -> float:
+        return self.cursor / SAMPLE_RATE
+
+    @property
+    def end(self) -> float:
+        # stream time of the end of the audio fed so far, ts lags it by the
+        # samples short of a whole window
+        return (self.cursor + len(self.pending)) / SAMPLE_RATE
+
+    def reset(self) -> None:
+        self.state, self.context = self.model.get_initial_states(batch_size=1)
+        self.pending = np.empty(0, dtype=np.float32)
+        self.cursor = 0
+        self.speaking = False
+        self.speech_start = 0
+        self.silence_start = 0
+        self.probabilities.clear()
+
+    def process(self, data: NDArray[np.float32]) -> list[VadEvent]:
+        with VAD_SECONDS.time():
+            return self._process(data)
+
+    def _process(self, data: NDArray[np.float32]) -> list[VadEvent]:
+        events: list[VadEvent] = []
+        pending = np.concatenate([self.pending, data]) if len(self.pending) else data
+        n_windows = len(pending) // WINDOW_SIZE
+
+        for i in range(n_windows):
+            window = pending[i * WINDOW_SIZE : (i + 1) * WINDOW_SIZE]
+            prob, self.state, self.context = self.model(
+                window, self.state, self.context, SAMPLE_RATE
+            )
+            prob = float(np.asarray(prob).item())
+            self.probabilities.append((self.ts, prob))
+            self._update(prob, events)
+            self.cursor += WINDOW_SIZE
+
+        self.pending = pending[n_windows * WINDOW_SIZE :].copy()
+        return events
+
+    def _update(self, prob: float, events: list[VadEvent]) -> None:
+        if prob >= self.threshold:
+            self.silence_start = 0
+            if not self.speaking:
+                self.speaking = True
+                self.speech_start = self.cursor
+                events.append(VadEvent(type="start", ts=self.ts))
+            return
+
+        if self.speaking and prob < self.neg_threshold:
+            if not self.silence_start:
+                self.silence_start = self.cursor
+            if self.cursor + WINDOW_SIZE - self.silence_start >= self.min_silence_samples:
+                self.speaking = False
+                # too short to be an utterance, drop it silently
+                if self.silence_start - self.speech_start >= self.min_speech_samples:
+                    events.append(
+                        VadEvent(type="end", ts=self.silence_start / SAMPLE_RATE)
+                    )
+                self.silence_start = 0
+
+    def speech_regions(
+        self,
+        start: float,
+        end: float,
+        pad: float = SPEECH_WINDOW_PAD,
+        min_silence: float = SPEECH_WINDOW_MIN_SILENCE,
+    ) -> list[tuple[float, float]]:
+        # Speech in [start, end) from the window probabilities seen so far,
+        # with the same hysteresis as _update. Audio the VAD has not reached
+        # yet or no longer remembers counts as speech. Regions are padded by
+        # pad, and silences shorter than min_silence are kept.
+        window = WINDOW_SIZE / SAMPLE_RATE
+        regions: list[tuple[float, float]] = []
+        speaking = False
+        speech_start = start
+        first = self.probabilities[0][0] if len(self.probabilities) else self.ts
+        if first > start:
+            speaking = True
+        for ts, prob in self.probabilities:
+            if ts + window <= start:
+                continue
+            if ts >= end:
+                break
+            if prob >= self.threshold:
+                if not speaking:
+                    speaking = True
+                    speech_start = ts
+            elif speaking and prob < self.neg_threshold:
+                speaking = False
+                regions.append((speech_start, ts))
+        if speaking:
+            regions.append((speech_start, end))
+        if self.ts < end:
+            regions.append((max(self.ts, start), end))
+
+        merged: list[tuple[float, float]] = []
+        for speech_start, speech_end in regions:
+            if len(merged) > 0 and speech_start - merged[-1][1] < min_silence:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], speech_end))
+            else:
+                merged.append((speech_start, speech_end))
+        return [
+            (max(speech_start - pad, start), min(speech_end + pad, end))
+            for speech_start, speech_end in merged
+        ]
+
+
+async def speech_chunks(
+    audio_stream: AudioStream,
+    min_duration: float | Callable[[], float],
+    vad: StreamingVAD | None = None,
+) -> AsyncGenerator[tuple[NDArray[np.float32], bool], None]:
+    # min_duration can be a callable so it follows the session's load level
+    duration = min_duration if callable(min_duration) else lambda: min_duration
+
+    if vad is None:
+        async for chunk in audio_stream.chunks(min_duration=duration()):
+            yield chunk, is_speaking(chunk)
+        return
+
+    # Audio is fed to the VAD in small steps. Chunks are still handed out
+    # every min_duration, but an end of utterance is flushed as soon as the
+    # VAD detects it instead of waiting for the next whole chunk.
+    pending: list[NDArray[np.float32]] = []
+    pending_duration = 0.0
+    spoken = False
+    reported = False
+    async for step in audio_stream.chunks(min_duration=VAD_STEP):
+        pending.append(step)
+        pending_duration += len(step) / SAMPLE_RATE
+
+        events = vad.process(step)
+        spoken = spoken or vad.speaking or any(e.type == "start" for e in events)
+        ended = any(e.type == "end" for e in events)
+
+        if ended:
+            chunk = np.concatenate(pending)
+            # an utterance shorter than min_duration has not been reported
+            # as speech yet, report it before signalling its end
+            if not reported:
+                yield chunk, True
+                chunk = np.empty(0, dtype=np.float32)
+            # otherwise the end of utterance chunk still holds up to
+            # min_duration of its speech, transcribers decode it when ending
+            # the utterance
+            yield chunk, False
+            reported = False
+        elif pending_duration >= duration():
+            yield np.concatenate(pending), spoken
+            reported = reported or spoken
+        else:
+            continue
+
+        pending = []
+        pending_duration = 0.0
+        spoken = vad.speaking
+
+    if pending:
+        yield np.concatenate(pending), spoken
@@ -0,0 +1,427 @@
+from config import (
+    SAMPLE_RATE,
+    WORKER_SLOTS,
+    WORKER_SLOT_SECONDS,
+    WORKER_OVERLOAD,
+    WORKER_SESSION_CACHE,
+    WORKER_CHECK_INTERVAL,
+    WORKER_REQUEST_TIMEOUT,
+    WORKER_MAX_START_FAILURES,
+)
+from models import ModelSpec
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from multiprocessing import shared_memory
+from numpy.typing import NDArray
+from typing import Any
+import copy
+import itertools
+import logging
+import multiprocessing as mp
+import queue
+import threading
+import time
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class WorkerRequest:
+    id: int
+    session: int
+    tier: str
+    options: dict[str, Any]
+    prompt: str | None
+    origin: int
+    feature_cache: bool
+    # audio is either in the worker's shared memory slot or, when no slot
+    # was free or it does not fit, pickled along with the request
+    slot: int | None
+    size: int
+    audio: NDArray[np.float32] | None = None
+
+
+def worker_main(
+    index: int,
+    models: dict[str, ModelSpec],
+    warmup_options: dict[str, dict[str, Any]],
+    shm_name: str,
+    slots: int,
+    slot_size: int,
+    requests: mp.Queue,
+    responses: mp.Queue,
+) -> None:
+    from features import FeatureCache
+    from models import warmup
+    from prompts import PromptCache
+
+    # the segment is owned and unlinked by the parent, spawned workers share
+    # its resource tracker
+    shm = shared_memory.SharedMemory(name=shm_name)
+    buffers = np.ndarray((slots, slot_size), dtype=np.float32, buffer=shm.buf)
+
+    try:
+        whispers = {tier: spec.build() for tier, spec in models.items()}
+        for tier, options in warmup_options.items():
+            warmup(whispers.get(tier, whispers["default"]), [options])
+        # token ids of prompt words are the same for every session
+        prompt_caches = {
+            tier: PromptCache(whisper.hf_tokenizer)
+            for tier, whisper in whispers.items()
+        }
+    except Exception as e:
+        responses.put(("failed", index, f"{type(e).__name__}: {e}"))
+        shm.close()
+        return
+    # per session copies of the model with their own feature cache, see
+    # MercuryASR._session_model
+    sessions: OrderedDict[tuple[int, str], Any] = OrderedDict()
+    responses.put(("ready", index, None))
+
+    while True:
+        request = requests.get()
+        if request is None:
+            break
+        if isinstance(request, int):
+            # the session ended
+            for key in [key for key in sessions if key[0] == request]:
+                del sessions[key]
+            continue
+
+        try:
+            whisper = whispers.get(request.tier, whispers["default"])
+            if request.feature_cache:
+                key = (request.session, request.tier)
+                if key not in sessions:
+                    session_model = copy.copy(whisper)
+                    session_model.feature_extractor = FeatureCache(
+                        whisper.feature_extractor
+                    )
+                    sessions[key] = session_model
+                sessions.move_to_end(key)
+                while len(sessions) > WORKER_SESSION_CACHE:
+                    sessions.popitem(last=False)
+                whisper = sessions[key]
+                whisper.feature_extractor.set_origin(request.origin)
+
+            audio = (
+                request.audio
+                if request.audio is not None
+                else buffers[request.slot, : request.size]
+            )
+            prompt = request.prompt
+            prompt_cache = prompt_caches.get(request.tier, prompt_caches["default"])
+            if prompt is not None:
+                prompt = prompt_cache.encode(prompt)
+            segments, info = whisper.transcribe(
+                audio, initial_prompt=prompt, **request.options
+            )
+            responses.put(
+                (request.id, (list(segments), info, prompt_cache.take_counts()), None)
+            )
+        except Exception as e:
+            responses.put((request.id, None, f"{type(e).__name__}: {e}"))
+
+    shm.close()
+
+
+@dataclass
+class Worker:
+    index: int
+    process: mp.Process
+    requests: mp.Queue
+    free_slots: list[int]
+    in_flight: int = 0
+    ready: bool = False
+    sessions: set[int] = field(default_factory=set)
+
+
+class WorkerPool:
+    # N model worker processes with M intra-op threads each. Audio goes to the
+    # workers through per-worker shared memory slots. A session sticks to one
+    # worker so its feature cache stays warm, and is only moved when its
+    # worker has WORKER_OVERLOAD requests in flight and another worker is
+    # less loaded.
+    #
+    # Each worker loads and warms up its models before reporting ready. A
+    # worker that exits before that is restarted, up to
+    # WORKER_MAX_START_FAILURES times in a row, then the pool fails with
+    # `error`.
+    #
+    # transcribe() blocks until the worker answers, it is meant to be called
+    # from the inference scheduler's threads like WhisperModel.transcribe.
+    def __init__(
+        self,
+        models: dict[str, ModelSpec],
+        workers: int,
+        warmup_options: dict[str, dict[str, Any]] | None = None,
+        slots: int = WORKER_SLOTS,
+        slot_seconds: float = WORKER_SLOT_SECONDS,
+    ) -> None:
+        self.models = models
+        self.n_workers = workers
+        self.warmup_options = warmup_options or {}
+        self.slots = slots
+        self.slot_size = int(slot_seconds * SAMPLE_RATE)
+
+        self.context = mp.get_context("spawn")
+        self.lock = threading.Lock()
+        self.counter = itertools.count()
+        self.workers: list[Worker] = []
+        self.shms: list[shared_memory.SharedMemory] = []
+        self.assignments: dict[int, int] = {}
+        self.pending: dict[int, tuple[Worker, int | None, Future]] = {}
+        self.responses: mp.Queue | None = None
+        self.reader: threading.Thread | None = None
+        self.closed = False
+        # sessions released without taking the lock, see release_later
+        self.released: deque[int] = deque()
+        # startup failures in a row by worker index, and the last reason
+        self.start_failures = [0] * workers
+        self.start_errors: dict[int, str] = {}
+        self.error: str | None = None
+
+    @property
+    def ready(self) -> bool:
+        return len(self.workers) > 0 and all(worker.ready for worker in self.workers)
+
+    def start(self) -> None:
+        self.responses = self.context.Queue()
+        for index in range(self.n_workers):
+            shm = shared_memory.SharedMemory(
+                create=True, size=self.slots * self.slot_size * 4
+            )
+            self.shms.append(shm)
+            self.workers.append(self._spawn(index))
+        self.reader = threading.Thread(
+            target=self._read, name="mercury-worker-pool", daemon=True
+        )
+        self.reader.start()
+
+    def _spawn(self, index: int) -> Worker:
+        requests = self.context.Queue()
+        process = self.context.Process(
+            target=worker_main,
+            args=(
+                index,
+                self.models,
+                self.warmup_options,
+                self.shms[index].name,
+                self.slots,
+                self.slot_size,
+                requests,
+                self.responses,
+            ),
+            name=f"mercury-worker-{index}",
+            daemon=True,
+        )
+        process.start()
+        logger.info(f"Started model worker {index} (pid {process.pid}).")
+        return Worker(
+            index=index,
+            process=process,
+            requests=requests,
+            free_slots=list(range(self.slots)),
+        )
+
+    def route(self, session: int) -> Worker:
+        # call with the lock held
+        worker = None
+        if session in self.assignments:
+            worker = self.workers[self.assignments[session]]
+        least = min(self.workers, key=lambda w: (w.in_flight, len(w.sessions)))
+        if worker is None or (
+            worker.in_flight >= WORKER_OVERLOAD and least.in_flight < worker.in_flight - 1
+        ):
+            if worker is not None:
+                logger.info(
+                    f"Moving session {session} from worker {worker.index} to {least.index}."
+                )
+                worker.sessions.discard(session)
+                worker.requests.put(session)
+            worker = least
+            worker.sessions.add(session)
+            self.assignments[session] = worker.index
+        return worker
+
+    def submit(
+        self,
+        session: int,
+        audio: NDArray[np.float32],
+        origin: int,
+        prompt: str | None,
+        tier: str,
+        options: dict[str, Any],
+        feature_cache: bool = True,
+    ) -> Future:
+        future: Future = Future()
+        with self.lock:
+            if self.closed:
+                raise RuntimeError("Worker pool is closed.")
+            if self.error is not None:
+                raise RuntimeError(self.error)
+            self._release_pending()
+            worker = self.route(session)
+            slot = None
+            if len(audio) <= self.slot_size and len(worker.free_slots) > 0:
+                slot = worker.free_slots.pop()
+            request = WorkerRequest(
+                id=next(self.counter),
+                session=session,
+                tier=tier,
+                options=options,
+                prompt=prompt,
+                origin=origin,
+                feature_cache=feature_cache,
+                slot=slot,
+                size=len(audio),
+                audio=audio if slot is None else None,
+            )
+            if slot is not None:
+                offset = slot * self.slot_size * 4
+                np.ndarray(
+                    len(audio),
+                    dtype=np.float32,
+                    buffer=self.shms[worker.index].buf,
+                    offset=offset,
+                )[:] = audio
+            worker.in_flight += 1
+            self.pending[request.id] = (worker, slot, future)
+            worker.requests.put(request)
+        return future
+
+    def transcribe(self, session: int, audio: NDArray[np.float32], **kwargs) -> Any:
+        try:
+            return self.submit(session, audio, **kwargs).result(
+                timeout=WORKER_REQUEST_TIMEOUT
+            )
+        except TimeoutError:
+            # the request stays pending, its slot is only reused once the
+            # worker answers or is found dead
+            raise TimeoutError(
+                f"Model worker did not answer within {WORKER_REQUEST_TIMEOUT:.0f} seconds."
+            ) from None
+
+    def release(self, session: int) -> None:
+        with self.lock:
+            self._release(session)
+
+    def release_later(self, session: int) -> None:
+        # For garbage collector finalizers, which can run on a thread that
+        # already holds the lock. The session is released by the next call
+        # taking the lock.
+        self.released.append(session)
+
+    def _release(self, session: int) -> None:
+        # call with the lock held
+        index = self.assignments.pop(session, None)
+        if index is None or self.closed:
+            return
+        worker = self.workers[index]
+        worker.sessions.discard(session)
+        worker.requests.put(session)
+
+    def _release_pending(self) -> None:
+        # call with the lock held
+        while len(self.released) > 0:
+            self._release(self.released.popleft())
+
+    def stats(self) -> list[dict[str, Any]]:
+        return [
+            {
+                "worker": worker.index,
+                "pid": worker.process.pid,
+                "alive": worker.process.is_alive(),
+                "ready": worker.ready,
+                "in_flight": worker.in_flight,
+                "sessions": len(worker.sessions),
+                "free_slots": len(worker.free_slots),
+                "start_failures": self.start_failures[worker.index],
+            }
+            for worker in self.workers
+        ]
+
+    def close(self) -> None:
+        with self.lock:
+            self.closed = True
+            for worker in self.workers:
+                worker.requests.put(None)
+        for worker in self.workers:
+            worker.process.join(timeout=5)
+            if worker.process.is_alive():
+                worker.process.terminate()
+        for shm in self.shms:
+            shm.close()
+            shm.unlink()
+        with self.lock:
+            for _, _, future in self.pending.values():
+                future.set_exception(RuntimeError("Worker pool is closed."))
+            self.pending.clear()
+
+    def _read(self) -> None:
+        checked = time.monotonic()
+        while not self.closed:
+            # also while responses keep coming in, a crashed worker never
+            # answers its in flight requests
+            if time.monotonic() - checked >= WORKER_CHECK_INTERVAL:
+                self._check_workers()
+                checked = time.monotonic()
+            try:
+                id, result, error = self.responses.get(timeout=WORKER_CHECK_INTERVAL)
+            except queue.Empty:
+                continue
+            except (EOFError, OSError):
+                break
+
+            if id == "ready":
+                self.workers[result].ready = True
+                self.start_failures[result] = 0
+                logger.info(f"Model worker {result} is ready.")
+                continue
+            if id == "failed":
+                # the worker exits, _check_workers counts the failure
+                self.start_errors[result] = error
+                logger.error(f"Model worker {result} failed to start: {error}")
+                continue
+
+            with self.lock:
+                entry = self.pending.pop(id, None)
+                if entry is None:
+                    continue
+                worker, slot, future = entry
+                worker.in_flight -= 1
+                if slot is not None:
+                    worker.free_slots.append(slot)
+            if error is not None:
+                future.set_exception(RuntimeError(error))
+            else:
+                future.set_result(result)
+
+    def _check_workers(self) -> None:
+        # a crashed worker fails its requests and is replaced
+        with self.lock:
+            self._release_pending()
+            for worker in list(self.workers):
+                if self.closed or self.error is not None or worker.process.is_alive():
+                    continue
+                if not worker.ready:
+                    self.start_failures[worker.index] += 1
+                if self.start_failures[worker.index] >= WORKER_MAX_START_FAILURES:
+                    reason = self.start_errors.get(
+                        worker.index, f"exit code {worker.process.exitcode}"
+                    )
+                    self.error = f"Model worker {worker.index} failed to start {self.start_failures[worker.index]} times: {reason}"
+                    logger.error(self.error)
+                else:
+                    logger.error(
+                        f"Model worker {worker.index} exited with {worker.process.exitcode}, restarting."
+                    )
+                    self.workers[worker.index] = self._spawn(worker.index)
+                for id, (owner, _, future) in list(self.pending.items()):
+                    if owner is worker:
+                        del self.pending[id]
+                        future.set_exception(RuntimeError("Model worker crashed."))
+                for session in worker.sessions:
+                    self.assignments.pop(session, None)
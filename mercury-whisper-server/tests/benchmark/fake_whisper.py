@@ -0,0 +1,133 @@
+from faster_whisper.feature_extractor import FeatureExtractor
+from faster_whisper.transcribe import Segment, TranscriptionInfo, Word
+from numpy.typing import NDArray
+import numpy as np
+import time
+
+SAMPLE_RATE = 16000
+BLOCK = 160
+
+
+def spell(index: int) -> str:
+    # a distinct all letter word for every index, canonical forms drop digits
+    letters = ""
+    for _ in range(3):
+        index, digit = divmod(index, 26)
+        letters = chr(ord("a") + digit) + letters
+    while index > 0:
+        index, digit = divmod(index, 26)
+        letters = chr(ord("a") + digit) + letters
+    return letters
+
+
+class FakeWhisperModel:
+    # Deterministic stand-in for faster_whisper.WhisperModel. It knows the
+    # audio files being replayed and a transcript for each, laid out at a
+    # fixed rate over the file. A decode finds where the buffer sits in its
+    # file, sleeps for a configurable cost per second of audio (the GIL is
+    # released like during a real GPU decode) and returns the transcript
+    # words that fall completely inside the buffer. Words ending in the last
+    # `unstable_tail` seconds come out truncated, so the agreement logic sees
+    # an unstable tail like with a real model.
+    def __init__(
+        self,
+        decode_cost: float = 0.05,
+        decode_overhead: float = 0.01,
+        unstable_tail: float = 0.5,
+        words_per_second: float = 2.5,
+        features: bool = True,
+        language: str = "en",
+    ) -> None:
+        self.decode_cost = decode_cost
+        self.decode_overhead = decode_overhead
+        self.unstable_tail = unstable_tail
+        self.words_per_second = words_per_second
+        self.features = features
+        self.language = language
+        self.feature_extractor = FeatureExtractor()
+
+        self.blocks: dict[bytes, tuple[int, int]] = {}
+        self.transcripts: list[list[Word]] = []
+
+    def add_audio(self, audio: NDArray[np.float32], text: str | None = None) -> str:
+        # registers a file and returns the transcript the model will produce
+        index = len(self.transcripts)
+        for position in range(0, len(audio) - BLOCK + 1, BLOCK):
+            block = audio[position : position + BLOCK]
+            if block.any():
+                self.blocks.setdefault(block.tobytes(), (index, position))
+
+        duration = len(audio) / SAMPLE_RATE
+        n_words = int(duration * self.words_per_second)
+        if text is not None:
+            tokens = text.split()
+        else:
+            tokens = [
+                f"{spell(i)}." if (i + 1) % 8 == 0 else spell(i) for i in range(n_words)
+            ]
+        slot = duration / max(len(tokens), 1)
+        self.transcripts.append(
+            [
+                Word(start=i * slot, end=(i + 0.8) * slot, word=f" {token}", probability=0.9)
+                for i, token in enumerate(tokens)
+            ]
+        )
+        return " ".join(tokens)
+
+    def locate(self, audio: NDArray[np.float32]) -> tuple[int, float] | None:
+        # (file index, start of the buffer in seconds within that file)
+        for shift in range(0, len(audio) - BLOCK + 1):
+            hit = self.blocks.get(audio[shift : shift + BLOCK].tobytes())
+            if hit is not None:
+                index, position = hit
+                return index, (position - shift) / SAMPLE_RATE
+        return None
+
+    def transcribe(self, audio: NDArray[np.float32], **kwargs):
+        if self.features:
+            self.feature_extractor(audio)
+        duration = len(audio) / SAMPLE_RATE
+        time.sleep(self.decode_overhead + self.decode_cost * duration)
+
+        words: list[Word] = []
+        located = self.locate(audio)
+        if located is not None:
+            index, start = located
+            end = start + duration
+            for word in self.transcripts[index]:
+                if word.start < start or word.end > end:
+                    continue
+                text = word.word
+                if end - word.end < self.unstable_tail and len(text) > 2:
+                    text = text[:-1]
+                words.append(
+                    word._replace(start=word.start - start, end=word.end - start, word=text)
+                )
+
+        segments = []
+        if len(words) > 0:
+            segments.append(
+                Segment(
+                    id=1,
+                    seek=0,
+                    start=words[0].start,
+                    end=words[-1].end,
+                    text="".join(word.word for word in words),
+                    tokens=[],
+                    temperature=0.0,
+                    avg_logprob=-0.1,
+                    compression_ratio=1.0,
+                    no_speech_prob=0.0,
+                    words=words,
+                )
+            )
+        info = TranscriptionInfo(
+            language=self.language,
+            language_probability=1.0,
+            duration=duration,
+            duration_after_vad=duration,
+            all_language_probs=None,
+            transcription_options=None,
+            vad_options=None,
+        )
+        return iter(segments), info
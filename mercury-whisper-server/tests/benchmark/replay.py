@@ -0,0 +1,484 @@
+# Streaming replay benchmark for the live transcription pipeline.
+#
+# Replays audio files into the transcribers as if N clients were streaming
+# them, either in process (driving mercury_transcribe / mercury_transcribe_v2
+# directly) or against a running server over its websocket endpoints.
+#
+#   # scheduling and buffering only, no model weights needed
+#   python tests/benchmark/replay.py --sessions 8 --model fake --decode-cost 0.05
+#   # real model on this machine
+#   python tests/benchmark/replay.py --model large-v3 --device cuda
+#   # a running server
+#   python tests/benchmark/replay.py --url ws://localhost:8000/v2/live-transcription
+#   python tests/benchmark/replay.py --url "ws://localhost:8000/v3/live-transcription?encoding=msgpack"
+#
+# A reference transcript for `file.mp3` is read from `file.txt` next to it. With
+# the fake model the reference is the transcript the fake produces.
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any
+import argparse
+import asyncio
+import bisect
+import json
+import re
+import resource
+import statistics
+import sys
+import time
+
+import numpy as np
+
+SERVER_SRC = Path(__file__).resolve().parents[2] / "server" / "src"
+AUDIO_FILES = Path(__file__).resolve().parents[1] / "audio_files"
+sys.path.insert(0, str(SERVER_SRC))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from faster_whisper.audio import decode_audio  # noqa: E402
+
+from config import SAMPLE_RATE  # noqa: E402
+
+TRANSCRIBERS = ("v1", "v2")
+
+
+@dataclass
+class Message:
+    received: float
+    type: str
+    text: str
+    end: float
+
+
+@dataclass
+class Session:
+    name: str
+    audio: np.ndarray
+    reference: str | None
+    started: float = 0.0
+    finished: float = 0.0
+    # (stream end in seconds, wall clock) of every frame sent
+    fed: list[tuple[float, float]] = field(default_factory=list)
+    messages: list[Message] = field(default_factory=list)
+
+    @property
+    def duration(self) -> float:
+        return len(self.audio) / SAMPLE_RATE
+
+    def fed_at(self, ts: float) -> float | None:
+        # wall clock at which the audio up to ts had been sent
+        i = bisect.bisect_left(self.fed, (ts, 0.0))
+        return self.fed[i][1] if i < len(self.fed) else None
+
+    def receive(self, type: str, text: str, end: float) -> None:
+        self.messages.append(
+            Message(received=time.perf_counter(), type=type, text=text, end=end)
+        )
+
+    def hypothesis(self) -> str:
+        texts = [message.text for message in self.messages if message.type == "final"]
+        # whatever was still in flight when the stream ended
+        if len(self.messages) > 0 and self.messages[-1].type == "partial":
+            texts.append(self.messages[-1].text)
+        return " ".join(texts)
+
+    def report(self) -> dict[str, Any]:
+        partials = [m for m in self.messages if m.type == "partial" and m.text]
+        finals = [m for m in self.messages if m.type == "final" and m.text]
+
+        def latencies(messages: list[Message]) -> list[float]:
+            result = []
+            for message in messages:
+                fed = self.fed_at(message.end)
+                if fed is not None:
+                    result.append(message.received - fed)
+            return result
+
+        return {
+            "session": self.name,
+            "audio_seconds": self.duration,
+            "time_to_first_partial": (
+                partials[0].received - self.started if partials else None
+            ),
+            "partial_latency": latencies(partials),
+            "partial_interval": [
+                b.received - a.received for a, b in zip(partials, partials[1:])
+            ],
+            "final_latency": latencies(finals),
+            "partials": len(partials),
+            "finals": len(finals),
+            "real_time_factor": (self.finished - self.started) / self.duration,
+            "wer": (
+                word_error_rate(self.reference, self.hypothesis())
+                if self.reference is not None
+                else None
+            ),
+        }
+
+
+def normalize(text: str) -> list[str]:
+    return re.sub(r"[^\w\s]", " ", text.lower()).split()
+
+
+def word_error_rate(reference: str, hypothesis: str) -> float:
+    ref = normalize(reference)
+    hyp = normalize(hypothesis)
+    if len(ref) == 0:
+        return float(len(hyp) > 0)
+
+    previous = list(range(len(hyp) + 1))
+    for i, r in enumerate(ref, start=1):
+        current = [i] + [0] * len(hyp)
+        for j, h in enumerate(hyp, start=1):
+            current[j] = min(
+                previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (r != h)
+            )
+        previous = current
+    return previous[-1] / len(ref)
+
+
+async def feed(
+    session: Session, push, frame: float, speed: float
+) -> None:
+    # sends the file in frames of `frame` seconds, paced at `speed` times real
+    # time (0 sends as fast as possible)
+    step = int(frame * SAMPLE_RATE)
+    session.started = time.perf_counter()
+    for i, position in enumerate(range(0, len(session.audio), step)):
+        if speed > 0:
+            due = session.started + i * frame / speed
+            await asyncio.sleep(max(due - time.perf_counter(), 0.0))
+        else:
+            await asyncio.sleep(0)
+        data = session.audio[position : position + step]
+        await push(data)
+        session.fed.append(
+            ((position + len(data)) / SAMPLE_RATE, time.perf_counter())
+        )
+
+
+async def run_direct(
+    session: Session, mercury_asr, transcriber: str, frame: float, speed: float
+) -> None:
+    from audio import AudioStream
+    from config import STREAMING_VAD
+    from transcriber import mercury_transcribe, mercury_transcribe_v2
+    from vad import StreamingVAD
+
+    audio_stream = AudioStream()
+    vad = StreamingVAD() if STREAMING_VAD else None
+    transcribe = mercury_transcribe if transcriber == "v1" else mercury_transcribe_v2
+
+    async def push(data: np.ndarray) -> None:
+        audio_stream.extend(data)
+
+    async def stream() -> None:
+        await feed(session, push, frame, speed)
+        audio_stream.close()
+
+    async with asyncio.TaskGroup() as tg:
+        tg.create_task(stream())
+        async for transcript in transcribe(
+            audio_stream=audio_stream, mercury_asr=mercury_asr, vad=vad
+        ):
+            if not transcript:
+                break
+            session.receive(transcript.type, transcript.text, transcript.end)
+    session.finished = time.perf_counter()
+
+
+class DeltaDecoder:
+    # client side of the v3 protocol, see protocol.DeltaEncoder
+    def __init__(self) -> None:
+        self.committed: list[list] = []
+        self.tail: list[list] = []
+
+    def decode(self, message: dict[str, Any]) -> list[list]:
+        self.committed = self.committed[: message["base"]] + message["commit"]
+        if message["type"] == "final":
+            words = self.committed[: message["words"]]
+            self.committed = self.committed[message["words"] :]
+            self.tail = []
+            return words
+        self.tail = self.tail[: message["tail_base"]] + message["tail"]
+        return self.committed + self.tail
+
+
+async def run_websocket(
+    session: Session, url: str, frame: float, speed: float, tail: float
+) -> None:
+    import websockets
+
+    delta = DeltaDecoder() if "/v3/" in url else None
+
+    async with websockets.connect(url, max_size=None) as websocket:
+
+        async def push(data: np.ndarray) -> None:
+            await websocket.send(data.astype(np.float32).tobytes())
+
+        async def receive() -> None:
+            async for raw in websocket:
+                if isinstance(raw, bytes):
+                    import msgpack
+
+                    message = msgpack.unpackb(raw)
+                else:
+                    message = json.loads(raw)
+                if message.get("type") not in ("partial", "final"):
+                    continue
+                if delta is not None:
+                    # [start, end, word, probability] in centiseconds
+                    words = delta.decode(message)
+                    text = "".join(word[2] for word in words)
+                    end = words[-1][1] / 100 if words else 0.0
+                else:
+                    words = message.get("words") or []
+                    text = message["text"]
+                    end = words[-1]["end"] if words else 0.0
+                session.receive(message["type"], text, end)
+
+        receiver = asyncio.create_task(receive())
+        await feed(session, push, frame, speed)
+        # the server closes the connection once the last utterance is
+        # finalized, give it at most `tail` seconds
+        await websocket.send(json.dumps({"type": "end"}))
+        try:
+            await asyncio.wait_for(receiver, timeout=tail)
+        except TimeoutError:
+            pass
+        session.finished = time.perf_counter()
+
+
+def load_model(args: argparse.Namespace):
+    if args.model == "fake":
+        from fake_whisper import FakeWhisperModel
+
+        return FakeWhisperModel(
+            decode_cost=args.decode_cost,
+            decode_overhead=args.decode_overhead,
+            unstable_tail=args.unstable_tail,
+        )
+
+    from faster_whisper import WhisperModel
+
+    return WhisperModel(args.model, device=args.device, compute_type=args.compute_type)
+
+
+def summarize(values: list[float]) -> dict[str, float] | None:
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    return {
+        "mean": statistics.fmean(values),
+        "p50": values[int(0.5 * (len(values) - 1))],
+        "p95": values[int(0.95 * (len(values) - 1))],
+        "max": values[-1],
+    }
+
+
+def aggregate(reports: list[dict[str, Any]]) -> dict[str, Any]:
+    def collect(key: str) -> list[float]:
+        values: list[float] = []
+        for report in reports:
+            value = report[key]
+            if isinstance(value, list):
+                values.extend(value)
+            elif value is not None:
+                values.append(value)
+        return values
+
+    return {
+        key: summarize(collect(key))
+        for key in (
+            "time_to_first_partial",
+            "partial_latency",
+            "partial_interval",
+            "final_latency",
+            "real_time_factor",
+            "wer",
+        )
+    }
+
+
+async def benchmark(args: argparse.Namespace) -> dict[str, Any]:
+    files = [Path(f) for f in args.files] or sorted(
+        f for f in AUDIO_FILES.iterdir() if f.suffix in (".mp3", ".wav")
+    )
+    model = None if args.url else load_model(args)
+
+    sessions: list[Session] = []
+    for i in range(args.sessions):
+        path = files[i % len(files)]
+        audio = decode_audio(str(path), sampling_rate=SAMPLE_RATE)
+        if args.max_duration:
+            audio = audio[: int(args.max_duration * SAMPLE_RATE)]
+        reference_path = path.with_suffix(".txt")
+        reference = reference_path.read_text() if reference_path.exists() else None
+        if args.model == "fake" and model is not None:
+            # every session gets its own copy of the audio registered
+            text = model.add_audio(audio, reference)
+            reference = text if reference is None else reference
+        sessions.append(Session(name=f"{i}:{path.name}", audio=audio, reference=reference))
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    started = time.perf_counter()
+
+    scheduler = None
+    policy = None
+    if args.url:
+        runs = [
+            run_websocket(session, args.url, args.frame, args.speed, args.tail)
+            for session in sessions
+        ]
+    else:
+        from decode_policy import DecodePolicy, DecodeTier
+        from mercury_asr import MercuryASR
+        from scheduler import InferenceScheduler, make_policy
+        from config import (
+            SCHEDULER_POLICY,
+            SCHEDULER_MAX_BATCH_SIZE,
+            SCHEDULER_MAX_WAIT,
+            SCHEDULER_DEFAULT_DEADLINE,
+            PARTIAL_BEAM_SIZE,
+            PARTIAL_WORD_TIMESTAMPS,
+            FINAL_BEAM_SIZE,
+            FINAL_WORD_TIMESTAMPS,
+        )
+
+        policy = DecodePolicy(
+            partial=DecodeTier(
+                name="partial",
+                beam_size=PARTIAL_BEAM_SIZE,
+                word_timestamps=PARTIAL_WORD_TIMESTAMPS,
+            ),
+            final=DecodeTier(
+                name="final",
+                beam_size=FINAL_BEAM_SIZE,
+                word_timestamps=FINAL_WORD_TIMESTAMPS,
+            ),
+        )
+        if not args.no_scheduler:
+            scheduler = InferenceScheduler(
+                policy=make_policy(args.policy or SCHEDULER_POLICY),
+                max_batch_size=args.batch_size or SCHEDULER_MAX_BATCH_SIZE,
+                max_wait=SCHEDULER_MAX_WAIT,
+                default_deadline=SCHEDULER_DEFAULT_DEADLINE,
+            )
+        runs = [
+            run_direct(
+                session,
+                MercuryASR(model, scheduler=scheduler, policy=policy),
+                args.transcriber,
+                args.frame,
+                args.speed,
+            )
+            for session in sessions
+        ]
+
+    await asyncio.gather(*runs)
+    elapsed = time.perf_counter() - started
+    after = resource.getrusage(resource.RUSAGE_SELF)
+    if scheduler is not None:
+        await scheduler.close()
+
+    reports = [session.report() for session in sessions]
+    cpu = (after.ru_utime - usage.ru_utime) + (after.ru_stime - usage.ru_stime)
+    audio_seconds = sum(session.duration for session in sessions)
+    result: dict[str, Any] = {
+        "mode": "websocket" if args.url else "direct",
+        "transcriber": args.transcriber,
+        "model": args.model,
+        "sessions": len(sessions),
+        "speed": args.speed,
+        "elapsed": elapsed,
+        "audio_seconds": audio_seconds,
+        # totals of the replaying process, only meaningful in direct mode.
+        # Sessions share the process, the per session numbers are the totals
+        # divided by the number of sessions, not measured per session.
+        "process_cpu_seconds": cpu,
+        "process_cpu_seconds_per_session": cpu / len(sessions),
+        "process_cpu_seconds_per_audio_second": cpu / audio_seconds,
+        "process_max_rss_mb": after.ru_maxrss / 1024,
+        "process_max_rss_mb_per_session": after.ru_maxrss / 1024 / len(sessions),
+        "summary": aggregate(reports),
+        "per_session": reports,
+    }
+    if policy is not None:
+        result["decode_policy"] = policy.stats()
+    if scheduler is not None:
+        result["scheduler"] = scheduler.stats()
+    return result
+
+
+def print_report(result: dict[str, Any]) -> None:
+    print(
+        f"{result['mode']} {result['transcriber']} model={result['model']} "
+        f"sessions={result['sessions']} speed={result['speed'] or 'max'} "
+        f"audio={result['audio_seconds']:.1f}s elapsed={result['elapsed']:.1f}s"
+    )
+    print(f"{'metric':<24}{'mean':>10}{'p50':>10}{'p95':>10}{'max':>10}")
+    for key, summary in result["summary"].items():
+        if summary is None:
+            print(f"{key:<24}{'-':>10}")
+            continue
+        print(
+            f"{key:<24}"
+            + "".join(f"{summary[k]:>10.3f}" for k in ("mean", "p50", "p95", "max"))
+        )
+    print(
+        f"process cpu={result['process_cpu_seconds']:.2f}s "
+        f"(/sessions={result['process_cpu_seconds_per_session']:.2f}s "
+        f"/audio-second={result['process_cpu_seconds_per_audio_second']:.3f}) "
+        f"process max-rss={result['process_max_rss_mb']:.1f}MB "
+        f"(/sessions={result['process_max_rss_mb_per_session']:.1f}MB)"
+    )
+    if "scheduler" in result:
+        scheduler = result["scheduler"]
+        print(
+            f"scheduler: mean_wait={scheduler['mean_wait']:.3f}s "
+            f"p95_wait={scheduler['p95_wait']:.3f}s "
+            f"mean_in_flight={scheduler['mean_in_flight']:.2f}"
+        )
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Replay audio files into the live transcription pipeline."
+    )
+    parser.add_argument("files", nargs="*", help="audio files, default tests/audio_files")
+    parser.add_argument("--sessions", type=int, default=1)
+    parser.add_argument(
+        "--speed", type=float, default=1.0, help="replay speed, 0 for as fast as possible"
+    )
+    parser.add_argument("--frame", type=float, default=0.1, help="seconds per frame")
+    parser.add_argument("--transcriber", choices=TRANSCRIBERS, default="v2")
+    parser.add_argument("--max-duration", type=float, default=None)
+    parser.add_argument("--url", help="websocket endpoint of a running server")
+    parser.add_argument(
+        "--tail",
+        type=float,
+        default=30.0,
+        help="seconds to wait for the last transcripts after the audio ends",
+    )
+    parser.add_argument("--model", default="fake", help="fake or a Whisper model size")
+    parser.add_argument("--device", default="cuda")
+    parser.add_argument("--compute-type", default="float16")
+    parser.add_argument("--decode-cost", type=float, default=0.05)
+    parser.add_argument("--decode-overhead", type=float, default=0.01)
+    parser.add_argument("--unstable-tail", type=float, default=0.5)
+    parser.add_argument("--no-scheduler", action="store_true")
+    parser.add_argument("--policy", default=None)
+    parser.add_argument("--batch-size", type=int, default=None)
+    parser.add_argument("--json", help="write the full report to this file")
+    return parser.parse_args(argv)
+
+
+def main(argv: list[str] | None = None) -> None:
+    args = parse_args(argv)
+    result = asyncio.run(benchmark(args))
+    print_report(result)
+    if args.json:
+        Path(args.json).write_text(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
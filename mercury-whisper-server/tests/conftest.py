@@ -0,0 +1,5 @@
+from pathlib import Path
+import sys
+
+# the server is not a package, its modules import each other from server/src
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "server" / "src"))
@@ -0,0 +1,64 @@
+from audio import Audio, AudioStream, SampleBuffer
+from config import SAMPLE_RATE
+import asyncio
+import numpy as np
+
+
+def test_views_stay_valid_while_the_buffer_grows():
+    buffer = SampleBuffer()
+    buffer.append(np.arange(10, dtype=np.float32))
+    view = buffer.view
+    # forces a reallocation
+    buffer.append(np.ones(SAMPLE_RATE * 8, dtype=np.float32))
+    assert list(view) == list(range(10))
+    assert buffer.size == 10 + SAMPLE_RATE * 8
+
+
+def test_dropped_samples_are_counted_and_skipped():
+    buffer = SampleBuffer(np.arange(10, dtype=np.float32))
+    buffer.drop(4)
+    buffer.append(np.array([10.0], dtype=np.float32))
+    assert list(buffer.view) == [4.0, 5.0, 6.0, 7.0, 8.0, 9.0, 10.0]
+    assert buffer.total == 11
+    buffer.drop(100)
+    assert buffer.size == 0
+    assert buffer.total == 11
+
+
+def test_released_audio_keeps_its_stream_time():
+    audio = Audio(data=np.zeros(SAMPLE_RATE * 2, dtype=np.float32), start=1.0)
+    audio.release(2.0)
+    assert audio.start == 2.0
+    assert audio.end == 3.0
+    assert audio.size == SAMPLE_RATE
+
+
+def test_audio_arriving_during_a_slow_decode_is_one_chunk():
+    async def run() -> tuple[list[int], list[float]]:
+        stream = AudioStream()
+        frame = np.zeros(SAMPLE_RATE // 10, dtype=np.float32)
+        sizes: list[int] = []
+        pending: list[float] = []
+
+        async def produce() -> None:
+            for _ in range(30):
+                stream.extend(frame)
+                await asyncio.sleep(0.005)
+            stream.close()
+
+        producer = asyncio.create_task(produce())
+        async for chunk in stream.chunks(min_duration=0.5):
+            sizes.append(len(chunk))
+            pending.append(stream.pending)
+            # a decode far slower than real time
+            await asyncio.sleep(0.05)
+        await producer
+        return sizes, pending
+
+    sizes, pending = asyncio.run(run())
+    assert sum(sizes) == 3 * SAMPLE_RATE
+    # everything that arrived during a decode was handed out at once, not
+    # as a backlog of half second chunks
+    assert len(sizes) < 6
+    assert max(sizes) > SAMPLE_RATE // 2
+    assert all(seconds == 0.0 for seconds in pending)
@@ -0,0 +1,25 @@
+from core import Transcription, Word
+
+
+def test_before_does_not_assume_sorted_word_ends():
+    # ends within the overlap margin can come out of order
+    words = [
+        Word(start=0.0, end=1.0, word=" long", probability=0.9),
+        Word(start=0.9, end=0.95, word=" short", probability=0.9),
+        Word(start=1.2, end=1.5, word=" next", probability=0.9),
+    ]
+    transcription = Transcription(words=words)
+    assert [word.word for word in transcription.before(0.97).words] == [" short"]
+    assert [word.word for word in transcription.before(1.0).words] == [" long", " short"]
+
+
+def test_merge_drops_the_words_ending_after_the_incoming_start():
+    transcription = Transcription(
+        words=[
+            Word(start=0.0, end=1.0, word=" long", probability=0.9),
+            Word(start=0.9, end=0.95, word=" short", probability=0.9),
+            Word(start=1.2, end=1.5, word=" next", probability=0.9),
+        ]
+    )
+    transcription.merge([Word(start=0.97, end=1.4, word=" new", probability=0.9)])
+    assert [word.word for word in transcription.words] == [" new"]
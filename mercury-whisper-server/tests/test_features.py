@@ -0,0 +1,47 @@
+from faster_whisper.feature_extractor import FeatureExtractor
+from features import FeatureCache
+import numpy as np
+
+
+def waveform(seconds: float, seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    return rng.uniform(-0.5, 0.5, int(seconds * 16000)).astype(np.float32)
+
+
+def test_growing_buffers_reuse_the_cached_frames():
+    extractor = FeatureExtractor()
+    cache = FeatureCache(extractor)
+    audio = waveform(3.0)
+
+    for end in (16000, 32000, 48000):
+        features = cache(audio[:end])
+        np.testing.assert_allclose(features, extractor(audio[:end]), atol=1e-4)
+    # the second and third call only computed the frames of the new second
+    assert cache.reused > 250
+
+
+def test_trimmed_buffers_shift_the_cached_frames():
+    extractor = FeatureExtractor()
+    cache = FeatureCache(extractor)
+    audio = waveform(3.0)
+
+    cache(audio[:32000])
+    reused = cache.reused
+    # the buffer dropped its first 0.5 seconds, on the hop grid
+    cache.set_origin(8000)
+    features = cache(audio[8000:48000])
+    np.testing.assert_allclose(features, extractor(audio[8000:48000]), atol=1e-4)
+    assert cache.reused > reused
+
+
+def test_other_audio_is_not_served_from_the_cache():
+    extractor = FeatureExtractor()
+    cache = FeatureCache(extractor)
+
+    cache(waveform(2.0, seed=0))
+    computed = cache.computed
+    other = waveform(2.0, seed=1)
+    features = cache(other)
+    np.testing.assert_allclose(features, extractor(other), atol=1e-4)
+    assert cache.reused == 0
+    assert cache.computed > computed
@@ -0,0 +1,39 @@
+from ingest import AudioDecoder, StreamingResampler
+import numpy as np
+
+
+def tone(rate: int, seconds: float, frequency: float = 440.0) -> np.ndarray:
+    t = np.arange(int(rate * seconds)) / rate
+    return (0.5 * np.sin(2 * np.pi * frequency * t)).astype(np.float32)
+
+
+def test_frames_resample_like_the_whole_signal():
+    signal = tone(44100, 1.0)
+    whole = StreamingResampler(in_rate=44100)
+    expected = np.concatenate([whole.process(signal), whole.flush()])
+
+    framed = StreamingResampler(in_rate=44100)
+    # odd frame sizes, so frames end between output samples
+    bounds = [0, 1, 441, 1000, 1037, 22050, 30001, len(signal)]
+    parts = [framed.process(signal[lo:hi]) for lo, hi in zip(bounds, bounds[1:])]
+    actual = np.concatenate([*parts, framed.flush()])
+
+    np.testing.assert_allclose(actual, expected, atol=1e-6)
+
+
+def test_resampled_tones_keep_their_rate_and_frequency():
+    resampler = StreamingResampler(in_rate=48000)
+    output = np.concatenate(
+        [resampler.process(frame) for frame in np.split(tone(48000, 1.0), 50)]
+        + [resampler.flush()]
+    )
+    assert abs(len(output) - 16000) <= 1
+    # away from the start-up transient the tone matches one sampled at 16 kHz
+    expected = tone(16000, 1.0)
+    np.testing.assert_allclose(output[1000:15000], expected[1000:15000], atol=1e-2)
+
+
+def test_s16_frames_are_scaled_to_floats():
+    decoder = AudioDecoder(format="s16")
+    samples = np.array([0, 16384, -32768], dtype=np.int16)
+    assert list(decoder.decode(samples.tobytes())) == [0.0, 0.5, -1.0]
@@ -0,0 +1,285 @@
+from core import Transcription, Word
+from fastapi.websockets import WebSocketState
+import asyncio
+import json
+import main
+
+
+class SlowWebSocket:
+    # a client that reads nothing until `gate` is set
+    def __init__(self) -> None:
+        self.gate = asyncio.Event()
+        self.closed = asyncio.Event()
+        self.client_state = WebSocketState.CONNECTED
+        self.received: list[dict] = []
+        self.accepted = False
+        self.close_code: int | None = None
+
+    async def accept(self) -> None:
+        self.accepted = True
+
+    async def receive(self) -> dict:
+        await self.closed.wait()
+        return {"type": "websocket.disconnect", "code": 1000}
+
+    async def send_text(self, data: str) -> None:
+        await self.gate.wait()
+        self.received.append(json.loads(data))
+
+    async def close(self, code: int = 1000, reason: str | None = None) -> None:
+        self.close_code = code
+        self.client_state = WebSocketState.DISCONNECTED
+        self.closed.set()
+
+
+def words(text: str, start: float = 0.0) -> list[Word]:
+    return [
+        Word(start=start + i, end=start + i + 0.5, word=f" {word}", probability=0.9)
+        for i, word in enumerate(text.split())
+    ]
+
+
+class ScriptedWebSocket(SlowWebSocket):
+    # a client sending the frames put into `inbox`, a dict is a disconnect
+    def __init__(self) -> None:
+        super().__init__()
+        self.gate.set()
+        self.inbox: asyncio.Queue[str | dict] = asyncio.Queue()
+
+    async def receive(self) -> dict:
+        get = asyncio.ensure_future(self.inbox.get())
+        closed = asyncio.ensure_future(self.closed.wait())
+        await asyncio.wait({get, closed}, return_when=asyncio.FIRST_COMPLETED)
+        closed.cancel()
+        if not get.done():
+            get.cancel()
+            return {"type": "websocket.disconnect", "code": 1000}
+        frame = get.result()
+        if isinstance(frame, dict):
+            return frame
+        return {"type": "websocket.receive", "text": frame}
+
+
+async def final_at_end(audio_stream, mercury_asr, vad=None, capacity=None):
+    # finalizes once the audio ends
+    async for _ in audio_stream.chunks(min_duration=1.0):
+        pass
+    transcript = Transcription(words=words("the end."))
+    transcript.set_final()
+    yield transcript
+
+
+def start(websocket, resumable: bool = True, language: str | None = None):
+    async def admitted() -> None:
+        # start_live_session holds the slot taken by admit()
+        assert await main.capacity.admit()
+        await main.start_live_session(
+            websocket,
+            protocol="v2",
+            decoder=None,
+            language=language,
+            resumable=resumable,
+            languages=None,
+            translation_model=main.TRANSLATION_MODEL,
+            stream_translation=False,
+        )
+
+    return asyncio.create_task(admitted())
+
+
+async def transcripts(audio_stream, mercury_asr, vad=None, capacity=None):
+    # one transcription mutated in place, like the real transcribers
+    transcript = Transcription()
+    transcript.replace(words("first"))
+    transcript.set_partial()
+    yield transcript
+    # the writer is now blocked sending the first partial
+    await asyncio.sleep(0.05)
+
+    transcript.replace(words("hello world."))
+    transcript.set_final()
+    yield transcript
+    transcript.replace(words("next", start=2.0))
+    transcript.set_partial()
+    yield transcript
+    transcript.replace(words("next words", start=2.0))
+    yield transcript
+
+
+def test_queued_messages_keep_their_transcripts(monkeypatch):
+    monkeypatch.setattr(main, "mercury_transcribe_v2", transcripts)
+    monkeypatch.setattr(main.model_manager, "state", "ready")
+
+    async def run() -> list[dict]:
+        websocket = SlowWebSocket()
+        session = start(websocket, resumable=False)
+        await asyncio.sleep(0.2)
+        websocket.gate.set()
+        await asyncio.wait_for(session, timeout=5)
+        return websocket.received
+
+    received = asyncio.run(run())
+    # the queued partial "next" was superseded by "next words"
+    assert [
+        (message["type"], " ".join(message["text"].split())) for message in received
+    ] == [
+        ("partial", "first"),
+        ("final", "hello world."),
+        ("partial", "next words"),
+    ]
+
+
+class RawWebSocket(ScriptedWebSocket):
+    # keeps the frames as sent
+    async def send_text(self, data: str) -> None:
+        await super().send_text(data)
+        self.received[-1] = data
+
+
+def test_v2_messages_do_not_carry_the_language(monkeypatch):
+    monkeypatch.setattr(main, "mercury_transcribe_v2", final_at_end)
+    monkeypatch.setattr(main.model_manager, "state", "ready")
+
+    async def run() -> list[str]:
+        websocket = RawWebSocket()
+        session = start(websocket, resumable=False, language="en")
+        await websocket.inbox.put(json.dumps({"type": "end"}))
+        await asyncio.wait_for(session, timeout=5)
+        return websocket.received
+
+    assert asyncio.run(run()) == [
+        '{"text":"the  end.","words":['
+        '{"start":0.0,"end":0.5,"word":" the","probability":0.9},'
+        '{"start":1.0,"end":1.5,"word":" end.","probability":0.9}],'
+        '"duration":1.5,"type":"final"}'
+    ]
+
+
+def test_end_message_flushes_the_last_transcripts(monkeypatch):
+    monkeypatch.setattr(main, "mercury_transcribe_v2", final_at_end)
+
+    async def run() -> tuple[list[dict], int]:
+        websocket = ScriptedWebSocket()
+        session = start(websocket)
+        await websocket.inbox.put(json.dumps({"type": "end"}))
+        await asyncio.wait_for(session, timeout=5)
+        return websocket.received, len(main.session_store.sessions)
+
+    received, stored = asyncio.run(run())
+    assert [message["type"] for message in received] == ["session", "final"]
+    assert received[-1]["seq"] == 1
+    assert stored == 0
+
+
+def test_only_dropped_connections_are_parked(monkeypatch):
+    monkeypatch.setattr(main, "mercury_transcribe_v2", final_at_end)
+
+    async def run(code: int) -> tuple[int, bool]:
+        websocket = ScriptedWebSocket()
+        session = start(websocket)
+        await asyncio.sleep(0.1)
+        await websocket.inbox.put({"type": "websocket.disconnect", "code": code})
+        await asyncio.wait_for(session, timeout=5)
+        await asyncio.sleep(0.1)
+        parked = len(main.session_store.parked)
+        live = list(main.session_store.sessions.values())
+        for token in list(main.session_store.sessions):
+            main.session_store.expire(token)
+        return parked, len(live) > 0 and not live[0].task.done()
+
+    assert asyncio.run(run(1000)) == (0, False)
+    assert asyncio.run(run(1006)) == (1, True)
+
+
+def test_sessions_are_counted_until_they_end(monkeypatch):
+    monkeypatch.setattr(main, "mercury_transcribe_v2", final_at_end)
+
+    async def run() -> list[int]:
+        counts = []
+        websocket = ScriptedWebSocket()
+        session = start(websocket)
+        await asyncio.sleep(0.1)
+        counts.append(len(main.live_streams))
+        # a dropped connection parks the session, it still holds its stream
+        await websocket.inbox.put({"type": "websocket.disconnect", "code": 1006})
+        await asyncio.wait_for(session, timeout=5)
+        counts.append(len(main.live_streams))
+        for token in list(main.session_store.sessions):
+            main.session_store.expire(token)
+        await asyncio.sleep(0.1)
+        counts.append(len(main.live_streams))
+        return counts
+
+    assert asyncio.run(run()) == [1, 1, 0]
+
+
+class DroppedWebSocket(SlowWebSocket):
+    # a client that goes away right after connecting
+    def __init__(self, fail_accept: bool = False) -> None:
+        super().__init__()
+        self.fail_accept = fail_accept
+
+    async def accept(self) -> None:
+        if self.fail_accept:
+            raise RuntimeError("Connection lost during the handshake.")
+
+    async def receive(self) -> dict:
+        return {"type": "websocket.disconnect", "code": 1006}
+
+
+def test_dropped_connections_give_back_their_capacity(monkeypatch):
+    monkeypatch.setattr(main, "mercury_transcribe_v2", final_at_end)
+    monkeypatch.setattr(main.model_manager, "state", "ready")
+
+    async def run(websocket) -> int:
+        sessions = main.capacity.sessions
+        try:
+            await main.transcribe_v2(websocket)
+        except RuntimeError:
+            pass
+        await asyncio.sleep(0.1)
+        return main.capacity.sessions - sessions
+
+    assert asyncio.run(run(DroppedWebSocket())) == 0
+    assert asyncio.run(run(DroppedWebSocket(fail_accept=True))) == 0
+
+
+def test_rejected_resumes_leave_the_session_parked(monkeypatch):
+    monkeypatch.setattr(main, "mercury_transcribe_v2", final_at_end)
+
+    async def run() -> tuple[ScriptedWebSocket, int]:
+        websocket = ScriptedWebSocket()
+        session = start(websocket)
+        await asyncio.sleep(0.1)
+        await websocket.inbox.put({"type": "websocket.disconnect", "code": 1006})
+        await asyncio.wait_for(session, timeout=5)
+        token = next(iter(main.session_store.parked))
+
+        # the session was opened with v2
+        rejected = ScriptedWebSocket()
+        await main.resume_live_session(rejected, token, ack=0, protocol="v3")
+        parked = len(main.session_store.parked)
+        main.session_store.expire(token)
+        return rejected, parked
+
+    rejected, parked = asyncio.run(run())
+    assert rejected.accepted
+    assert rejected.close_code == 1008
+    assert parked == 1
+
+
+def test_unsupported_parameters_are_rejected_with_1003():
+    async def run(endpoint, **params) -> SlowWebSocket:
+        websocket = SlowWebSocket()
+        await endpoint(websocket, **params)
+        return websocket
+
+    for endpoint, params in [
+        (main.transcribe, {"format": "mp3"}),
+        (main.transcribe_v2, {"language": "klingon"}),
+        (main.transcribe_v3, {"encoding": "xml"}),
+    ]:
+        websocket = asyncio.run(run(endpoint, **params))
+        # closed after the handshake, not turned into an HTTP 403
+        assert websocket.accepted
+        assert websocket.close_code == 1003
@@ -0,0 +1,29 @@
+from metrics import Counter, Gauge, Histogram, Registry
+
+
+def test_counters_are_exposed_with_the_total_suffix():
+    registry = Registry()
+    tokens = registry.register(
+        Counter("mercury_prompt_tokens", "Prompt tokens.", ("source",))
+    )
+    tokens.labels(source="cache").inc(3)
+    registry.register(Gauge("mercury_sessions", "Sessions.")).set(2)
+    registry.register(
+        Histogram("mercury_decode_seconds", "Decode time.", buckets=(1.0,))
+    ).observe(0.5)
+
+    assert registry.render().splitlines() == [
+        "# HELP mercury_prompt_tokens Prompt tokens.",
+        "# TYPE mercury_prompt_tokens counter",
+        'mercury_prompt_tokens_total{source="cache"} 3.0',
+        "# HELP mercury_sessions Sessions.",
+        "# TYPE mercury_sessions gauge",
+        "mercury_sessions 2",
+        "# HELP mercury_decode_seconds Decode time.",
+        "# TYPE mercury_decode_seconds histogram",
+        'mercury_decode_seconds_bucket{le="1.0"} 1',
+        'mercury_decode_seconds_bucket{le="+Inf"} 1',
+        "mercury_decode_seconds_sum 0.5",
+        "mercury_decode_seconds_count 1",
+        "# EOF",
+    ]
@@ -0,0 +1,37 @@
+from prompts import PromptCache
+from types import SimpleNamespace
+
+
+class FakeTokenizer:
+    # one token per character, counts the calls
+    def __init__(self) -> None:
+        self.calls: list[str] = []
+
+    def encode(self, text: str, add_special_tokens: bool = True):
+        self.calls.append(text)
+        return SimpleNamespace(ids=[ord(char) for char in text])
+
+
+def test_prompts_are_the_concatenation_of_their_chunks():
+    cache = PromptCache(FakeTokenizer())
+    assert cache.encode("hello  world ") == [ord(char) for char in " hello  world"]
+
+
+def test_shared_words_are_only_tokenized_once():
+    tokenizer = FakeTokenizer()
+    cache = PromptCache(tokenizer)
+    cache.encode("the quick brown")
+    cache.encode("the quick brown fox")
+    assert tokenizer.calls == [" the", " quick", " brown", " fox"]
+    # (reused, tokenized)
+    assert cache.take_counts() == (len(" the quick brown"), len(" the quick brown fox"))
+    assert cache.take_counts() == (0, 0)
+
+
+def test_the_least_recently_used_chunks_are_evicted():
+    tokenizer = FakeTokenizer()
+    cache = PromptCache(tokenizer, size=2)
+    cache.encode("a b")
+    cache.encode("c")
+    cache.encode("a")
+    assert tokenizer.calls == [" a", " b", " c", " a"]
@@ -0,0 +1,77 @@
+from core import Transcription, Word
+from protocol import DeltaEncoder, compact_word, serialize
+import json
+import msgpack
+import pytest
+
+
+def words(text: str, start: float = 0.0) -> list[Word]:
+    return [
+        Word(start=start + i, end=start + i + 0.5, word=f" {word}", probability=0.9)
+        for i, word in enumerate(text.split())
+    ]
+
+
+def transcription(text: str, stable: int, final: bool = False) -> Transcription:
+    transcription = Transcription(words=words(text))
+    transcription.stable = stable
+    if final:
+        transcription.set_final()
+    else:
+        transcription.set_partial()
+    return transcription
+
+
+class Client:
+    # applies v3 messages as described in DeltaEncoder
+    def __init__(self) -> None:
+        self.committed: list[list] = []
+        self.tail: list[list] = []
+        self.finals: list[list[list]] = []
+
+    def apply(self, message: dict) -> list[list]:
+        self.committed = self.committed[: message["base"]] + message["commit"]
+        if message["type"] == "final":
+            self.finals.append(self.committed[: message["words"]])
+            self.committed = self.committed[message["words"] :]
+            self.tail = []
+            return self.finals[-1]
+        self.tail = self.tail[: message["tail_base"]] + message["tail"]
+        return self.committed + self.tail
+
+
+@pytest.mark.parametrize("encoding", ["json", "msgpack"])
+def test_deltas_rebuild_every_transcription(encoding):
+    encoder = DeltaEncoder()
+    client = Client()
+    sequence = [
+        transcription("the quick", stable=0),
+        transcription("the quick brown", stable=1),
+        # the unstable tail was revised
+        transcription("the quick browns fox", stable=2),
+        transcription("the quick browns fox jumps.", stable=4, final=True),
+        transcription("over", stable=0),
+        transcription("over the dog.", stable=0, final=True),
+    ]
+    for sent in sequence:
+        data = serialize(encoder.encode(sent), encoding)
+        message = msgpack.unpackb(data) if encoding == "msgpack" else json.loads(data)
+        assert client.apply(message) == [compact_word(word) for word in sent.words]
+    assert len(client.finals) == 2
+
+
+def test_unchanged_words_are_not_sent_again():
+    encoder = DeltaEncoder()
+    encoder.encode(transcription("one two three", stable=2))
+    message = encoder.encode(transcription("one two three four", stable=3))
+    assert (message["base"], message["tail_base"]) == (2, 0)
+    assert [word[2] for word in message["commit"]] == [" three"]
+    assert [word[2] for word in message["tail"]] == [" four"]
+
+
+def test_the_language_is_only_sent_when_it_changes():
+    encoder = DeltaEncoder()
+    first = encoder.encode(transcription("hallo", stable=0), "de", 0.93)
+    second = encoder.encode(transcription("hallo welt", stable=1), "de", 0.93)
+    assert first["language"] == ["de", 930]
+    assert "language" not in second
@@ -0,0 +1,73 @@
+from scheduler import POLICIES, InferenceScheduler, SchedulingPolicy, make_policy
+import asyncio
+import time
+import pytest
+
+
+@pytest.mark.parametrize("policy", sorted(POLICIES))
+def test_live_requests_go_before_queued_background_work(policy):
+    async def run() -> list[str]:
+        scheduler = InferenceScheduler(
+            policy=make_policy(policy),
+            max_batch_size=1,
+            max_wait=0.0,
+            default_deadline=1.0,
+        )
+        order: list[str] = []
+
+        def decode(name: str):
+            def fn() -> None:
+                order.append(name)
+                time.sleep(0.02)
+
+            return fn
+
+        uploads = [
+            asyncio.create_task(scheduler.submit(decode(f"file{i}"), background=True))
+            for i in range(5)
+        ]
+        await asyncio.sleep(0.01)
+        # submitted long after the upload, and with a later deadline
+        await scheduler.submit(decode("partial"), deadline=60.0)
+        await asyncio.gather(*uploads)
+        await scheduler.close()
+        return order
+
+    order = asyncio.run(run())
+    assert order.index("partial") <= 2
+
+
+def test_a_slow_request_does_not_hold_up_the_others():
+    async def run() -> list[str]:
+        scheduler = InferenceScheduler(
+            policy=make_policy("fifo"),
+            max_batch_size=2,
+            max_wait=0.0,
+            default_deadline=1.0,
+        )
+        done: list[str] = []
+
+        def decode(name: str, seconds: float):
+            def fn() -> None:
+                time.sleep(seconds)
+                done.append(name)
+
+            return fn
+
+        requests = [scheduler.submit(decode("slow", 0.5))] + [
+            scheduler.submit(decode(f"fast{i}", 0.02)) for i in range(5)
+        ]
+        await asyncio.gather(*requests)
+        await scheduler.close()
+        return done
+
+    # the fast requests share the second thread while the slow one runs
+    assert asyncio.run(run())[-1] == "slow"
+
+
+def test_policies_must_define_a_key():
+    class Unordered(SchedulingPolicy):
+        name = "unordered"
+
+    with pytest.raises(TypeError):
+        Unordered()
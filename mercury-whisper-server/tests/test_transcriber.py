@@ -0,0 +1,173 @@
+from audio import Audio, AudioStream
+from config import SAMPLE_RATE
+from core import Transcription, Word
+from types import SimpleNamespace
+import asyncio
+import numpy as np
+import transcriber
+
+SENTENCES = ["Alpha.", "Bravo.", "Charlie.", "Delta.", "Echo.", "Foxtrot."]
+
+
+class FakeASR:
+    # one sentence per second of audio, the final tier spells it in capitals
+    def __init__(self, tiered: bool = True) -> None:
+        self.policy = SimpleNamespace(tiered=tiered)
+        self.finals: list[tuple[float, float]] = []
+        self.partials: list[tuple[float, float]] = []
+        self.speech: list[list[tuple[float, float]] | None] = []
+
+    async def transcribe(
+        self,
+        audio: Audio,
+        prompt=None,
+        final=False,
+        background=False,
+        speech=None,
+        committed=None,
+    ):
+        if final:
+            self.finals.append((audio.start, audio.end))
+        else:
+            self.partials.append((audio.start, audio.end))
+        self.speech.append(speech)
+        words = [
+            Word(
+                start=i + 0.1,
+                end=i + 0.9,
+                word=" " + (SENTENCES[i].upper() if final else SENTENCES[i]),
+                probability=0.9,
+            )
+            for i in range(int(audio.start), int(audio.end + 1e-6))
+            if i + 1 <= audio.end + 1e-6
+        ]
+        return Transcription(words=words), None
+
+
+async def speech(audio_stream, min_duration, vad=None):
+    for _ in SENTENCES:
+        yield np.zeros(SAMPLE_RATE, dtype=np.float32), True
+
+
+def test_incremental_max_sentences_are_finalized_by_the_final_tier(monkeypatch):
+    monkeypatch.setattr(transcriber, "speech_chunks", speech)
+
+    async def run() -> tuple[list[Transcription], FakeASR]:
+        asr = FakeASR()
+        finals = []
+        async for transcript in transcriber.mercury_transcribe_v2_incremental(
+            audio_stream=AudioStream(), mercury_asr=asr
+        ):
+            if transcript.type == "final":
+                finals.append(Transcription(words=list(transcript.words)))
+        return finals, asr
+
+    finals, asr = asyncio.run(run())
+    assert len(finals) > 0
+    # decoded again from the start of the utterance, not the partial words
+    assert asr.finals[0][0] == 0.0
+    assert finals[0].words[0].word.strip() == "ALPHA."
+    assert all(word.word.strip().isupper() for word in finals[0].words)
+
+
+async def trailing_speech(audio_stream, min_duration, vad=None):
+    # the VAD ends the utterance before the last second was handed out
+    for _ in range(2):
+        yield np.zeros(SAMPLE_RATE, dtype=np.float32), True
+    yield np.zeros(SAMPLE_RATE, dtype=np.float32), False
+
+
+def test_v1_decodes_the_chunk_ending_an_utterance(monkeypatch):
+    monkeypatch.setattr(transcriber, "speech_chunks", trailing_speech)
+
+    async def run() -> list[str]:
+        async for transcript in transcriber.mercury_transcribe(
+            audio_stream=AudioStream(), mercury_asr=FakeASR(tiered=False)
+        ):
+            if transcript.type == "final":
+                return [word.word.strip().lower() for word in transcript.words]
+        return []
+
+    assert asyncio.run(run()) == ["alpha.", "bravo.", "charlie."]
+
+
+class FakeVAD:
+    # speech from 5.5 to 7.0 seconds of the stream
+    def __init__(self) -> None:
+        self.end = 0.0
+        self.queries: list[tuple[float, float]] = []
+
+    def speech_regions(self, start: float, end: float) -> list[tuple[float, float]]:
+        self.queries.append((start, end))
+        return [(max(start, 5.5), min(end, 7.0))]
+
+
+def test_speech_windows_are_looked_up_in_stream_time(monkeypatch):
+    vad = FakeVAD()
+
+    async def chunks(audio_stream, min_duration, vad=None):
+        # five seconds of silence before the utterance
+        for second in range(8):
+            vad.end = second + 1.0
+            yield np.zeros(SAMPLE_RATE, dtype=np.float32), 5 <= second < 7
+
+    monkeypatch.setattr(transcriber, "speech_chunks", chunks)
+
+    async def run() -> FakeASR:
+        asr = FakeASR(tiered=False)
+        async for _ in transcriber.mercury_transcribe_v2(
+            audio_stream=AudioStream(), mercury_asr=asr, vad=vad
+        ):
+            pass
+        return asr
+
+    asr = asyncio.run(run())
+    # the utterance starts at 5 seconds in the stream and 0 in the buffer
+    assert vad.queries[0] == (5.0, 6.0)
+    assert asr.speech[0] == [(0.5, 1.0)]
+
+
+def test_incremental_utterances_are_finalized_by_the_final_tier(monkeypatch):
+    monkeypatch.setattr(transcriber, "speech_chunks", trailing_speech)
+
+    async def run() -> tuple[list[str], FakeASR]:
+        asr = FakeASR()
+        async for transcript in transcriber.mercury_transcribe_v2_incremental(
+            audio_stream=AudioStream(), mercury_asr=asr
+        ):
+            if transcript.type == "final":
+                return [word.word.strip() for word in transcript.words], asr
+        return [], asr
+
+    words, asr = asyncio.run(run())
+    # the committed words came from partial decodes and are decoded again
+    assert asr.finals == [(0.0, 3.0)]
+    assert words == ["ALPHA.", "BRAVO.", "CHARLIE."]
+
+
+def test_incremental_decodes_only_see_the_audio_after_the_committed_words(
+    monkeypatch,
+):
+    async def chunks(audio_stream, min_duration, vad=None):
+        for _ in range(5):
+            yield np.zeros(SAMPLE_RATE, dtype=np.float32), True
+        yield np.zeros(SAMPLE_RATE, dtype=np.float32), False
+
+    monkeypatch.setattr(transcriber, "speech_chunks", chunks)
+
+    async def run() -> tuple[list[int], FakeASR]:
+        asr = FakeASR(tiered=False)
+        stable = []
+        async for transcript in transcriber.mercury_transcribe_v2_incremental(
+            audio_stream=AudioStream(), mercury_asr=asr
+        ):
+            if transcript.type == "partial":
+                stable.append(transcript.stable)
+        return stable, asr
+
+    stable, asr = asyncio.run(run())
+    # a word is committed once two decodes agree on it
+    assert stable[:4] == [0, 1, 2, 3]
+    # and the next decode starts at its end (snapped to the feature hop)
+    starts = [round(start, 1) for start, _ in asr.partials]
+    assert starts == [0.0, 0.0, 0.9, 1.9, 2.9]
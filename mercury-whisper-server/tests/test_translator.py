@@ -0,0 +1,39 @@
+from translator import SecretCache, TTLCache
+import asyncio
+import translator
+
+
+def test_entries_expire_and_the_oldest_are_evicted(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(translator.time, "monotonic", lambda: now[0])
+    cache = TTLCache(max_size=2, ttl=10.0)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    # "b" is now the least recently used
+    cache.put("c", 3)
+    assert cache.get("b") is None
+    now[0] = 11.0
+    assert cache.get("a") is None
+    assert cache.stats() == {"size": 1, "hits": 1, "misses": 2}
+
+
+def test_secrets_are_fetched_once_and_kept_when_a_refresh_fails(monkeypatch):
+    fetched: list[str] = []
+    secrets = iter(["key-1", None])
+
+    def get_secret(name: str) -> str | None:
+        fetched.append(name)
+        return next(secrets)
+
+    monkeypatch.setattr(translator, "get_secret", get_secret)
+
+    async def run() -> list[str | None]:
+        cache = SecretCache(ttl=60.0)
+        first = [await cache.get("openai_api_token") for _ in range(3)]
+        # expired, the refresh fails
+        cache.cache.entries.clear()
+        return first + [await cache.get("openai_api_token")]
+
+    assert asyncio.run(run()) == ["key-1"] * 4
+    assert len(fetched) == 2
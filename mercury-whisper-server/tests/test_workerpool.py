@@ -0,0 +1,122 @@
+from concurrent.futures import Future
+from config import WORKER_MAX_START_FAILURES
+from decode_policy import DecodePolicy
+from mercury_asr import MercuryASR
+from models import ModelManager, ModelSpec
+from types import SimpleNamespace
+from workerpool import Worker, WorkerPool
+import asyncio
+import gc
+import queue
+import threading
+import time
+import numpy as np
+import pytest
+
+
+class FakeProcess:
+    def __init__(self, alive: bool = True) -> None:
+        self.alive = alive
+        self.pid = 0
+        self.exitcode = None if alive else -9
+
+    def is_alive(self) -> bool:
+        return self.alive
+
+
+def make_worker(index: int, alive: bool = True, ready: bool = True) -> Worker:
+    return Worker(
+        index=index,
+        process=FakeProcess(alive),
+        requests=queue.Queue(),
+        free_slots=[],
+        ready=ready,
+    )
+
+
+def test_crashed_worker_fails_its_requests_under_load(monkeypatch):
+    pool = WorkerPool(models={}, workers=2)
+    monkeypatch.setattr(pool, "_spawn", lambda index: make_worker(index))
+    pool.responses = queue.Queue()
+    pool.workers = [make_worker(0, alive=False), make_worker(1)]
+
+    crashed: Future = Future()
+    served: Future = Future()
+    pool.pending = {1: (pool.workers[0], None, crashed), 2: (pool.workers[1], None, served)}
+    pool.workers[0].in_flight = 1
+    pool.workers[1].in_flight = 1
+
+    def respond() -> None:
+        # the live worker keeps the response queue busy
+        while not pool.closed:
+            pool.responses.put(("ready", 1, None))
+            time.sleep(0.05)
+
+    threading.Thread(target=respond, daemon=True).start()
+    reader = threading.Thread(target=pool._read, daemon=True)
+    reader.start()
+    try:
+        with pytest.raises(RuntimeError, match="crashed"):
+            crashed.result(timeout=5)
+        assert not served.done()
+        assert pool.workers[0].process.is_alive()
+    finally:
+        pool.closed = True
+        reader.join(timeout=5)
+
+
+def test_workers_failing_to_start_fail_the_model_manager(monkeypatch):
+    pool = WorkerPool(models={}, workers=1)
+    spawned = []
+
+    def spawn(index: int) -> Worker:
+        # every worker dies while loading its model
+        spawned.append(index)
+        return make_worker(index, alive=False, ready=False)
+
+    def start() -> None:
+        pool.workers = [spawn(0)]
+        pool.responses = queue.Queue()
+        pool.reader = threading.Thread(target=pool._read, daemon=True)
+        pool.reader.start()
+
+    monkeypatch.setattr(pool, "_spawn", spawn)
+    monkeypatch.setattr(pool, "start", start)
+    monkeypatch.setattr("workerpool.WORKER_CHECK_INTERVAL", 0.01)
+    pool.start_errors[0] = "RuntimeError: no such model"
+
+    manager = ModelManager(ModelSpec(model="tiny"), DecodePolicy.uniform(), pool=pool)
+    try:
+        asyncio.run(asyncio.wait_for(manager.load(), timeout=5))
+        assert manager.state == "failed"
+        assert "no such model" in manager.error
+        assert len(spawned) == WORKER_MAX_START_FAILURES
+        with pytest.raises(RuntimeError, match="failed to start"):
+            pool.submit(0, np.zeros(16, dtype=np.float32), 0, None, "default", {})
+    finally:
+        pool.closed = True
+
+
+def test_finalized_sessions_are_released_without_the_lock():
+    pool = WorkerPool(models={}, workers=1)
+    pool.workers = [make_worker(0)]
+    pool.assignments = {7: 0}
+    pool.workers[0].sessions.add(7)
+
+    # a finalizer running on a thread that is inside submit
+    with pool.lock:
+        pool.release_later(7)
+    pool._check_workers()
+    assert pool.assignments == {}
+    assert pool.workers[0].requests.get_nowait() == 7
+
+
+def test_closed_sessions_are_released_once():
+    released = []
+    pool = SimpleNamespace(release=released.append, release_later=released.append)
+    mercury_asr = MercuryASR(None, pool=pool)
+    mercury_asr.close()
+    mercury_asr.close()
+    del mercury_asr
+    gc.collect()
+    assert len(released) == 1